@@ -2,33 +2,55 @@
 # -*- coding: utf-8 -*-
 
 import io
+import re
+import gzip
+import zlib
+import hashlib
+import mmap
+import heapq
 import sys
-import argparse
-import requests
-from requests.exceptions import HTTPError
-import six
+import os
 import json
-from datetime import datetime
+import random
+import shutil
+import sqlite3
+import threading
+from array import array
+from bisect import bisect_left
+from collections import deque
+try:
+    from collections.abc import Mapping, MutableMapping
+except ImportError:
+    from collections import Mapping, MutableMapping
+from functools import partial
+from concurrent.futures import Future, ThreadPoolExecutor, wait, FIRST_COMPLETED
+from datetime import datetime, timedelta
 from os import path
 from abc import ABCMeta, abstractmethod
 
 try:
-    from urllib.parse import urlencode
-    from urllib.parse import urlunparse
+    import queue
+except ImportError:
+    import Queue as queue
+
+try:
+    from urllib.parse import urlencode, quote_plus
+    from urllib.parse import urlunparse, urlparse
 except ImportError:
-    from urllib import urlencode
-    from urlparse import urlunparse
-from bs4 import BeautifulSoup
-from time import sleep, time, mktime
+    from urllib import urlencode, quote_plus
+    from urlparse import urlunparse, urlparse
+from time import sleep, time, perf_counter, strftime, gmtime
 import logging
-from fake_useragent import UserAgent, settings as fake_useragent_settings
-import email
+
+# requests, bs4, lxml, fake_useragent, asyncio and the optional libraries are imported where they are used, so that
+# short-lived crawl processes start fast
 
 
 __author__ = 'Tom Dickinson, Flavio Martins, David Semedo'
 
 logger = logging.getLogger(__name__)
-logging.basicConfig(format='%(asctime)s : %(levelname)s : %(message)s', level=logging.INFO)
+LOG_FORMAT = '%(asctime)s : %(levelname)s : %(message)s'
+PY2 = sys.version_info[0] == 2
 
 # Only needed in case user additional details are required
 # If that is the case, the library requires the package python-twitter
@@ -39,423 +61,3938 @@ TWITTER_REST_API_ACCESS_TOKEN_SECRET = ""
 
 DEFAULT_RATE_DELAY = 0
 DEFAULT_ERROR_DELAY = 5
+MAX_BACKOFF = 900
 DEFAULT_LIMIT = None
 MAX_RETRIES_SESSION = 5
 MAX_RETRIES = MAX_RETRIES_SESSION*5
+MAX_THROTTLED_RETRIES = MAX_RETRIES  # Throttled retries of a request before it is given up on
+STOP_POLL_INTERVAL = 0.5  # Seconds between two looks at the stop event of a search waiting for its next page
 PROGRESS_PER = 100
+DEFAULT_ASYNC_CONCURRENCY = 100  # Requests in flight at once with --async
+PIPELINE_PAGES_PER_WORKER = 2  # Pages fetched ahead of the writer, per parsing process
+DEFAULT_PREFETCH_PAGES = 1  # Pages fetched ahead of the writer when parsing on the fetching thread
+CHECKPOINT_SUFFIX = ".ckpt"
+INCREMENTAL_STATE_FILE = "incremental.state"
+DEFAULT_POLL_MIN = 60  # Seconds between two polls of the busiest accounts with --follow
+DEFAULT_POLL_MAX = 6 * 3600  # Seconds between two polls of dormant accounts with --follow
+FOLLOW_ITEMS_PER_POLL = 20  # Accounts are polled about once per page of new items
+ACTIVITY_SMOOTHING = 0.3  # Weight of the last poll in the activity of an account
+DEFAULT_SINK = "jsonl"
+STDOUT = "-"  # Output file name that writes to the standard output
+DEFAULT_SINK_BATCH_SIZE = 100  # Lines written at once by the JSON lines sinks
+DEFAULT_ROW_GROUP_SIZE = 10000  # Rows per row group of the Parquet sink
+DEFAULT_DEDUP_PENDING = 1000000  # Ids kept in memory before they are merged into the on-disk index
+MERGE_CHUNK_SIZE = 65536
 DEFAULT_TARGET_TYPE = "tweets"
+DEFAULT_BASE_URL = "https://twitter.com"
+MAX_QUERY_LENGTH = 500  # Longest query packed with accounts by --pack_accounts
+DEFAULT_PARSER = "bs4"
 DATE_FORMAT = "%a %b %d %H:%M:%S +0000 %Y"  # "Fri Mar 29 11:03:41 +0000 2013";
+USER_INTERN_SIZE = 100000  # Authors shared between their tweets by the parsers before they start over
 
-class TwitterSearch:
-    __metaclass__ = ABCMeta
+# HTTP transport
+DEFAULT_POOL_SIZE = 10
+DEFAULT_CONNECT_TIMEOUT = 10
+DEFAULT_READ_TIMEOUT = 30
+USERAGENT_POOL_SIZE = 50
+CACHE_DIR_NAME = "twitterscraper"  # Directory of the cache directory of the user
+USERAGENT_POOL_FILE = "useragents.pool"  # In the cache directory of the user, for the default database
+USERAGENT_POOL_SUFFIX = ".pool"  # Next to the database given with --fake_useragent_cache_path
+USERAGENT_POOL_TTL = 7 * 24 * 3600  # Seconds before a pool is drawn again from its database
+FALLBACK_USERAGENT = 'Mozilla/5.0 (Windows NT 6.1; WOW64; rv:33.0) Gecko/20100101 Firefox/33.0'
+
+# Rate governor, in requests per second
+DEFAULT_RATE = 2.0
+DEFAULT_MAX_RATE = 20.0
+MIN_RATE = 0.05
+DEFAULT_BURST = 5
+RATE_INCREASE = 0.05  # Added to the rate after each request that goes through
+RATE_DECREASE = 0.5  # Rate multiplier after each throttled request
+
+# Date-range sharding. A crawl window is cut into slices that are crawled concurrently.
+SHARD_GRANULARITIES = {'day': timedelta(days=1), 'hour': timedelta(hours=1)}
+DEFAULT_SHARD_WORKERS = 1
+MIN_SHARD_SPAN = timedelta(hours=1)
+MAX_SHARD_SPAN = timedelta(days=32)
+SHARD_DENSE_PAGES = 50  # A slice needing more pages than this is split in two
+SHARD_SPARSE_ITEMS = 20  # A slice with fewer items than this doubles the size of the next slices
+SEARCH_DATE_FORMAT = "%Y-%m-%d"
+SEARCH_DATETIME_FORMAT = "%Y-%m-%d_%H:%M:%S_UTC"
+
+# Account searches run side by side with --account_workers
+DEFAULT_ACCOUNT_WORKERS = 1
+ACCOUNTS_PROGRESS_INTERVAL = 30  # Seconds between two progress reports across every account
+
+# Distributed crawls
+DEFAULT_UNIT_DAYS = 30  # Days of the search window of a work unit
+DEFAULT_LEASE = 300  # Seconds a worker holds a work unit for without renewing its lease
+MAX_UNIT_ATTEMPTS = 5  # Leases of a failing work unit before it is given up on
+QUEUE_POLL_INTERVAL = 5  # Seconds between two looks at the queue, by the coordinator and by idle workers
+PARTS_DIR = "parts"  # Directory of the output directory where workers write the output of each work unit
+
+# Crawl metrics
+METRICS_PREFIX = "twitterscraper_"  # Prefix of the exported metric names
+DEFAULT_METRICS_HOST = "127.0.0.1"  # Address the metrics are served on, only to the local machine by default
+PROFILE_REPORT_LINES = 30  # Functions listed in the report of --profile
+
+# Raw page cache
+DEFAULT_PAGE_CACHE_SIZE = 1 << 30  # Bytes of compressed pages kept, the oldest segments go first
+PAGE_CACHE_SEGMENT_SIZE = 64 << 20  # Bytes of compressed pages per segment file
+DEFAULT_PAGE_CACHE_TTL = 24 * 3600  # Seconds a cached page is served for, older ones are fetched again
+
+# User enrichment through the REST API
+USER_LOOKUP_BATCH = 100  # Most users a users/lookup request takes
+USER_LOOKUP_RATE = 1.0  # users/lookup allows 900 requests per 15 minute window
+DEFAULT_USER_LOOKUP_WORKERS = 4
+ENRICH_MAX_PENDING_PAGES = 10  # Pages waiting for their users before a partial batch is sent
+DEFAULT_USER_CACHE_TTL = 7 * 24 * 3600  # Seconds a cached profile is used for
+DEFAULT_USER_CACHE_SIZE = 1000000  # Profiles kept in the cache, the least recently used go first
+
+SEARCH_HEADERS = {
+    'Accept': 'application/json, text/javascript, */*; q=0.01',
+    'Referer': 'https://twitter.com/search',
+    'X-Twitter-Active-User': 'yes',
+    'X-Requested-With': 'XMLHttpRequest'
+}
 
-    def __init__(self, session, rate_delay, error_delay=5, useragent_cache_path=fake_useragent_settings.DB):
+def parse_retry_after(value):
+    """
+    Parses a Retry-After header, given either in seconds or as an HTTP date
+    :return: Seconds to wait, or None if the header is invalid
+    """
+    if re.match("([0-9])+$", value):
+        return int(value)
+
+    import email.utils
+
+    retry_after_tuple = email.utils.parsedate_tz(value)
+    if retry_after_tuple is None:
+        logger.error("Invalid Retry-After header: %s" % value)
+        return None
+    return max(email.utils.mktime_tz(retry_after_tuple) - time(), 0)
+
+
+def wait_or_stop(seconds, stop_event=None):
+    """
+    Sleeps for the given number of seconds, or until stop_event is set
+    :return: True if stop_event is set
+    """
+    if stop_event is None:
+        sleep(seconds)
+        return False
+    return stop_event.wait(seconds)
+
+
+class RateGovernor(object):
+    _shared = None
+    _shared_lock = threading.Lock()
+
+    def __init__(self, rate=DEFAULT_RATE, min_rate=MIN_RATE, max_rate=DEFAULT_MAX_RATE, burst=DEFAULT_BURST):
         """
-        :param rate_delay: How long to pause between calls to Twitter
-        :param error_delay: How long to pause when an error occurs
+        Paces requests to Twitter. It is a token bucket whose rate grows additively while requests go through and is
+        halved whenever Twitter throttles (AIMD), so it settles close to the highest rate that does not get throttled.
+        The x-rate-limit-* and Retry-After headers cap the rate and pause every request until the limit resets.
+        :param rate: Initial rate, in requests per second
+        :param min_rate: Lowest rate throttling can bring the governor down to
+        :param max_rate: Highest rate the governor grows to
+        :param burst: Number of requests that can go out back to back after an idle period
         """
-        self.session = session
-        self.rate_delay = rate_delay
-        self.error_delay = error_delay
+        self.lock = threading.Lock()
+        self._rate = rate
+        self.min_rate = min_rate
+        self.max_rate = max_rate
+        self.burst = burst
+        self.next_slot = 0
+        self.paused_until = 0
 
-        self.UA = UserAgent(fallback='Mozilla/5.0 (Windows NT 6.1; WOW64; rv:33.0) Gecko/20100101 Firefox/33.0',
-                       path=useragent_cache_path)
+    @classmethod
+    def shared(cls):
+        """
+        The governor shared by every search and thread of the process
+        """
+        with cls._shared_lock:
+            if cls._shared is None:
+                cls._shared = cls()
+            return cls._shared
 
-    def search(self, query, target_type, **kwargs):
+    @property
+    def rate(self):
         """
-        Scrape items from twitter
-        :param query:   Query to search Twitter with. Takes form of queries constructed with using Twitters
-                        advanced search: https://twitter.com/search-advanced
-        :param target_type:    Can be "tweets" or "users"
+        Current rate, in requests per second
         """
-        url = self.construct_url(query, target_type=target_type, language=kwargs['language'])
-        continue_search = True
-        min_item = None
+        return self._rate
 
-        # Initialize search function wrapper according to the target type
-        parse_tweets_fn = self.parse_tweets if target_type == DEFAULT_TARGET_TYPE else self.parse_users
+    def reserve(self):
+        """
+        Books a slot for the next request
+        :return: Seconds to wait before sending it
+        """
+        with self.lock:
+            now = time()
+            interval = 1.0 / self._rate
+            slot = max(self.next_slot, now - (self.burst - 1) * interval, self.paused_until)
+            self.next_slot = slot + interval
+            return max(slot - now, 0)
 
-        response = self.execute_search(url)
-        while response is not None and continue_search and response['items_html'] is not None:
-            items = parse_tweets_fn(response['items_html'])
+    def acquire(self, stop_event=None):
+        """
+        Waits for the next slot
+        :param stop_event: A threading.Event that cuts the wait short when set
+        :return: Seconds waited
+        """
+        seconds = self.reserve()
+        wait_or_stop(seconds, stop_event)
+        return seconds
 
-            # Check if we should collect additional user details
-            if target_type == "users" and kwargs["user_stats"]:
-                self.retrieve_user_details(items)
+    def set_rate(self, rate):
+        """
+        Sets the current rate, within the minimum and maximum rates
+        """
+        with self.lock:
+            self._rate = min(max(rate, self.min_rate), self.max_rate)
 
-            # If we have no items, then we can break the loop early
-            if len(items) == 0:
-                break
+    def pause(self, seconds):
+        """
+        Holds every request for the given number of seconds
+        """
+        with self.lock:
+            self.paused_until = max(self.paused_until, time() + seconds)
 
-            continue_search = self.save_items(items)
+    def success(self, headers):
+        """
+        Grows the rate after a request went through, within what the rate limit headers allow
+        """
+        with self.lock:
+            rate = min(self._rate + RATE_INCREASE, self.max_rate)
 
-            max_item = response["min_position"]
+            remaining = headers.get('x-rate-limit-remaining')
+            reset = headers.get('x-rate-limit-reset')
+            if remaining is not None and reset is not None:
+                window = max(int(reset) - time(), 1)
+                if int(remaining) <= 0:
+                    self.paused_until = max(self.paused_until, time() + window)
+                else:
+                    rate = min(rate, int(remaining) / window)
 
-            if min_item is not max_item:
-                url = self.construct_url(query, target_type=target_type, max_position=max_item,
-                                         language=kwargs['language'])
-                # Sleep for our rate_delay
-                sleep(self.rate_delay)
-                response = self.execute_search(url)
-                min_item = max_item
+            self._rate = max(rate, self.min_rate)
 
-    def execute_search(self, url, retry_num=0):
+    def throttled(self, headers):
         """
-        Executes a search to Twitter for the given URL
-        :param url: URL to search twitter with
-        :param retry_num: Retry number of current function call
-        :return: A JSON object with data from Twitter
+        Halves the rate and pauses every request until Twitter lifts the limit
         """
-        try:
-            logger.info("URL: " + url)
-            response = self.session.get(url)
-            response.raise_for_status()  # raise on any HTTPError
-            data = response.json()
-            return data
-        # If we get a HTTPError exception due to a request timing out, we sleep for our error delay, then make
-        # another attempt
-        except HTTPError as e:
-            # 400 Bad Request
-            if e.response.status_code == 400:
-                logger.debug("HTTP 400 - Bad request")
-                return response.json()
-            elif e.response.status_code == 429:
-                now_ts = datetime.datetime.utcnow().timestamp()
-                logger.debug("HTTP 429 - Too many requests")
-                logger.debug(e.response.headers)
-                utc_reset_ts = int(e.response.headers['x-rate-limit-reset'])
-                reset = utc_reset_ts - now_ts
-                logger.debug("Reset time: %s", str(reset))
-                # Multiply by small delay for paranoid reasons.
-                seconds = reset * self.error_delay
-                logger.debug("Going to sleep for %s seconds.", str(seconds))
-                sleep(seconds)
+        with self.lock:
+            self._rate = max(self._rate * RATE_DECREASE, self.min_rate)
+            logger.info("HTTP 429 - Too many requests, rate lowered to %.2f requests per second", self._rate)
+
+        if 'x-rate-limit-reset' in headers:
+            seconds = int(headers['x-rate-limit-reset']) - time()
+        elif 'retry-after' in headers:
+            seconds = parse_retry_after(headers['retry-after'])
+        else:
+            seconds = None
+
+        if seconds is None:
+            seconds = 1.0 / self._rate
+        # A little jitter, so that waiting searches do not all come back at once
+        self.pause(max(seconds, 0) + random.uniform(0, 1))
+
+    @staticmethod
+    def backoff(retry_num, base_delay):
+        """
+        Jittered exponential back-off
+        :param retry_num: Number of retries so far
+        :param base_delay: Delay of the first retry
+        :return: Seconds to wait
+        """
+        delay = min(base_delay * (2 ** min(retry_num, 16)), MAX_BACKOFF)
+        return random.uniform(delay / 2, delay)
+
+
+def user_cache_dir():
+    """
+    :return: The directory of the files the script keeps across runs for the current user, such as the user agent
+             pool: under XDG_CACHE_HOME or ~/.cache, or LOCALAPPDATA on Windows
+    """
+    if os.name == 'nt':
+        base = os.environ.get('LOCALAPPDATA') or path.expanduser('~')
+    else:
+        base = os.environ.get('XDG_CACHE_HOME') or path.join(path.expanduser('~'), '.cache')
+    return path.join(base, CACHE_DIR_NAME)
+
+
+class UserAgentPool(object):
+    _shared = {}
+    _shared_lock = threading.Lock()
+
+    def __init__(self, useragent_cache_path=None, size=USERAGENT_POOL_SIZE):
+        """
+        A fixed set of user agents drawn once from the fake_useragent database, rotated through like UserAgent.random.
+        The pool is kept in a small file of its own, one user agent per line, that later processes map into memory
+        instead of loading fake_useragent and its database again.
+        :param useragent_cache_path: Path of the fake_useragent database, its default one if None
+        :param size: Number of user agents in the pool
+        """
+        self.filepath = self.pool_path(useragent_cache_path)
+        self.data = None
+        if not self.load(useragent_cache_path):
+            self.data = self.draw(useragent_cache_path, size)
+            # A pool drawn while the database could not be loaded would turn rotation off for as long as it is kept
+            if self.data == (FALLBACK_USERAGENT + '\n').encode('utf-8'):
+                logger.warning("Could not load the fake_useragent database, using a single user agent.")
             else:
-                retry_after = e.response.headers['retry-after']
-                reset_seconds = 1
+                self.save()
+        # Where each line starts, plus the end of the last one
+        self.offsets = array('L', [0])
+        self.offsets.extend(match.end() for match in re.finditer(b'\n', self.data))
 
-                if retry_after is not None:
-                    if re.match("([0-9])+", retry_after):
-                        reset_seconds = int(retry_after)
-                    else:
-                        retry_after_tuple = email.utils.parsedate(retry_after)
-                        if retry_after_tuple is None:
-                            logger.error("Invalid Retry-After header: %s" % retry_after)
-                        retry_date = mktime(retry_after_tuple)
-                        reset_seconds = retry_date - time()
-
-                logger.error(e.response.message)
-                total_sleep = reset_seconds * self.error_delay
-                logger.info("Sleeping for %i", total_sleep)
-                sleep(total_sleep)
-                
-                if retry_num % MAX_RETRIES_SESSION == 0 and retry_num > 0:
-                    headers = {'User-Agent': self.UA.random}
-                    self.session.headers.update(headers)
-                elif retry_num == MAX_RETRIES:
-                    return None
-            return self.execute_search(url, retry_num + 1)
+    @staticmethod
+    def pool_path(useragent_cache_path):
+        if useragent_cache_path is None:
+            return path.join(user_cache_dir(), USERAGENT_POOL_FILE)
+        return useragent_cache_path + USERAGENT_POOL_SUFFIX
+
+    def load(self, useragent_cache_path):
+        """
+        Maps the pool file into memory, unless it is missing, stale or older than its database
+        :return: True if the pool was loaded
+        """
+        try:
+            modified = path.getmtime(self.filepath)
+            if time() - modified > USERAGENT_POOL_TTL or path.getsize(self.filepath) == 0:
+                return False
+            if useragent_cache_path is not None and path.isfile(useragent_cache_path) and \
+                    path.getmtime(useragent_cache_path) > modified:
+                return False
+            with io.open(self.filepath, 'rb') as f:
+                self.data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+        except (OSError, ValueError):
+            return False
+        return True
 
     @staticmethod
-    def parse_tweets(items_html):
+    def draw(useragent_cache_path, size):
         """
-        Parses Tweets from the given HTML
-        :param items_html: The HTML block with tweets
-        :return: A JSON list of tweets
+        :return: The user agents drawn from the database, as the lines of the pool file
         """
-        soup = BeautifulSoup(items_html, 'lxml')
+        from fake_useragent import UserAgent
 
-        comma = ','
-        dot = '.'
-        tweets = []
-        for tweet in soup.find_all(class_='stream-item'):
-            if 'data-item-id' not in tweet.attrs:
-                continue
+        if useragent_cache_path is None:
+            useragent = UserAgent(fallback=FALLBACK_USERAGENT)
+        else:
+            useragent = UserAgent(fallback=FALLBACK_USERAGENT, path=useragent_cache_path)
+        useragents = sorted(set(useragent.random for _ in range(size)))
+        return ''.join(value + '\n' for value in useragents).encode('utf-8')
 
-            id_str = tweet.attrs['data-item-id']
-            id = int(id_str)
+    def save(self):
+        # Written aside and renamed, processes starting at the same time never map a partial pool
+        tmp_path = "%s.%i.tmp" % (self.filepath, os.getpid())
+        try:
+            dirpath = path.dirname(self.filepath)
+            if dirpath and not path.isdir(dirpath):
+                os.makedirs(dirpath, 0o700)
+            with io.open(tmp_path, 'wb') as f:
+                f.write(self.data)
+            os.replace(tmp_path, self.filepath)
+        except OSError as e:
+            logger.warning("%s : Could not save the user agent pool: %s", self.filepath, e)
 
-            tweet_text = tweet.find(class_="tweet-text")
-            if tweet_text is None:
-                continue
+    @classmethod
+    def shared(cls, useragent_cache_path=None):
+        """
+        The pool loaded from the given database, shared by every search of the process
+        """
+        with cls._shared_lock:
+            if useragent_cache_path not in cls._shared:
+                cls._shared[useragent_cache_path] = cls(useragent_cache_path)
+            return cls._shared[useragent_cache_path]
 
-            timestamp = int(tweet.find(class_="_timestamp").attrs['data-time'])
-            created_at = datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT)
+    @property
+    def useragents(self):
+        return [self.data[start:end - 1].decode('utf-8') for start, end in zip(self.offsets, self.offsets[1:])]
 
-            tweet_div = tweet.find(class_="tweet")
-            user = {
-                'id_str': tweet_div.attrs['data-user-id'],
-                'id': int(tweet_div.attrs['data-user-id']),
-                'screen_name': tweet_div.attrs['data-screen-name'],
-                'name': tweet_div.attrs['data-name'],
+    @property
+    def random(self):
+        i = random.randrange(len(self.offsets) - 1)
+        return self.data[self.offsets[i]:self.offsets[i + 1] - 1].decode('utf-8')
+
+
+class TransportError(Exception):
+    """
+    Raised by Transport when a request gets no response
+    """
+
+
+def accept_encoding():
+    """
+    :return: The Accept-Encoding header of the searches, with brotli if a package to decode it is installed
+    """
+    try:
+        import brotli  # Lets requests, httpx and aiohttp decode brotli responses
+    except ImportError:
+        return 'gzip, deflate'
+    return 'gzip, deflate, br'
+
+
+def request_errors():
+    """
+    :return: The exceptions of a request that got no response, from a Transport or a plain requests.Session
+    """
+    import requests
+
+    return TransportError, requests.exceptions.RequestException
+
+
+class Transport(object):
+    def __init__(self, pool_size=DEFAULT_POOL_SIZE, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+                 read_timeout=DEFAULT_READ_TIMEOUT, http2=False):
+        """
+        The HTTP client shared by every search: a pool of keep-alive connections with timeouts, asking for compressed
+        responses. It stands in for a requests.Session.
+        :param pool_size: Number of connections kept open, which should match the number of concurrent searches
+        :param connect_timeout: Seconds to wait for a connection
+        :param read_timeout: Seconds to wait for a response
+        :param http2: Use an HTTP/2 client, requires the httpx package with its http2 extra
+        """
+        self.http2 = http2
+        headers = {'Accept-Encoding': accept_encoding(), 'Connection': 'keep-alive'}
+
+        if http2:
+            import httpx
+            self.client = httpx.Client(http2=True, headers=headers,
+                                       timeout=httpx.Timeout(read_timeout, connect=connect_timeout),
+                                       limits=httpx.Limits(max_connections=pool_size,
+                                                           max_keepalive_connections=pool_size))
+            self.errors = (httpx.TransportError,)
+            self.timeout = None
+        else:
+            import requests
+            from requests.adapters import HTTPAdapter
+
+            self.client = requests.Session()
+            adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size, max_retries=0, pool_block=True)
+            self.client.mount('https://', adapter)
+            self.client.mount('http://', adapter)
+            self.client.headers.update(headers)
+            self.errors = (requests.exceptions.RequestException,)
+            self.timeout = (connect_timeout, read_timeout)
+
+    @property
+    def headers(self):
+        return self.client.headers
+
+    def get(self, url):
+        try:
+            if self.http2:
+                return self.client.get(url)
+            return self.client.get(url, timeout=self.timeout)
+        except self.errors as e:
+            raise TransportError(str(e))
+
+    def close(self):
+        self.client.close()
+
+
+class Metrics(object):
+    def __init__(self):
+        """
+        Counters and timings of the stages of a crawl. Nothing is recorded until it is enabled, so that the
+        instrumentation of the hot paths costs a single attribute check otherwise.
+        Timings are kept as Prometheus summaries: the number of observations, their sum and their maximum.
+        """
+        self.enabled = False
+        self.lock = threading.Lock()
+        self.started = time()
+        self.counters = {}
+        self.timings = {}
+
+    def count(self, name, value=1):
+        if not self.enabled:
+            return
+        with self.lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def observe(self, name, value):
+        """
+        Records a timing in seconds, or any other measurement such as the number of items of a page
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            timing = self.timings.get(name)
+            if timing is None:
+                self.timings[name] = [1, value, value]
+            else:
+                timing[0] += 1
+                timing[1] += value
+                timing[2] = max(timing[2], value)
+
+    def reset(self):
+        with self.lock:
+            self.started = time()
+            self.counters = {}
+            self.timings = {}
+
+    def snapshot(self):
+        """
+        :return: A dict of everything recorded so far, which can be logged as JSON or merged into other Metrics
+        """
+        with self.lock:
+            return {
+                'uptime': time() - self.started,
+                'counters': dict(self.counters),
+                'timings': {name: {'count': timing[0], 'sum': timing[1], 'max': timing[2]}
+                            for name, timing in self.timings.items()},
             }
 
-            interactions = [x.get_text() for x in tweet.find_all(class_='ProfileTweet-actionCount')]
-            replies = int(interactions[0].split(" ")[0].replace(comma, "").replace(dot, ""))
-            retweets = int(interactions[1].split(" ")[
-                               0].replace(comma, "").replace(dot, ""))
-            likes = int(interactions[2].split(" ")[0].replace(comma, "").replace(dot, ""))
-            hashtags = [hashtag_node.get_text() for hashtag_node in tweet.find_all(class_='twitter-hashtag')]
-            urls = [url_node.attrs['data-expanded-url']
-                    for url_node in tweet.find_all('a', class_='twitter-timeline-link')
-                    if 'data-expanded-url' in url_node.attrs]
-            photos = [photo_node.attrs['data-image-url']
-                      for photo_node in tweet.find_all(class_='AdaptiveMedia-photoContainer')
-                      if 'data-image-url' in photo_node.attrs]
+    def merge(self, snapshot):
+        """
+        Adds what another Metrics recorded, such as the one of a parsing process
+        """
+        if not self.enabled:
+            return
+        with self.lock:
+            for name, value in snapshot['counters'].items():
+                self.counters[name] = self.counters.get(name, 0) + value
+            for name, other in snapshot['timings'].items():
+                timing = self.timings.setdefault(name, [0, 0, other['max']])
+                timing[0] += other['count']
+                timing[1] += other['sum']
+                timing[2] = max(timing[2], other['max'])
 
-            videos = []
-            native_video_node = tweet.find(class_='PlayableMedia-player')
-            if native_video_node is not None:
-                videos.append({
-                    'expanded_url': 'https://twitter.com/i/videos/tweet/%s' % id_str
-                })
+    def prometheus(self):
+        """
+        :return: Everything recorded so far in the Prometheus text exposition format
+        """
+        snapshot = self.snapshot()
+        lines = ['# TYPE %suptime_seconds gauge' % METRICS_PREFIX,
+                 '%suptime_seconds %f' % (METRICS_PREFIX, snapshot['uptime'])]
+        for name, value in sorted(snapshot['counters'].items()):
+            lines.append('# TYPE %s%s counter' % (METRICS_PREFIX, name))
+            lines.append('%s%s %s' % (METRICS_PREFIX, name, value))
+        for name, timing in sorted(snapshot['timings'].items()):
+            lines.append('# TYPE %s%s summary' % (METRICS_PREFIX, name))
+            lines.append('%s%s_count %i' % (METRICS_PREFIX, name, timing['count']))
+            lines.append('%s%s_sum %f' % (METRICS_PREFIX, name, timing['sum']))
+            lines.append('# TYPE %s%s_max gauge' % (METRICS_PREFIX, name))
+            lines.append('%s%s_max %f' % (METRICS_PREFIX, name, timing['max']))
+        return '\n'.join(lines) + '\n'
 
-            cards = []
-            card_nodes = tweet.find_all(class_='card2')
-            for node in card_nodes:
-                card_type = node.get('data-card2-name', None)
-                if card_type is not None:  # Only care about media. Ignore Tweet Quotes, etc.
-                    if 'summary' in card_type:  # Expanded URL w/ image
-                        iframe_container = node.find(class_='js-macaw-cards-iframe-container')
-                        if iframe_container is not None:
-                            timeline_link = tweet_text.find('a', class_='twitter-timeline-link')
-                            if timeline_link is not None and 'data-expanded-url' in timeline_link.attrs:
-                                cards.append({
-                                    'card_url': 'https://twitter.com' + iframe_container.attrs['data-src'],
-                                    'expanded_url': timeline_link.attrs['data-expanded-url']
-                                })
-                            else:
-                                logger.error("BAD CARD: %s", id_str)
-                    elif 'player' in card_type:  # Embedded video
-                        timeline_link = tweet_text.find('a', class_='twitter-timeline-link')
-                        if timeline_link is not None and 'data-expanded-url' in timeline_link.attrs:
-                            videos.append({
-                                'expanded_url': timeline_link.attrs['data-expanded-url']
-                            })
-                        else:
-                            logger.error("BAD CARD: %s", id_str)
 
-            # remove u-hidden links, etc
-            for hidden_child in tweet_text.find_all(class_='u-hidden'):
-                hidden_child.decompose()
-            text = tweet_text.get_text()
+# The metrics of the process, recorded by every search once enabled
+METRICS = Metrics()
 
-            tweets.append({
-                'created_at': created_at,
-                'text': text,
-                'id': id,
-                'id_str': id_str,
-                'epoch': timestamp,
-                'reply_count': replies,
-                'retweet_count': retweets,
-                'favorite_count': likes,
-                'hashtags': hashtags,
-                'cards': cards,
-                'urls': urls,
-                'photos': photos,
-                'videos': videos,
-                'user': user,
-            })
-        return tweets
+
+def parse_with_metrics(parse_fn, items_html):
+    """
+    Runs a parser on a parsing process, recording its metrics there
+    :return: The items, and a snapshot of the metrics to merge into those of the crawl
+    """
+    METRICS.enabled = True
+    METRICS.reset()
+    items = parse_fn(items_html)
+    return items, METRICS.snapshot()
+
+
+class MetricsReporter(object):
+    def __init__(self, metrics, interval=0, filepath=None, port=None, host=DEFAULT_METRICS_HOST):
+        """
+        Reports the metrics of a crawl while it runs, and once more when closed
+        :param metrics: The Metrics to report, enabled by the reporter
+        :param interval: Seconds between two reports, 0 to only report once closed
+        :param filepath: Path of a file rewritten with the metrics in the Prometheus text format at each report
+        :param port: Serve the metrics on http://host:port/metrics for Prometheus to scrape
+        :param host: Address to serve the metrics on, e.g. 0.0.0.0 to serve them to other machines
+        """
+        self.metrics = metrics
+        self.interval = interval
+        self.filepath = filepath
+        self.metrics.enabled = True
+        self.stop_event = threading.Event()
+
+        self.server = None
+        if port is not None:
+            from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+            class MetricsHandler(BaseHTTPRequestHandler):
+                def do_GET(handler):
+                    if handler.path.split('?')[0] != '/metrics':
+                        handler.send_error(404)
+                        return
+                    body = metrics.prometheus().encode('utf-8')
+                    handler.send_response(200)
+                    handler.send_header('Content-Type', 'text/plain; version=0.0.4')
+                    handler.send_header('Content-Length', str(len(body)))
+                    handler.end_headers()
+                    handler.wfile.write(body)
+
+                def log_message(handler, format, *args):
+                    logger.debug(format, *args)
+
+            self.server = ThreadingHTTPServer((host, port), MetricsHandler)
+            self.server.daemon_threads = True
+            threading.Thread(target=self.server.serve_forever, daemon=True).start()
+            logger.info("Serving metrics on %s port %i.", host, self.server.server_address[1])
+
+        self.thread = None
+        if interval:
+            self.thread = threading.Thread(target=self.run, daemon=True)
+            self.thread.start()
+
+    def run(self):
+        while not self.stop_event.wait(self.interval):
+            self.report()
+
+    def report(self):
+        """
+        Logs the metrics as a JSON line and rewrites the metrics file
+        """
+        logger.info("Metrics: %s", json.dumps(self.metrics.snapshot(), sort_keys=True))
+        if self.filepath:
+            # Replaced in one go, so that a scraper never reads half a file
+            with io.open(self.filepath + '.tmp', 'w', encoding='utf-8') as metrics_file:
+                metrics_file.write(self.metrics.prometheus())
+            os.replace(self.filepath + '.tmp', self.filepath)
+
+    def close(self):
+        self.stop_event.set()
+        if self.thread is not None:
+            self.thread.join()
+        self.report()
+        if self.server is not None:
+            self.server.shutdown()
+            self.server.server_close()
+
+
+# Encoders giving the same output as json.dumps(..., ensure_ascii=False)
+encode_json_string = json.encoder.encode_basestring
+encode_json = json.JSONEncoder(ensure_ascii=False).encode
+
+
+def encode_json_strings(values):
+    """
+    :return: The JSON of a list of strings, faster than encode_json for the short lists of tweets
+    """
+    if not values:
+        return '[]'
+    return '[' + ', '.join(map(encode_json_string, values)) + ']'
+
+
+class User(Mapping):
+    """
+    The author of a tweet, as a dict. Parsers share one User between all the tweets of an author, so it is
+    copy-on-write: tweet['user'] is a TweetUser, and the first change made through it gives that tweet a dict of its
+    own.
+    """
+    __slots__ = ('id_str', 'id', 'screen_name', 'name', 'json')
+    FIELDS = ('id_str', 'id', 'screen_name', 'name')
+    _interned = {}
+
+    def __init__(self, id_str, screen_name, name):
+        self.id_str = id_str
+        self.id = int(id_str)
+        self.screen_name = screen_name
+        self.name = name
+        self.json = None
+
+    @classmethod
+    def intern(cls, id_str, screen_name, name):
+        """
+        :return: The User already made for these details, or a new one
+        """
+        key = (id_str, screen_name, name)
+        user = cls._interned.get(key)
+        if user is None:
+            if len(cls._interned) >= USER_INTERN_SIZE:
+                cls._interned.clear()
+            user = cls._interned[key] = cls(id_str, screen_name, name)
+        return user
+
+    def __getitem__(self, key):
+        if key not in self.FIELDS:
+            raise KeyError(key)
+        return getattr(self, key)
+
+    def __iter__(self):
+        return iter(self.FIELDS)
+
+    def __len__(self):
+        return len(self.FIELDS)
+
+    def __repr__(self):
+        return 'User(%r)' % dict(self)
+
+    def to_json(self):
+        # Encoded once for all the tweets of the author
+        if self.json is None:
+            self.json = '{"id_str": %s, "id": %i, "screen_name": %s, "name": %s}' % (
+                encode_json(self.id_str), self.id, encode_json(self.screen_name), encode_json(self.name))
+        return self.json
+
+
+class TweetUser(MutableMapping):
+    """
+    The user of a Tweet as read through tweet['user']. Reads go to the User shared by the tweets of the author, the
+    first change copies it into a dict of the tweet, leaving the other tweets of the author as they were.
+    """
+    __slots__ = ('tweet',)
+
+    def __init__(self, tweet):
+        self.tweet = tweet
+
+    def own(self):
+        """
+        :return: The user of the tweet, copied from the shared User first if it still is one
+        """
+        if isinstance(self.tweet.user, User):
+            self.tweet.user = dict(self.tweet.user)
+        return self.tweet.user
+
+    def __getitem__(self, key):
+        return self.tweet.user[key]
+
+    def __setitem__(self, key, value):
+        self.own()[key] = value
+
+    def __delitem__(self, key):
+        del self.own()[key]
+
+    def __iter__(self):
+        return iter(self.tweet.user)
+
+    def __len__(self):
+        return len(self.tweet.user)
+
+    def __repr__(self):
+        return repr(dict(self))
+
+
+class Missing(object):
+    """
+    Stands for a key of Tweet.FIELDS deleted from a tweet. MISSING is the only one, copies and pickles of a tweet
+    get it back rather than a new object.
+    """
+    __slots__ = ()
+
+    def __reduce__(self):
+        return 'MISSING'
+
+    def __repr__(self):
+        return 'MISSING'
+
+
+MISSING = Missing()
+
+
+class Tweet(MutableMapping):
+    """
+    A parsed tweet, with the keys and values of the dicts parsers used to return, in a fraction of their memory.
+    Its author is a shared User, read through a TweetUser, created_at is only formatted when it is read, and to_json
+    encodes it without building a dict. Keys other than FIELDS can be added, such tweets are encoded through
+    dict(tweet).
+    """
+    __slots__ = ('text', 'id', 'id_str', 'epoch', 'reply_count', 'retweet_count', 'favorite_count', 'hashtags',
+                 'cards', 'urls', 'photos', 'videos', 'user', 'extra')
+    FIELDS = ('created_at', 'text', 'id', 'id_str', 'epoch', 'reply_count', 'retweet_count', 'favorite_count',
+              'hashtags', 'cards', 'urls', 'photos', 'videos', 'user')
+
+    def __init__(self, text, id, id_str, epoch, reply_count, retweet_count, favorite_count, hashtags, cards, urls,
+                 photos, videos, user):
+        self.text = text
+        self.id = id
+        self.id_str = id_str
+        self.epoch = epoch
+        self.reply_count = reply_count
+        self.retweet_count = retweet_count
+        self.favorite_count = favorite_count
+        self.hashtags = hashtags
+        self.cards = cards
+        self.urls = urls
+        self.photos = photos
+        self.videos = videos
+        self.user = user
+        # Keys added or deleted through the dict interface, created_at once it is set
+        self.extra = None
+
+    @property
+    def created_at(self):
+        if self.extra is not None and 'created_at' in self.extra:
+            return self.extra['created_at']
+        return strftime(DATE_FORMAT, gmtime(self.epoch))
+
+    def __getitem__(self, key):
+        if self.extra is not None and key in self.extra:
+            value = self.extra[key]
+        elif key in self.FIELDS:
+            value = getattr(self, key)
+        else:
+            raise KeyError(key)
+        if value is MISSING:
+            raise KeyError(key)
+        if key == 'user' and isinstance(value, User):
+            return TweetUser(self)
+        return value
+
+    def __setitem__(self, key, value):
+        if key in self.__slots__ and key != 'extra' and (self.extra is None or key not in self.extra):
+            setattr(self, key, value)
+        else:
+            if self.extra is None:
+                self.extra = {}
+            self.extra[key] = value
+
+    def __delitem__(self, key):
+        self[key]
+        if self.extra is None:
+            self.extra = {}
+        if key in self.FIELDS:
+            self.extra[key] = MISSING
+        else:
+            del self.extra[key]
+
+    def __iter__(self):
+        if self.extra is None:
+            return iter(self.FIELDS)
+        keys = [key for key in self.FIELDS if self.extra.get(key) is not MISSING]
+        return iter(keys + [key for key in self.extra if key not in self.FIELDS])
+
+    def __len__(self):
+        return sum(1 for _ in self)
+
+    def __repr__(self):
+        return 'Tweet(%r)' % dict(self)
+
+    def to_dict(self):
+        """
+        :return: The tweet as the nested dicts parsers used to return
+        """
+        item = dict(self)
+        if isinstance(item.get('user'), Mapping):
+            item['user'] = dict(item['user'])
+        return item
+
+    def to_json(self):
+        """
+        :return: The same JSON as json.dumps(self.to_dict(), ensure_ascii=False)
+        """
+        if self.extra is not None:
+            return encode_json(self.to_dict())
+        user = self.user.to_json() if isinstance(self.user, User) else encode_json(self.user)
+        return ('{"created_at": "%s", "text": %s, "id": %i, "id_str": %s, "epoch": %i, "reply_count": %i, '
+                '"retweet_count": %i, "favorite_count": %i, "hashtags": %s, "cards": %s, "urls": %s, "photos": %s, '
+                '"videos": %s, "user": %s}') % (
+            self.created_at, encode_json_string(self.text), self.id, encode_json_string(self.id_str), self.epoch,
+            self.reply_count, self.retweet_count, self.favorite_count,
+            encode_json_strings(self.hashtags), encode_json(self.cards) if self.cards else '[]',
+            encode_json_strings(self.urls), encode_json_strings(self.photos),
+            encode_json(self.videos) if self.videos else '[]', user)
+
+
+class SearchQuery(object):
+    def __init__(self, terms=None, accounts=None, since=None, until=None, search_filter=None, lang=None):
+        """
+        A query in the search syntax of Twitter, built from its parts
+        :param terms: Words, phrases and other operators to search for
+        :param accounts: Screen names the tweets are from, any one of them when there are several
+        :param since: Date the tweets are from, see parse_search_date
+        :param until: Date the tweets are before
+        :param search_filter: Kind of tweets searched for, such as links or images
+        :param lang: Language of the tweets, as an operator of the query rather than a parameter of the URL
+        """
+        self.terms = list(terms or [])
+        self.accounts = list(accounts or [])
+        self.since = since
+        self.until = until
+        self.search_filter = search_filter
+        self.lang = lang
+
+    def with_accounts(self, accounts):
+        """
+        :return: A copy of the query searching the tweets of accounts
+        """
+        return SearchQuery(self.terms, accounts, since=self.since, until=self.until, search_filter=self.search_filter,
+                           lang=self.lang)
+
+    def pack(self, accounts, max_length=MAX_QUERY_LENGTH):
+        """
+        Spreads accounts over as few queries as max_length allows, in their order, so that they are searched with
+        fewer chains of pages
+        :return: A list of queries, each one searching the tweets of a group of accounts
+        """
+        queries = []
+        group = []
+        for account in accounts:
+            if group and len(str(self.with_accounts(group + [account]))) > max_length:
+                queries.append(self.with_accounts(group))
+                group = []
+            group.append(account)
+        if group:
+            queries.append(self.with_accounts(group))
+        return queries
+
+    def __str__(self):
+        operators = []
+        if self.since:
+            operators.append("since:" + self.since)
+        if self.until:
+            operators.append("until:" + self.until)
+        if self.search_filter:
+            operators.append("filter:" + self.search_filter)
+        if self.lang:
+            operators.append("lang:" + self.lang)
+        if len(self.accounts) == 1:
+            operators.append("from:" + self.accounts[0])
+        elif self.accounts:
+            operators.append("(%s)" % " OR ".join("from:" + account for account in self.accounts))
+        return " ".join([" ".join(self.terms)] + operators)
+
+
+class SearchUrl(object):
+    MARKER = 'MAXPOSITION'
+
+    def __init__(self, query, target_type, language=None, base_url=DEFAULT_BASE_URL, construct_url=None):
+        """
+        The URLs of the pages of a search. They only differ in their max_position, so the rest is encoded once.
+        :param construct_url: Builds the URL of a page, TwitterSearch.construct_url by default
+        """
+        construct_url = construct_url or TwitterSearch.construct_url
+        url = construct_url(query, target_type=target_type, max_position=self.MARKER, language=language,
+                            base_url=base_url)
+        self.prefix, _, self.suffix = url.partition('max_position=' + self.MARKER)
+        self.prefix += 'max_position='
+
+    def page(self, max_position=None):
+        """
+        :return: The same URL as TwitterSearch.construct_url for the page at max_position
+        """
+        started = perf_counter()
+        url = self.prefix + quote_plus(str(max_position)) + self.suffix
+        METRICS.observe('url_seconds', perf_counter() - started)
+        return url
+
+
+class TwitterSearch:
+    __metaclass__ = ABCMeta
+    # Have the parsers return Tweet records rather than dicts, see uses_records
+    compact_records = False
+    # A threading.Event set from outside to stop the search, see TwitterSearchImpl
+    stop_event = None
+
+    def __init__(self, session, rate_delay, error_delay=5, useragent_cache_path=None,
+                 useragent=None, parser=DEFAULT_PARSER, governor=None, base_url=DEFAULT_BASE_URL, enricher=None,
+                 page_cache=None, offline=False):
+        """
+        :param session: A Transport, or any client with get and headers like a requests.Session
+        :param rate_delay: How long to pause between calls to Twitter
+        :param error_delay: How long to pause when an error occurs, before backing off exponentially
+        :param useragent: A UserAgent or UserAgentPool, the pool loaded from useragent_cache_path if None
+        :param parser: The HTML parser backend, one of PARSERS
+        :param governor: The RateGovernor pacing requests, the one shared by the process if None
+        :param base_url: Scheme and host searches are sent to, such as a local stand-in server for benchmarks
+        :param enricher: The UserEnricher looking users up for user_stats searches, one of its own if None
+        :param page_cache: A PageCache serving and keeping the responses of Twitter
+        :param offline: Only replay the pages in page_cache, without going to Twitter
+        """
+        self.session = session
+        self.rate_delay = rate_delay
+        self.error_delay = error_delay
+        self.governor = governor if governor is not None else RateGovernor.shared()
+        self.base_url = base_url
+        self._enricher = enricher
+        self.page_cache = page_cache
+        self.offline = offline
+        # Saved pages waiting for the profiles of their users
+        self.enriching = deque()
+        self.gave_up = False
+
+        if parser != DEFAULT_PARSER:
+            self.parse_tweets, self.parse_users = PARSERS[parser]
+
+        if useragent is None:
+            useragent = UserAgentPool.shared(useragent_cache_path)
+        self.UA = useragent
+
+    @classmethod
+    def uses_records(cls):
+        """
+        Whether the parsers give this search Tweet records rather than dicts. Records only go to a save_items written
+        for them: a subclass overriding save_items gets dicts unless it sets compact_records itself.
+        """
+        for klass in cls.__mro__:
+            if 'compact_records' in vars(klass):
+                return vars(klass)['compact_records']
+            if 'save_items' in vars(klass):
+                return False
+        return False
+
+    def update_session_headers(self):
+        """
+        Specify a user agent to prevent Twitter from returning a profile card
+        """
+        headers = dict(SEARCH_HEADERS)
+        headers['User-Agent'] = self.UA.random
+        self.session.headers.update(headers)
+
+    def search(self, query, target_type, **kwargs):
+        """
+        Scrape items from twitter
+        :param query:   Query to search Twitter with. Takes form of queries constructed with using Twitters
+                        advanced search: https://twitter.com/search-advanced
+        :param target_type:    Can be "tweets" or "users"
+        :param parse_workers:  When set, parse pages on that many processes
+        :param max_position:   Cursor of the page to start from, to resume an interrupted search
+        :return: False if the search gave up after too many failed requests
+        """
+        pages = self.iter_pages(query, target_type, max_position=kwargs.get('max_position'),
+                                language=kwargs.get('language'), user_stats=kwargs.get('user_stats'),
+                                parse_workers=kwargs.get('parse_workers'))
+        try:
+            for items, max_position in pages:
+                # A page is only checkpointed once saved, a stopped search leaves it to the next run
+                if self.stopped():
+                    break
+                started = perf_counter()
+                continue_search = self.save_items(items)
+                METRICS.observe('save_seconds', perf_counter() - started)
+                self.checkpoint(query, max_position, items)
+                if not continue_search:
+                    break
+        finally:
+            pages.close()
+        return not self.gave_up
+
+    def iter_search(self, query, target_type=DEFAULT_TARGET_TYPE, **kwargs):
+        """
+        Yields the items of a search one by one, as its pages come in. Takes the keyword arguments of iter_pages.
+        """
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            for items, _ in pages:
+                for item in items:
+                    yield item
+        finally:
+            pages.close()
+
+    def iter_pages(self, query, target_type=DEFAULT_TARGET_TYPE, max_position=None, language=None, user_stats=False,
+                   parse_workers=0, prefetch=DEFAULT_PREFETCH_PAGES):
+        """
+        Yields the pages of a search as they come in, with the next pages fetched on a thread while the caller works
+        through the current one. Closing the generator, dropping it, or setting the stop_event of the search stops
+        the search, including its waits for the rate governor and between retries.
+        Sets gave_up once done if the search gave up after too many failed requests.
+        :param query:   Query to search Twitter with
+        :param target_type:    Can be "tweets" or "users"
+        :param max_position:   Cursor of the page to start from, to resume an interrupted search
+        :param language: Specifies a language to filter search results
+        :param user_stats: Add the profiles of their users to the items, see UserEnricher
+        :param parse_workers: Number of processes parsing pages, pages are parsed on the fetching thread if 0
+        :param prefetch: Number of pages fetched ahead of the caller, parse_workers * PIPELINE_PAGES_PER_WORKER if
+                         pages are parsed on processes
+        :return: A generator of (items, max_position) tuples, max_position being the cursor of the next page
+        """
+        # Initialize search function wrapper according to the target type
+        parse_tweets_fn = self.parse_tweets if target_type == DEFAULT_TARGET_TYPE else self.parse_users
+        if target_type == DEFAULT_TARGET_TYPE and self.uses_records():
+            parse_tweets_fn = partial(parse_tweets_fn, compact=True)
+        self.gave_up = False
+
+        # Parsed pages waiting for the caller. Once it is full the fetcher waits, so it never runs far ahead.
+        pages = queue.Queue(maxsize=parse_workers * PIPELINE_PAGES_PER_WORKER if parse_workers else prefetch)
+        stop_event = threading.Event()
+        errors = []
+
+        def put(page):
+            while not stop_event.is_set():
+                try:
+                    pages.put(page, timeout=0.1)
+                    return True
+                except queue.Full:
+                    pass
+            return False
+
+        def fetch(executor):
+            try:
+                urls = SearchUrl(query, target_type, language=language, base_url=self.base_url,
+                                 construct_url=self.construct_url)
+                url = urls.page(max_position)
+                min_item = None
+                response = self.execute_search(url, stop_event)
+                while response is not None and response['items_html'] is not None and not stop_event.is_set():
+                    max_item = response["min_position"]
+                    if executor is not None and METRICS.enabled:
+                        items = executor.submit(parse_with_metrics, parse_tweets_fn, response['items_html'])
+                    elif executor is not None:
+                        items = executor.submit(parse_tweets_fn, response['items_html'])
+                    else:
+                        items = parse_tweets_fn(response['items_html'])
+                    if not put((items, max_item)):
+                        break
+
+                    if min_item == max_item:
+                        break
+                    url = urls.page(max_item)
+                    # Sleep for our rate_delay
+                    if wait_or_stop(self.rate_delay, stop_event):
+                        break
+                    response = self.execute_search(url, stop_event)
+                    min_item = max_item
+
+                if response is None and not stop_event.is_set():
+                    self.gave_up = True
+            except Exception as e:
+                errors.append(e)
+            finally:
+                put(None)
+
+        executor = None
+        if parse_workers:
+            from concurrent.futures import ProcessPoolExecutor
+            executor = ProcessPoolExecutor(max_workers=parse_workers)
+        fetcher = threading.Thread(target=fetch, args=(executor,))
+        fetcher.daemon = True
+        fetcher.start()
+        try:
+            while True:
+                try:
+                    page = pages.get(timeout=STOP_POLL_INTERVAL)
+                except queue.Empty:
+                    if self.stopped():
+                        break
+                    continue
+                if page is None:
+                    break
+
+                items = page[0].result() if executor is not None else page[0]
+                if isinstance(items, tuple):
+                    items, recorded = items
+                    METRICS.merge(recorded)
+                METRICS.count('pages_total')
+                METRICS.observe('page_items', len(items))
+
+                # If we have no items, then we can stop early
+                if len(items) == 0:
+                    break
+
+                if not user_stats:
+                    yield items, page[1]
+                    continue
+
+                # Pages wait for the profiles of their users, looked up in batches spanning several pages
+                self.enriching.append((items, page[1], self.enricher.lookup(self.user_ids(items))))
+                for enriched in self.enriched():
+                    yield enriched
+
+            for enriched in self.enriched(drain=True):
+                yield enriched
+        finally:
+            stop_event.set()
+            self.enriching.clear()
+            fetcher.join()
+            while not pages.empty():
+                page = pages.get()
+                if page is not None and executor is not None:
+                    page[0].cancel()
+            if executor is not None:
+                executor.shutdown()
+
+        if errors:
+            raise errors[0]
+
+    def checkpoint(self, query, max_position, items):
+        """
+        Called once a page of items has been saved, with the cursor of the next page.
+        Implementations can record it to resume the search later on.
+        """
+
+    def stopped(self):
+        """
+        :return: True once the stop_event of the search is set, after which no page is saved nor checkpointed
+        """
+        return self.stop_event is not None and self.stop_event.is_set()
+
+    @property
+    def enricher(self):
+        if self._enricher is None:
+            self._enricher = UserEnricher()
+        return self._enricher
+
+    def save_page(self, query, items, max_position, user_stats=False):
+        """
+        Saves a page of items and checkpoints the cursor of the next one. With user_stats, the page first waits for
+        the profiles of its users, which are looked up in batches spanning several pages.
+        :return: False if the search should stop
+        """
+        if self.stopped():
+            return False
+        if not user_stats:
+            continue_search = self.save_items(items)
+            self.checkpoint(query, max_position, items)
+            return continue_search
+
+        self.enriching.append((items, max_position, self.enricher.lookup(self.user_ids(items))))
+        return self.save_enriched(query)
+
+    def save_enriched(self, query, drain=False):
+        """
+        Saves, in order, the pages whose users have been looked up
+        :return: False if the search should stop
+        """
+        for items, max_position in self.enriched(drain):
+            if self.stopped():
+                self.enriching.clear()
+                return False
+            continue_search = self.save_items(items)
+            self.checkpoint(query, max_position, items)
+            if not continue_search:
+                self.enriching.clear()
+                return False
+        return True
+
+    def enriched(self, drain=False):
+        """
+        Yields, in order, the pages waiting in enriching whose users have been looked up. Waits for the oldest pages
+        while there are too many of them, or for all of them if drain is set.
+        """
+        while self.enriching:
+            items, max_position, lookup = self.enriching[0]
+            if not lookup.done():
+                if not drain and len(self.enriching) < ENRICH_MAX_PENDING_PAGES:
+                    break
+                self.enricher.flush()
+
+            self.enriching.popleft()
+            self.merge_profiles(items, lookup.result())
+            yield items, max_position
+
+    @staticmethod
+    def user_ids(items):
+        """
+        :return: The ids of the users of a page of users or tweets
+        """
+        return [item['user']['id'] if 'user' in item else item['id'] for item in items]
+
+    @staticmethod
+    def merge_profiles(items, profiles):
+        """
+        Adds the looked up profiles to a page of users or to the users of a page of tweets, in place
+        """
+        for i, item in enumerate(items):
+            if 'user' in item:
+                profile = profiles.get(item['user']['id'])
+                if profile is not None:
+                    item['user'] = {**item['user'], **profile}
+            else:
+                profile = profiles.get(item['id'])
+                if profile is not None:
+                    items[i] = {**item, **profile}
+
+    def execute_search(self, url, stop_event=None):
+        """
+        Executes a search to Twitter for the given URL
+        :param url: URL to search twitter with
+        :param stop_event: A threading.Event that stops the retries when set
+        :return: A JSON object with data from Twitter, None if the request was given up on or stopped
+        """
+        response = self.cached_page(url)
+        if response is not None or self.offline:
+            return response
+
+        started = perf_counter()
+        retry_num = 0
+        throttled_num = 0
+        while True:
+            METRICS.observe('rate_wait_seconds', self.governor.acquire(stop_event))
+            if stop_event is not None and stop_event.is_set():
+                return None
+            logger.info("URL: " + url)
+            request_started = perf_counter()
+            try:
+                response = self.session.get(url)
+            except request_errors() as e:
+                logger.error("Request failed: %s", e)
+                response = None
+            METRICS.observe('http_request_seconds', perf_counter() - request_started)
+            METRICS.count('requests_total')
+
+            if response is not None:
+                # 400 Bad Request still carries a JSON body
+                if response.status_code <= 400:
+                    if response.status_code == 400:
+                        logger.debug("HTTP 400 - Bad request")
+                    self.governor.success(response.headers)
+                    data = response.json()
+                    if response.status_code == 200 and self.page_cache is not None:
+                        self.page_cache.put(url, data)
+                    if METRICS.enabled:
+                        METRICS.count('bytes_received_total', len(response.content))
+                    METRICS.observe('http_seconds', perf_counter() - started)
+                    return data
+
+                # Throttling pauses every search sharing the governor, the retry waits for it
+                if response.status_code == 429:
+                    METRICS.count('throttled_total')
+                    self.governor.throttled(response.headers)
+                    throttled_num += 1
+                    if throttled_num <= MAX_THROTTLED_RETRIES:
+                        continue
+                    logger.error("Still throttled after %i retries, giving up", MAX_THROTTLED_RETRIES)
+                    METRICS.count('failed_requests_total')
+                    return None
+
+            if retry_num == MAX_RETRIES:
+                METRICS.count('failed_requests_total')
+                return None
+
+            if response is not None:
+                total_sleep = self.retry_delay(response.status_code, response.headers, retry_num)
+            else:
+                total_sleep = self.retry_delay(None, {}, retry_num)
+            logger.info("Sleeping for %i", total_sleep)
+            METRICS.count('retries_total')
+            METRICS.observe('retry_wait_seconds', total_sleep)
+            if wait_or_stop(total_sleep, stop_event):
+                return None
+
+            retry_num += 1
+            if retry_num % MAX_RETRIES_SESSION == 0:
+                headers = {'User-Agent': self.UA.random}
+                self.session.headers.update(headers)
+
+    def cached_page(self, url):
+        """
+        :return: The response to the URL kept in the page cache, or None
+        """
+        if self.page_cache is None:
+            return None
+        # Offline searches replay whatever was cached, however old
+        response = self.page_cache.get(url, None if self.offline else self.page_cache.ttl)
+        if response is None and self.offline:
+            logger.info("Not in the page cache, stopping: %s", url)
+        elif response is not None:
+            METRICS.count('cached_pages_total')
+        return response
+
+    def retry_delay(self, status_code, headers, retry_num):
+        """
+        How long to wait before retrying a failed request
+        :param status_code: HTTP status of the failed request, or None if it did not get a response
+        :param headers: Headers of the failed response
+        :param retry_num: Number of retries so far
+        :return: Seconds to sleep
+        """
+        if status_code is not None:
+            logger.error("HTTP %i", status_code)
+            retry_after = headers.get('retry-after')
+            if retry_after is not None:
+                seconds = parse_retry_after(retry_after)
+                if seconds is not None:
+                    return seconds
+        return self.governor.backoff(retry_num, self.error_delay)
+
+    @staticmethod
+    def parse_tweets(items_html, compact=False):
+        """
+        Parses Tweets from the given HTML
+        :param items_html: The HTML block with tweets
+        :param compact: Return Tweet records rather than dicts
+        :return: A JSON list of tweets
+        """
+        from bs4 import BeautifulSoup
+
+        started = perf_counter()
+        soup = BeautifulSoup(items_html, 'lxml')
+        parsed = perf_counter()
+        METRICS.observe('document_seconds', parsed - started)
+
+        comma = ','
+        dot = '.'
+        tweets = []
+        for tweet in soup.find_all(class_='stream-item'):
+            if 'data-item-id' not in tweet.attrs:
+                continue
+
+            id_str = tweet.attrs['data-item-id']
+            id = int(id_str)
+
+            tweet_text = tweet.find(class_="tweet-text")
+            if tweet_text is None:
+                continue
+
+            timestamp = int(tweet.find(class_="_timestamp").attrs['data-time'])
+
+            tweet_div = tweet.find(class_="tweet")
+            user_id_str = tweet_div.attrs['data-user-id']
+            screen_name = tweet_div.attrs['data-screen-name']
+            name = tweet_div.attrs['data-name']
+
+            interactions = [x.get_text() for x in tweet.find_all(class_='ProfileTweet-actionCount')]
+            replies = int(interactions[0].split(" ")[0].replace(comma, "").replace(dot, ""))
+            retweets = int(interactions[1].split(" ")[
+                               0].replace(comma, "").replace(dot, ""))
+            likes = int(interactions[2].split(" ")[0].replace(comma, "").replace(dot, ""))
+            hashtags = [hashtag_node.get_text() for hashtag_node in tweet.find_all(class_='twitter-hashtag')]
+            urls = [url_node.attrs['data-expanded-url']
+                    for url_node in tweet.find_all('a', class_='twitter-timeline-link')
+                    if 'data-expanded-url' in url_node.attrs]
+            photos = [photo_node.attrs['data-image-url']
+                      for photo_node in tweet.find_all(class_='AdaptiveMedia-photoContainer')
+                      if 'data-image-url' in photo_node.attrs]
+
+            videos = []
+            native_video_node = tweet.find(class_='PlayableMedia-player')
+            if native_video_node is not None:
+                videos.append({
+                    'expanded_url': 'https://twitter.com/i/videos/tweet/%s' % id_str
+                })
+
+            cards = []
+            card_nodes = tweet.find_all(class_='card2')
+            for node in card_nodes:
+                card_type = node.get('data-card2-name', None)
+                if card_type is not None:  # Only care about media. Ignore Tweet Quotes, etc.
+                    if 'summary' in card_type:  # Expanded URL w/ image
+                        iframe_container = node.find(class_='js-macaw-cards-iframe-container')
+                        if iframe_container is not None:
+                            timeline_link = tweet_text.find('a', class_='twitter-timeline-link')
+                            if timeline_link is not None and 'data-expanded-url' in timeline_link.attrs:
+                                cards.append({
+                                    'card_url': 'https://twitter.com' + iframe_container.attrs['data-src'],
+                                    'expanded_url': timeline_link.attrs['data-expanded-url']
+                                })
+                            else:
+                                logger.error("BAD CARD: %s", id_str)
+                    elif 'player' in card_type:  # Embedded video
+                        timeline_link = tweet_text.find('a', class_='twitter-timeline-link')
+                        if timeline_link is not None and 'data-expanded-url' in timeline_link.attrs:
+                            videos.append({
+                                'expanded_url': timeline_link.attrs['data-expanded-url']
+                            })
+                        else:
+                            logger.error("BAD CARD: %s", id_str)
+
+            # remove u-hidden links, etc
+            for hidden_child in tweet_text.find_all(class_='u-hidden'):
+                hidden_child.decompose()
+            text = tweet_text.get_text()
+
+            if compact:
+                tweets.append(Tweet(text, id, id_str, timestamp, replies, retweets, likes, hashtags, cards, urls,
+                                    photos, videos, User.intern(user_id_str, screen_name, name)))
+                continue
+
+            user = {
+                'id_str': user_id_str,
+                'id': int(user_id_str),
+                'screen_name': screen_name,
+                'name': name,
+            }
+            tweets.append({
+                'created_at': datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT),
+                'text': text,
+                'id': id,
+                'id_str': id_str,
+                'epoch': timestamp,
+                'reply_count': replies,
+                'retweet_count': retweets,
+                'favorite_count': likes,
+                'hashtags': hashtags,
+                'cards': cards,
+                'urls': urls,
+                'photos': photos,
+                'videos': videos,
+                'user': user,
+            })
+        METRICS.observe('extract_seconds', perf_counter() - parsed)
+        METRICS.count('items_parsed_total', len(tweets))
+        return tweets
+
+    @staticmethod
+    def parse_users(items_html):
+        """
+        Parses Users from the given HTML
+        :param items_html: The HTML block with items
+        :return: A JSON list of items
+        """
+        from bs4 import BeautifulSoup
+
+        started = perf_counter()
+        soup = BeautifulSoup(items_html, 'lxml')
+        parsed = perf_counter()
+        METRICS.observe('document_seconds', parsed - started)
+        items = []
+        for div in soup.find_all("div", class_='js-stream-item'):
+
+            # If our li doesn't have a tweet-id, we skip it as it's not going to be a tweet.
+            if 'data-item-id' not in div.attrs:
+                continue
+
+            user = {
+                'bio': None,
+                'id_str': div['data-item-id'],
+                'id': int(div['data-item-id']),
+                'screen_name': None,
+                'name': None,
+            }
+
+            # User Bio
+            text_p = div.find("p", class_="ProfileCard-bio")
+            if text_p is not None:
+                user['bio'] = text_p.get_text()
+
+            # Tweet User ID, User Screen Name, User Name
+            user_details_div = div.find("div", class_="user-actions")
+            if user_details_div is not None:
+                user['screen_name'] = user_details_div['data-screen-name']
+                user['name'] = user_details_div['data-name']
+
+            user_fields_div = div.find("div", class_="ProfileCard-userFields")
+            user_verified_span = user_fields_div.find("span", class_="Icon--verified")
+            user['verified'] = True if user_verified_span else False
+
+            items.append(user)
+        METRICS.observe('extract_seconds', perf_counter() - parsed)
+        METRICS.count('items_parsed_total', len(items))
+        return items
+
+    @staticmethod
+    def construct_url(query, target_type, max_position=None, language=None, base_url=DEFAULT_BASE_URL):
+        """
+        For a given query, will construct a URL to search Twitter with
+        :param query: The query term used to search twitter
+        :param target_type:    Can be "tweets" or "users"
+        :param max_position: The max_position value to select the next pagination of items
+        :param language: Specifies a language to filter search results
+        :param base_url: Scheme and host of the search endpoint
+        :return: A string URL
+        """
+        started = perf_counter()
+        params = {
+            'f': target_type,
+            'vertical': 'default',
+            'include_available_features': 1,
+            'include_entities': 1,
+            'include_new_items_bar': 'true',
+            'reset_error_state': 'false',
+            'src': 'typd',
+            'max_position': max_position,
+            'q': query,
+        }
+
+        if language:
+            params['l'] = language
+
+        base = urlparse(base_url)
+        url_tupple = (base.scheme, base.netloc, base.path.rstrip('/') + '/i/search/timeline', '', urlencode(params), '')
+        url = urlunparse(url_tupple)
+        METRICS.observe('url_seconds', perf_counter() - started)
+        return url
+
+    @staticmethod
+    def construct_user_url(query, target_type, max_position=None):
+        """
+        Same as construct_url, kept for existing callers
+        """
+        return TwitterSearch.construct_url(query, target_type, max_position=max_position)
+
+    @abstractmethod
+    def save_items(self, items):
+        """
+        An abstract method that's called with a list of items.
+        When implementing this class, you can do whatever you want with these items.
+        """
+
+    def retrieve_user_details(self, items):
+        """
+        For a given set of crawled users, retrieves additional information using the Twitter REST API
+        :param items: A list of user dictionarities, or of tweets whose user dictionaries get the information
+        :return: An updated list with additional fields of User dictionaries
+        """
+        lookup = self.enricher.lookup(self.user_ids(items))
+        self.enricher.flush()
+        self.merge_profiles(items, lookup.result())
+        return items
+
+
+def _has_class(name):
+    """
+    XPath predicate matching elements with the given class, the way BeautifulSoup's class_ does
+    """
+    return "contains(concat(' ', normalize-space(@class), ' '), ' %s ')" % name
+
+
+class LxmlParser(object):
+    """
+    Parses pages straight on lxml, with precompiled selectors and a single walk over each stream item.
+    Gives the same items as the BeautifulSoup parsers of TwitterSearch, at a fraction of the cost.
+    """
+    SELECTORS = {
+        'STREAM_ITEMS': "//*[%s]" % _has_class('stream-item'),
+        'USER_STREAM_ITEMS': "//div[%s]" % _has_class('js-stream-item'),
+        'TIMELINE_LINK': ".//a[%s]" % _has_class('twitter-timeline-link'),
+        'IFRAME_CONTAINER': ".//*[%s]" % _has_class('js-macaw-cards-iframe-container'),
+        'HIDDEN': ".//*[%s]" % _has_class('u-hidden'),
+        'VERIFIED': ".//span[%s]" % _has_class('Icon--verified'),
+    }
+    # Compiled from SELECTORS by load, once lxml is needed
+    STREAM_ITEMS = USER_STREAM_ITEMS = TIMELINE_LINK = IFRAME_CONTAINER = HIDDEN = VERIFIED = None
+    loaded = False
+
+    # Classes collected while walking a tweet, the first match of each and every match of the lists
+    TWEET_FIRST = frozenset(['tweet-text', '_timestamp', 'tweet', 'PlayableMedia-player'])
+    TWEET_ALL = frozenset(['ProfileTweet-actionCount', 'twitter-hashtag', 'AdaptiveMedia-photoContainer', 'card2'])
+
+    @staticmethod
+    def load():
+        """
+        Imports lxml and compiles the selectors, the first time a page is parsed
+        """
+        if not LxmlParser.loaded:
+            from lxml import etree
+
+            for name, selector in LxmlParser.SELECTORS.items():
+                setattr(LxmlParser, name, etree.XPath(selector))
+            LxmlParser.loaded = True
+
+    @staticmethod
+    def document(items_html):
+        import lxml.html
+
+        LxmlParser.load()
+        if not items_html or not items_html.strip():
+            return None
+        return lxml.html.document_fromstring(items_html)
+
+    @staticmethod
+    def parse_tweets(items_html, compact=False):
+        """
+        Parses Tweets from the given HTML
+        :param items_html: The HTML block with tweets
+        :param compact: Return Tweet records rather than dicts
+        :return: A JSON list of tweets
+        """
+        from lxml import etree
+
+        started = perf_counter()
+        document = LxmlParser.document(items_html)
+        parsed = perf_counter()
+        METRICS.observe('document_seconds', parsed - started)
+        if document is None:
+            return []
+
+        comma = ','
+        dot = '.'
+        tweets = []
+        for tweet in LxmlParser.STREAM_ITEMS(document):
+            id_str = tweet.get('data-item-id')
+            if id_str is None:
+                continue
+            id = int(id_str)
+
+            first = {}
+            found = {name: [] for name in LxmlParser.TWEET_ALL}
+            urls = []
+            for node in tweet.iterdescendants(tag=etree.Element):
+                classes = node.get('class')
+                if classes is None:
+                    continue
+                for name in classes.split():
+                    if name in LxmlParser.TWEET_FIRST:
+                        first.setdefault(name, node)
+                    elif name in LxmlParser.TWEET_ALL:
+                        found[name].append(node)
+                    elif name == 'twitter-timeline-link' and node.tag == 'a' and 'data-expanded-url' in node.attrib:
+                        urls.append(node.get('data-expanded-url'))
+
+            tweet_text = first.get('tweet-text')
+            if tweet_text is None:
+                continue
+
+            timestamp = int(first['_timestamp'].attrib['data-time'])
+
+            tweet_div = first['tweet']
+            user_id_str = tweet_div.attrib['data-user-id']
+            screen_name = tweet_div.attrib['data-screen-name']
+            name = tweet_div.attrib['data-name']
+
+            interactions = [x.text_content() for x in found['ProfileTweet-actionCount']]
+            replies = int(interactions[0].split(" ")[0].replace(comma, "").replace(dot, ""))
+            retweets = int(interactions[1].split(" ")[0].replace(comma, "").replace(dot, ""))
+            likes = int(interactions[2].split(" ")[0].replace(comma, "").replace(dot, ""))
+            hashtags = [hashtag_node.text_content() for hashtag_node in found['twitter-hashtag']]
+            photos = [photo_node.get('data-image-url')
+                      for photo_node in found['AdaptiveMedia-photoContainer']
+                      if 'data-image-url' in photo_node.attrib]
+
+            videos = []
+            if 'PlayableMedia-player' in first:
+                videos.append({
+                    'expanded_url': 'https://twitter.com/i/videos/tweet/%s' % id_str
+                })
+
+            cards = []
+            for node in found['card2']:
+                card_type = node.get('data-card2-name')
+                if card_type is not None:  # Only care about media. Ignore Tweet Quotes, etc.
+                    if 'summary' in card_type:  # Expanded URL w/ image
+                        iframe_containers = LxmlParser.IFRAME_CONTAINER(node)
+                        if iframe_containers:
+                            timeline_links = LxmlParser.TIMELINE_LINK(tweet_text)
+                            if timeline_links and 'data-expanded-url' in timeline_links[0].attrib:
+                                cards.append({
+                                    'card_url': 'https://twitter.com' + iframe_containers[0].attrib['data-src'],
+                                    'expanded_url': timeline_links[0].get('data-expanded-url')
+                                })
+                            else:
+                                logger.error("BAD CARD: %s", id_str)
+                    elif 'player' in card_type:  # Embedded video
+                        timeline_links = LxmlParser.TIMELINE_LINK(tweet_text)
+                        if timeline_links and 'data-expanded-url' in timeline_links[0].attrib:
+                            videos.append({
+                                'expanded_url': timeline_links[0].get('data-expanded-url')
+                            })
+                        else:
+                            logger.error("BAD CARD: %s", id_str)
+
+            # remove u-hidden links, etc
+            for hidden_child in LxmlParser.HIDDEN(tweet_text):
+                hidden_child.drop_tree()
+            text = tweet_text.text_content()
+
+            if compact:
+                tweets.append(Tweet(text, id, id_str, timestamp, replies, retweets, likes, hashtags, cards, urls,
+                                    photos, videos, User.intern(user_id_str, screen_name, name)))
+                continue
+
+            user = {
+                'id_str': user_id_str,
+                'id': int(user_id_str),
+                'screen_name': screen_name,
+                'name': name,
+            }
+            tweets.append({
+                'created_at': datetime.utcfromtimestamp(timestamp).strftime(DATE_FORMAT),
+                'text': text,
+                'id': id,
+                'id_str': id_str,
+                'epoch': timestamp,
+                'reply_count': replies,
+                'retweet_count': retweets,
+                'favorite_count': likes,
+                'hashtags': hashtags,
+                'cards': cards,
+                'urls': urls,
+                'photos': photos,
+                'videos': videos,
+                'user': user,
+            })
+        METRICS.observe('extract_seconds', perf_counter() - parsed)
+        METRICS.count('items_parsed_total', len(tweets))
+        return tweets
+
+    @staticmethod
+    def parse_users(items_html):
+        """
+        Parses Users from the given HTML
+        :param items_html: The HTML block with items
+        :return: A JSON list of items
+        """
+        started = perf_counter()
+        document = LxmlParser.document(items_html)
+        parsed = perf_counter()
+        METRICS.observe('document_seconds', parsed - started)
+        if document is None:
+            return []
+
+        items = []
+        for div in LxmlParser.USER_STREAM_ITEMS(document):
+
+            # If our li doesn't have a tweet-id, we skip it as it's not going to be a tweet.
+            if 'data-item-id' not in div.attrib:
+                continue
+
+            user = {
+                'bio': None,
+                'id_str': div.attrib['data-item-id'],
+                'id': int(div.attrib['data-item-id']),
+                'screen_name': None,
+                'name': None,
+            }
+
+            text_p = user_details_div = user_fields_div = None
+            for node in div.iterdescendants('p', 'div'):
+                classes = node.get('class')
+                if classes is None:
+                    continue
+                classes = classes.split()
+                if text_p is None and node.tag == 'p' and 'ProfileCard-bio' in classes:
+                    text_p = node
+                elif node.tag == 'div':
+                    if user_details_div is None and 'user-actions' in classes:
+                        user_details_div = node
+                    if user_fields_div is None and 'ProfileCard-userFields' in classes:
+                        user_fields_div = node
+
+            # User Bio
+            if text_p is not None:
+                user['bio'] = text_p.text_content()
+
+            # Tweet User ID, User Screen Name, User Name
+            if user_details_div is not None:
+                user['screen_name'] = user_details_div.attrib['data-screen-name']
+                user['name'] = user_details_div.attrib['data-name']
+
+            user['verified'] = True if LxmlParser.VERIFIED(user_fields_div) else False
+
+            items.append(user)
+        METRICS.observe('extract_seconds', perf_counter() - parsed)
+        METRICS.count('items_parsed_total', len(items))
+        return items
+
+
+PARSERS = {
+    'bs4': (TwitterSearch.parse_tweets, TwitterSearch.parse_users),
+    'lxml': (LxmlParser.parse_tweets, LxmlParser.parse_users),
+}
+
+
+class JsonlSink(object):
+    """
+    Writes items as JSON lines, a batch of lines at a time
+    """
+    extension = '.jsonl'
+    # Whether sync can make what was written so far durable, other sinks only are once closed
+    resumable = True
+
+    def __init__(self, filepath, batch_size=DEFAULT_SINK_BATCH_SIZE, **kwargs):
+        """
+        :param filepath: Path of the output file, or STDOUT
+        :param batch_size: Number of lines buffered before they are written out
+        """
+        self.filepath = filepath
+        self.batch_size = batch_size
+        self.raw = None
+        self.stream = None
+        self.buffer = []
+
+    def open(self, offset=None):
+        """
+        :param offset: Size to cut the existing output back to before appending, or None to overwrite it
+        """
+        if self.filepath == STDOUT:
+            # Lines go straight to the file descriptor, past the text layer of sys.stdout
+            sys.stdout.flush()
+            self.raw = io.open(sys.stdout.fileno(), 'wb', closefd=False)
+        elif offset is None:
+            self.raw = io.open(self.filepath, 'wb')
+        else:
+            # Drop whatever was written after the offset, it will be written again
+            self.raw = io.open(self.filepath, 'ab')
+            self.raw.truncate(offset)
+            self.raw.seek(0, io.SEEK_END)
+        self.stream = self.wrap(self.raw)
+
+    def wrap(self, raw):
+        return raw
+
+    @staticmethod
+    def reader(raw):
+        """
+        :return: A binary stream of the lines written to the raw output
+        """
+        return raw
+
+    @staticmethod
+    def encode(item):
+        if isinstance(item, Tweet):
+            return item.to_json()
+        if PY2:
+            return json.dumps(item, ensure_ascii=False, encoding='utf-8')
+        return json.dumps(item, ensure_ascii=False)
+
+    def write(self, item):
+        if METRICS.enabled:
+            started = perf_counter()
+            self.buffer.append(self.encode(item))
+            METRICS.observe('serialize_seconds', perf_counter() - started)
+        else:
+            self.buffer.append(self.encode(item))
+        if len(self.buffer) >= self.batch_size:
+            self.flush()
+
+    def flush(self):
+        if self.buffer:
+            started = perf_counter()
+            self.buffer.append('')
+            data = '\n'.join(self.buffer).encode('utf-8')
+            self.stream.write(data)
+            self.buffer = []
+            METRICS.observe('write_seconds', perf_counter() - started)
+            METRICS.count('bytes_written_total', len(data))
+
+    def sync(self):
+        """
+        Makes everything written so far durable
+        :return: Size of the output, a valid offset to resume from
+        """
+        self.flush()
+        self.end_frame()
+        self.raw.flush()
+        if self.filepath == STDOUT:
+            # Pipes can not be synced nor resumed, whatever was flushed is the reader's
+            offset = None
+        else:
+            os.fsync(self.raw.fileno())
+            offset = self.raw.tell()
+        if self.stream is None:
+            self.stream = self.wrap(self.raw)
+        return offset
+
+    def end_frame(self):
+        """
+        Ends the current compressed frame, so that the output can be cut back to this point.
+        Sinks that close their stream to do so set it to None, and a new one is started after the sync.
+        """
+
+    def close(self):
+        if self.raw is None:
+            return
+        self.flush()
+        if self.stream is not self.raw:
+            self.stream.close()
+        self.raw.close()
+        self.raw = self.stream = None
+
+
+class GzipJsonlSink(JsonlSink):
+    """
+    Writes gzip compressed JSON lines. Every checkpoint closes a gzip member, concatenated members stay valid gzip.
+    """
+    extension = '.jsonl.gz'
+
+    def __init__(self, filepath, batch_size=DEFAULT_SINK_BATCH_SIZE, compression_level=6, **kwargs):
+        super(GzipJsonlSink, self).__init__(filepath, batch_size)
+        self.compression_level = compression_level
+
+    def wrap(self, raw):
+        return gzip.GzipFile(fileobj=raw, mode='wb', compresslevel=self.compression_level)
+
+    @staticmethod
+    def reader(raw):
+        return gzip.GzipFile(fileobj=raw, mode='rb')
+
+    def end_frame(self):
+        self.stream.close()
+        self.stream = None
+
+
+class ZstdJsonlSink(JsonlSink):
+    """
+    Writes zstd compressed JSON lines, requires the zstandard package.
+    Every checkpoint ends a zstd frame, concatenated frames stay valid zstd.
+    """
+    extension = '.jsonl.zst'
+
+    def __init__(self, filepath, batch_size=DEFAULT_SINK_BATCH_SIZE, compression_level=3, **kwargs):
+        super(ZstdJsonlSink, self).__init__(filepath, batch_size)
+        self.compression_level = compression_level
+
+    def wrap(self, raw):
+        import zstandard
+        return zstandard.ZstdCompressor(level=self.compression_level).stream_writer(raw, closefd=False)
+
+    @staticmethod
+    def reader(raw):
+        import zstandard
+        return io.BufferedReader(zstandard.ZstdDecompressor().stream_reader(raw, read_across_frames=True,
+                                                                            closefd=False))
+
+    def end_frame(self):
+        import zstandard
+        self.stream.flush(zstandard.FLUSH_FRAME)
+
+
+def flatten_item(item, prefix=''):
+    """
+    Flattens nested dicts into dotted keys, e.g. user.screen_name
+    """
+    flat = {}
+    for key, value in item.items():
+        if isinstance(value, Mapping):
+            flat.update(flatten_item(value, prefix + key + '.'))
+        else:
+            flat[prefix + key] = value
+    return flat
+
+
+class ParquetSink(object):
+    """
+    Writes items to a Parquet file with one column per field, requires the pyarrow package.
+    Tweets use a fixed schema with user.* columns and list columns for hashtags, urls, photos, videos and cards,
+    other items get the schema of their first row group.
+    """
+    extension = '.parquet'
+    resumable = False
+
+    def __init__(self, filepath, row_group_size=DEFAULT_ROW_GROUP_SIZE, **kwargs):
+        """
+        :param filepath: Path of the output file
+        :param row_group_size: Number of rows per Parquet row group
+        """
+        self.filepath = filepath
+        self.row_group_size = row_group_size
+        self.writer = None
+        self.schema = None
+        self.rows = []
+
+    @staticmethod
+    def tweet_schema():
+        import pyarrow as pa
+        return pa.schema([
+            ('created_at', pa.string()),
+            ('text', pa.string()),
+            ('id', pa.int64()),
+            ('id_str', pa.string()),
+            ('epoch', pa.int64()),
+            ('reply_count', pa.int64()),
+            ('retweet_count', pa.int64()),
+            ('favorite_count', pa.int64()),
+            ('hashtags', pa.list_(pa.string())),
+            ('cards', pa.list_(pa.struct([('card_url', pa.string()), ('expanded_url', pa.string())]))),
+            ('urls', pa.list_(pa.string())),
+            ('photos', pa.list_(pa.string())),
+            ('videos', pa.list_(pa.string())),
+            ('user.id_str', pa.string()),
+            ('user.id', pa.int64()),
+            ('user.screen_name', pa.string()),
+            ('user.name', pa.string()),
+        ])
+
+    def open(self, offset=None):
+        if offset is not None:
+            raise ValueError("Parquet output can not be appended to")
+
+    def write(self, item):
+        row = flatten_item(item)
+        if 'videos' in row:
+            row['videos'] = [video['expanded_url'] for video in row['videos']]
+        self.rows.append(row)
+        if len(self.rows) >= self.row_group_size:
+            self.flush()
+
+    def flush(self):
+        if not self.rows:
+            return
+
+        import pyarrow as pa
+        import pyarrow.parquet as pq
+        if self.schema is None:
+            tweet_schema = self.tweet_schema()
+            if set(self.rows[0]).issubset(tweet_schema.names):
+                self.schema = tweet_schema
+            else:
+                self.schema = pa.Table.from_pylist(self.rows).schema
+            self.writer = pq.ParquetWriter(self.filepath, self.schema)
+
+        started = perf_counter()
+        self.writer.write_table(pa.Table.from_pylist(self.rows, schema=self.schema))
+        METRICS.observe('write_seconds', perf_counter() - started)
+        self.rows = []
+
+    def sync(self):
+        raise ValueError("Parquet output can not be resumed")
+
+    def close(self):
+        self.flush()
+        if self.writer is not None:
+            self.writer.close()
+            self.writer = None
+
+
+class SplitSink(object):
+    """
+    Writes the items of a search of several accounts to the output of their author
+    """
+    resumable = False
+
+    def __init__(self, filepaths, sink_class, **kwargs):
+        """
+        :param filepaths: Output path of each account, by lower case screen name
+        :param sink_class: One of SINKS, opened for each output
+        """
+        self.sinks = dict((name, sink_class(filepath, **kwargs)) for name, filepath in filepaths.items())
+        self.unmatched = 0
+
+    def open(self, offset=None):
+        if offset is not None:
+            raise ValueError("Split outputs can not be appended to")
+        self.unmatched = 0
+        for sink in self.sinks.values():
+            sink.open()
+
+    def write(self, item):
+        sink = self.sinks.get(item['user']['screen_name'].lower())
+        if sink is None:
+            # Searches match mentions of the accounts too, those tweets are not theirs
+            self.unmatched += 1
+            return
+        sink.write(item)
+
+    def sync(self):
+        raise ValueError("Split outputs can not be resumed")
+
+    def close(self):
+        for sink in self.sinks.values():
+            sink.close()
+        if self.unmatched:
+            logger.warning("%i items by other accounts skipped.", self.unmatched)
+
+
+SINKS = {
+    'jsonl': JsonlSink,
+    'gzip': GzipJsonlSink,
+    'zstd': ZstdJsonlSink,
+    'parquet': ParquetSink,
+}
+
+
+class CrawlCheckpoint(object):
+    def __init__(self, filepath):
+        """
+        Records how far each query of a crawl got, so that a restarted crawl carries on from the last saved page
+        :param filepath: Path of the SQLite database
+        """
+        self.filepath = filepath
+        # Opened by run_jobs, then used by the thread searching its output with --account_workers
+        self.db = sqlite3.connect(filepath, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS checkpoints ("
+                            "query TEXT PRIMARY KEY, max_position TEXT, counter INTEGER, last_id TEXT, "
+                            "offset INTEGER, done INTEGER NOT NULL DEFAULT 0, updated REAL)")
+
+    @classmethod
+    def for_output(cls, filepath):
+        """
+        The checkpoint store kept next to an output file
+        """
+        return cls(filepath + CHECKPOINT_SUFFIX)
+
+    def load(self, query):
+        """
+        :return: The last checkpoint of the query as a dict, or None if it was never saved
+        """
+        row = self.db.execute("SELECT max_position, counter, last_id, offset, done FROM checkpoints WHERE query = ?",
+                              (query,)).fetchone()
+        if row is None:
+            return None
+        return {'max_position': row[0], 'counter': row[1], 'last_id': row[2], 'offset': row[3], 'done': bool(row[4])}
+
+    def save(self, query, max_position, counter, last_id, offset):
+        """
+        Atomically replaces the checkpoint of the query
+        :param max_position: Cursor of the next page to fetch
+        :param counter: Number of items saved so far
+        :param last_id: Id of the last item saved
+        :param offset: Size of the output once the items were saved
+        """
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO checkpoints VALUES (?, ?, ?, ?, ?, 0, ?)",
+                            (query, max_position, counter, last_id, offset, time()))
+
+    def empty(self):
+        return self.db.execute("SELECT 1 FROM checkpoints LIMIT 1").fetchone() is None
+
+    def finish(self, query):
+        with self.db:
+            self.db.execute("UPDATE checkpoints SET done = 1, updated = ? WHERE query = ?", (time(), query))
+
+    def close(self):
+        self.db.close()
+
+
+class PageCache(object):
+    def __init__(self, dirpath, max_size=DEFAULT_PAGE_CACHE_SIZE, ttl=DEFAULT_PAGE_CACHE_TTL,
+                 segment_size=PAGE_CACHE_SEGMENT_SIZE):
+        """
+        Keeps the raw responses of execute_search, keyed by a hash of their URL, so that cached crawls can be parsed
+        again without going to Twitter. Responses are compressed and appended to segment files, read back through
+        memory maps and indexed in SQLite. Once the segments grow past max_size the oldest ones are dropped. Several
+        processes can share the cache, each one appending to segments it created.
+        :param dirpath: Directory of the cache, created if missing
+        :param max_size: Bytes of segments kept
+        :param ttl: Seconds a page is served for, by get
+        :param segment_size: Bytes of a segment before the next one is started
+        """
+        self.dirpath = dirpath
+        self.max_size = max_size
+        self.ttl = ttl
+        self.segment_size = segment_size
+        if not path.isdir(dirpath):
+            os.makedirs(dirpath)
+
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(path.join(dirpath, 'index.db'), check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS pages ("
+                            "key BLOB PRIMARY KEY, segment INTEGER, offset INTEGER, length INTEGER, stored REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS pages_segment ON pages (segment)")
+
+        self.sizes = {}
+        self.maps = {}
+        self.segment = None
+        self.active = None
+
+    def scan(self):
+        """
+        Reads the sizes of the segments, including the ones other processes sharing the cache write to
+        """
+        self.sizes = {}
+        for filename in os.listdir(self.dirpath):
+            match = re.match(r"segment-([0-9]+)\.seg$", filename)
+            if match:
+                try:
+                    self.sizes[int(match.group(1))] = path.getsize(path.join(self.dirpath, filename))
+                except OSError:
+                    # Dropped by another process in the meantime
+                    pass
+
+    @staticmethod
+    def key(url):
+        return hashlib.sha1(url.encode('utf-8')).digest()
+
+    def segment_path(self, segment):
+        return path.join(self.dirpath, 'segment-%06i.seg' % segment)
+
+    def get(self, url, max_age=None):
+        """
+        :param max_age: Seconds since the page was cached after which it is ignored, None to use any cached page
+        :return: The cached response of the URL, or None
+        """
+        with self.lock:
+            row = self.db.execute("SELECT segment, offset, length, stored FROM pages WHERE key = ?",
+                                  (self.key(url),)).fetchone()
+            if row is None or (max_age is not None and row[3] < time() - max_age):
+                return None
+            try:
+                data = zlib.decompress(self.read(row[0], row[1], row[2]))
+            except (OSError, ValueError, zlib.error) as e:
+                # A segment dropped by another process sharing the cache, the page is requested again
+                logger.debug("Cached page of %s unreadable: %s", url, e)
+                return None
+        return json.loads(data.decode('utf-8'))
+
+    def read(self, segment, offset, length):
+        page_map = self.maps.get(segment)
+        # The active segment keeps growing, its map is made again once it no longer covers the page
+        if page_map is None or len(page_map) < offset + length:
+            if page_map is not None:
+                page_map.close()
+            with io.open(self.segment_path(segment), 'rb') as segment_file:
+                page_map = mmap.mmap(segment_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.maps[segment] = page_map
+        return page_map[offset:offset + length]
+
+    def put(self, url, response):
+        """
+        Caches the response of the URL, replacing the one cached before
+        """
+        data = zlib.compress(json.dumps(response).encode('utf-8'))
+        with self.lock:
+            if self.active is None or self.sizes[self.segment] + len(data) > self.segment_size:
+                self.roll()
+            offset = self.active.tell()
+            self.active.write(data)
+            # Flushed so that memory maps of the segment see the page, a lost page only costs a request
+            self.active.flush()
+            self.sizes[self.segment] = offset + len(data)
+            with self.db:
+                self.db.execute("INSERT OR REPLACE INTO pages VALUES (?, ?, ?, ?, ?)",
+                                (self.key(url), self.segment, offset, len(data), time()))
+
+    def roll(self):
+        """
+        Starts a new segment after every existing one, dropping the oldest ones past max_size. Pages written after the
+        last indexed one by an interrupted run are left behind in its last segment.
+        """
+        if self.active is not None:
+            self.active.close()
+            self.active = None
+        self.scan()
+        self.segment = max(self.sizes) + 1 if self.sizes else 0
+        while self.active is None:
+            try:
+                # Created exclusively, so that no other process sharing the cache appends to it
+                self.active = io.open(self.segment_path(self.segment), 'xb')
+            except FileExistsError:
+                self.segment += 1
+        self.sizes[self.segment] = 0
+
+        while sum(self.sizes.values()) > self.max_size and len(self.sizes) > 1:
+            oldest = min(self.sizes)
+            with self.db:
+                self.db.execute("DELETE FROM pages WHERE segment = ?", (oldest,))
+            if oldest in self.maps:
+                self.maps.pop(oldest).close()
+            try:
+                os.remove(self.segment_path(oldest))
+            except OSError:
+                # Dropped by another process sharing the cache
+                pass
+            del self.sizes[oldest]
+
+    def close(self):
+        with self.lock:
+            if self.active is not None:
+                self.active.close()
+                self.active = None
+            for page_map in self.maps.values():
+                page_map.close()
+            self.maps = {}
+            self.db.close()
+
+
+def newest_saved_item(filepath, sink_class, accounts=None):
+    """
+    Scans an existing JSON lines output for its newest item
+    :param sink_class: The sink that wrote the output, one of SINKS
+    :param accounts: Lower case screen names of the authors whose items count, None for every item
+    :return: The id and epoch of the newest item, None and None if there is none
+    """
+    newest_id = newest_epoch = None
+    with io.open(filepath, 'rb') as raw:
+        for line in sink_class.reader(raw):
+            try:
+                item = json.loads(line.decode('utf-8'))
+            except ValueError:
+                # Cut short by an interrupted crawl
+                continue
+            user = item.get('user')
+            if accounts is not None and isinstance(user, dict) and \
+                    user.get('screen_name', '').lower() not in accounts:
+                continue
+            if item.get('id') is not None and (newest_id is None or item['id'] > newest_id):
+                newest_id, newest_epoch = item['id'], item.get('epoch')
+    return newest_id, newest_epoch
+
+
+class IncrementalState(object):
+    def __init__(self, filepath):
+        """
+        Records the newest item each query of an incremental crawl saved, so that the next run only crawls newer items,
+        along with how active the query has been, to schedule it with --follow
+        :param filepath: Path of the SQLite database
+        """
+        self.filepath = filepath
+        self.db = sqlite3.connect(filepath)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS queries ("
+                            "query TEXT PRIMARY KEY, newest_id INTEGER, newest_epoch INTEGER, crawled REAL, "
+                            "polled REAL, activity REAL)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS outputs (filepath TEXT PRIMARY KEY, offset INTEGER)")
+
+    def load(self, query):
+        """
+        :return: The state of the query as a dict, or None if it was never crawled
+        """
+        row = self.db.execute("SELECT newest_id, newest_epoch, crawled, polled, activity FROM queries WHERE query = ?",
+                              (query,)).fetchone()
+        if row is None:
+            return None
+        return {'newest_id': row[0], 'newest_epoch': row[1], 'crawled': row[2], 'polled': row[3], 'activity': row[4]}
+
+    def writer_options(self, query, filepath, sink_class=JsonlSink):
+        """
+        :param sink_class: The sink writing the output, one of SINKS
+        :return: Keyword arguments of TwitterSearchImpl that crawl the query from where its last crawl stopped
+        """
+        state = self.load(query)
+        since_id = state['newest_id'] if state is not None else None
+        offset = None
+        if path.isfile(filepath):
+            offset = path.getsize(filepath)
+            row = self.db.execute("SELECT offset FROM outputs WHERE filepath = ?", (filepath,)).fetchone()
+            # Items past the end of the last finished crawl come from an interrupted one, which gets crawled again
+            if row is not None and row[0] < offset:
+                logger.warning("%s : Cutting off %i bytes left by an interrupted crawl.", filepath, offset - row[0])
+                offset = row[0]
+
+            # An output saved before the query was crawled incrementally, e.g. by a plain crawl or with another
+            # state file, is carried on from its newest item rather than crawled again into duplicates
+            if since_id is None and offset > 0:
+                accounts = set(account.lower() for account in re.findall(r'\bfrom:(\w+)', query)) or None
+                since_id, newest_epoch = newest_saved_item(filepath, sink_class, accounts)
+                if since_id is not None:
+                    logger.info("%s : Not crawled incrementally before, carrying on from its newest item %i.",
+                                filepath, since_id)
+                    with self.db:
+                        self.db.execute("INSERT OR IGNORE INTO queries (query, newest_id, newest_epoch) "
+                                        "VALUES (?, ?, ?)", (query, since_id, newest_epoch))
+        return {'since_id': since_id, 'append_offset': offset}
+
+    def finish(self, query, filepath, newest_id, newest_epoch, items):
+        """
+        Records a finished crawl of the query
+        :param newest_id: Id of the newest item saved, None if there was no new item
+        :param items: Number of items saved
+        """
+        now = time()
+        state = self.load(query)
+        activity = None
+        if state is not None:
+            if newest_id is None:
+                newest_id, newest_epoch = state['newest_id'], state['newest_epoch']
+            # Items per second since the last crawl, smoothed over the previous crawls
+            if state['crawled'] is not None:
+                rate = items / max(now - state['crawled'], 1)
+                activity = rate if state['activity'] is None else \
+                    ACTIVITY_SMOOTHING * rate + (1 - ACTIVITY_SMOOTHING) * state['activity']
+
+        with self.db:
+            self.db.execute("INSERT OR REPLACE INTO queries VALUES (?, ?, ?, ?, ?, ?)",
+                            (query, newest_id, newest_epoch, now, now, activity))
+            self.db.execute("INSERT OR REPLACE INTO outputs VALUES (?, ?)",
+                            (filepath, path.getsize(filepath) if path.isfile(filepath) else 0))
+
+    def failed(self, query):
+        """
+        Records a crawl of the query that gave up, so that it waits for its next turn before being polled again
+        """
+        with self.db:
+            if self.db.execute("UPDATE queries SET polled = ? WHERE query = ?", (time(), query)).rowcount == 0:
+                self.db.execute("INSERT INTO queries (query, polled) VALUES (?, ?)", (query, time()))
+
+    def next_poll(self, query, poll_min=DEFAULT_POLL_MIN, poll_max=DEFAULT_POLL_MAX):
+        """
+        When to poll the query again, about once per FOLLOW_ITEMS_PER_POLL new items
+        :return: A timestamp
+        """
+        state = self.load(query)
+        if state is None or state['polled'] is None:
+            return 0
+        if state['activity'] is None:
+            return state['polled'] + poll_min
+        if state['activity'] <= 0:
+            return state['polled'] + poll_max
+        return state['polled'] + min(max(FOLLOW_ITEMS_PER_POLL / state['activity'], poll_min), poll_max)
+
+    def close(self):
+        self.db.close()
+
+
+class IdIndex(object):
+    def __init__(self, filepath, max_pending=DEFAULT_DEDUP_PENDING):
+        """
+        A persistent set of 64-bit ids, such as tweet or user ids, that holds far more ids than fit in memory.
+        Merged ids are kept as a sorted array on disk that is memory-mapped and binary searched. Ids added since the
+        last merge are kept in memory and appended to a journal on every sync.
+        :param filepath: Path of the sorted id array, the journal is kept next to it
+        :param max_pending: Number of ids kept in memory before they are merged into the array
+        """
+        self.filepath = filepath
+        self.journal_path = filepath + '.journal'
+        self.max_pending = max_pending
+        self.lock = threading.Lock()
+        self.pending = set()
+        self.unsynced = array('Q')
+        self.map = None
+        self.ids = memoryview(array('Q'))
+        self.load()
+
+    def load(self):
+        if path.isfile(self.filepath) and path.getsize(self.filepath) > 0:
+            with io.open(self.filepath, 'rb') as index_file:
+                self.map = mmap.mmap(index_file.fileno(), 0, access=mmap.ACCESS_READ)
+            self.ids = memoryview(self.map).cast('Q')
+
+        if path.isfile(self.journal_path):
+            journal = array('Q')
+            with io.open(self.journal_path, 'rb') as journal_file:
+                data = journal_file.read()
+            # Ignore a partially written last id
+            journal.frombytes(data[:len(data) - len(data) % journal.itemsize])
+            self.pending.update(journal)
+
+    def __len__(self):
+        return len(self.ids) + len(self.pending)
+
+    def __contains__(self, id):
+        if id in self.pending:
+            return True
+        position = bisect_left(self.ids, id)
+        return position < len(self.ids) and self.ids[position] == id
+
+    def add(self, id):
+        """
+        :return: True if the id was not in the index yet
+        """
+        with self.lock:
+            if id in self:
+                return False
+            self.pending.add(id)
+            self.unsynced.append(id)
+            return True
+
+    def sync(self):
+        """
+        Makes the ids added so far durable, merging them into the array once there are enough of them
+        """
+        with self.lock:
+            if self.unsynced:
+                with io.open(self.journal_path, 'ab') as journal_file:
+                    self.unsynced.tofile(journal_file)
+                    journal_file.flush()
+                    os.fsync(journal_file.fileno())
+                self.unsynced = array('Q')
+
+            if len(self.pending) >= self.max_pending:
+                self.merge()
+
+    def merge(self):
+        tmp_path = self.filepath + '.tmp'
+        with io.open(tmp_path, 'wb') as index_file:
+            chunk = array('Q')
+            for id in heapq.merge(self.ids, sorted(self.pending)):
+                chunk.append(id)
+                if len(chunk) >= MERGE_CHUNK_SIZE:
+                    chunk.tofile(index_file)
+                    chunk = array('Q')
+            chunk.tofile(index_file)
+            index_file.flush()
+            os.fsync(index_file.fileno())
+
+        self.release()
+        os.replace(tmp_path, self.filepath)
+        if path.isfile(self.journal_path):
+            os.remove(self.journal_path)
+        self.pending = set()
+        self.load()
+
+    def release(self):
+        self.ids.release()
+        self.ids = memoryview(array('Q'))
+        if self.map is not None:
+            self.map.close()
+            self.map = None
+
+    def close(self):
+        self.sync()
+        with self.lock:
+            self.release()
+
+
+class UserCache(object):
+    def __init__(self, filepath=':memory:', ttl=DEFAULT_USER_CACHE_TTL, max_size=DEFAULT_USER_CACHE_SIZE):
+        """
+        A cache of user profiles keyed by id, kept in SQLite so that later runs do not look the same users up again.
+        Profiles expire after ttl seconds, and the least recently used are dropped once there are max_size of them.
+        :param filepath: Path of the SQLite database, in memory by default
+        :param ttl: Seconds a profile is used for before it is looked up again
+        :param max_size: Number of profiles kept
+        """
+        self.filepath = filepath
+        self.ttl = ttl
+        self.max_size = max_size
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filepath, check_same_thread=False)
+        with self.db:
+            self.db.execute("CREATE TABLE IF NOT EXISTS users ("
+                            "id INTEGER PRIMARY KEY, profile TEXT, fetched REAL, used REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS users_used ON users (used)")
+
+    def get(self, ids):
+        """
+        :return: A dict of the profiles of the given user ids that are cached and fresh, None for missing users
+        """
+        now = time()
+        profiles = {}
+        with self.lock, self.db:
+            for id in ids:
+                row = self.db.execute("SELECT profile FROM users WHERE id = ? AND fetched > ?",
+                                      (id, now - self.ttl)).fetchone()
+                if row is not None:
+                    profiles[id] = json.loads(row[0])
+            self.db.executemany("UPDATE users SET used = ? WHERE id = ?", [(now, id) for id in profiles])
+        return profiles
+
+    def put(self, profiles):
+        """
+        :param profiles: A dict of user profiles by id, None for users the lookup did not return
+        """
+        now = time()
+        with self.lock, self.db:
+            self.db.executemany("INSERT OR REPLACE INTO users VALUES (?, ?, ?, ?)",
+                                [(id, json.dumps(profile), now, now) for id, profile in profiles.items()])
+            excess = self.db.execute("SELECT COUNT(*) FROM users").fetchone()[0] - self.max_size
+            if excess > 0:
+                self.db.execute("DELETE FROM users WHERE id IN (SELECT id FROM users ORDER BY used LIMIT ?)",
+                                (excess,))
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+class UserLookup(object):
+    def __init__(self, profiles, futures):
+        """
+        The profiles of the users of a page, some from the cache and the others from pending users/lookup batches
+        """
+        self.profiles = profiles
+        self.futures = futures
+
+    def done(self):
+        return all(future.done() for future in self.futures)
+
+    def result(self):
+        """
+        :return: A dict of user profiles by id, waiting for the batches still pending
+        """
+        profiles = dict(self.profiles)
+        for future in self.futures:
+            profiles.update(future.result())
+        return profiles
+
+
+class UserEnricher(object):
+    def __init__(self, client=None, cache=None, workers=DEFAULT_USER_LOOKUP_WORKERS, governor=None,
+                 batch_size=USER_LOOKUP_BATCH):
+        """
+        Looks users up through the REST API. Users missing from the cache are gathered into full batches, across
+        pages and searches, which are sent concurrently while the searches carry on.
+        :param client: A client with the UsersLookup method of twitter.Api, built from the TWITTER_REST_API_*
+                       settings if None
+        :param cache: A UserCache, an in-memory one if None
+        :param workers: Number of batches looked up at once
+        :param governor: A RateGovernor keeping the lookups within the REST API rate limit
+        :param batch_size: Number of users per lookup
+        """
+        self._client = client
+        self.cache = cache if cache is not None else UserCache()
+        self.governor = governor if governor is not None else RateGovernor(rate=USER_LOOKUP_RATE,
+                                                                             max_rate=USER_LOOKUP_RATE)
+        self.batch_size = batch_size
+        self.executor = ThreadPoolExecutor(max_workers=workers)
+        self.lock = threading.Lock()
+        self.batch = []
+        self.batch_future = None
+        self.in_flight = {}
+        self.lookups = 0
+
+    @property
+    def client(self):
+        if self._client is None:
+            import twitter
+            self._client = twitter.Api(consumer_key=TWITTER_REST_API_CONSUMER_KEY,
+                                       consumer_secret=TWITTER_REST_API_CONSUMER_SECRET,
+                                       access_token_key=TWITTER_REST_API_ACCESS_TOKEN,
+                                       access_token_secret=TWITTER_REST_API_ACCESS_TOKEN_SECRET)
+        return self._client
+
+    def lookup(self, ids):
+        """
+        Starts looking the given users up. Only full batches are sent, see flush.
+        :param ids: User ids
+        :return: A UserLookup of their profiles
+        """
+        ids = list(set(ids))
+        profiles = self.cache.get(ids)
+        futures = set()
+        with self.lock:
+            for id in ids:
+                if id in profiles:
+                    continue
+                if id not in self.in_flight:
+                    if self.batch_future is None:
+                        self.batch_future = Future()
+                    self.batch.append(id)
+                    self.in_flight[id] = self.batch_future
+                    if len(self.batch) >= self.batch_size:
+                        self.dispatch()
+                futures.add(self.in_flight[id])
+        return UserLookup(profiles, futures)
+
+    def flush(self):
+        """
+        Sends the users gathered so far without waiting for a full batch
+        """
+        with self.lock:
+            if self.batch:
+                self.dispatch()
+
+    def dispatch(self):
+        batch, future = self.batch, self.batch_future
+        self.batch = []
+        self.batch_future = None
+        self.executor.submit(self.run_batch, batch, future)
+
+    def run_batch(self, ids, future):
+        try:
+            profiles = self.fetch(ids)
+            if profiles is not None:
+                # Suspended or deleted users are cached as well, so they are not looked up on every run
+                self.cache.put(dict((id, profiles.get(id)) for id in ids))
+            future.set_result(profiles or {})
+        except Exception as e:
+            future.set_exception(e)
+        finally:
+            with self.lock:
+                for id in ids:
+                    self.in_flight.pop(id, None)
+
+    def fetch(self, ids):
+        """
+        Looks a batch of users up
+        :return: A dict of user profiles by id, or None if the lookup kept failing
+        """
+        for retry_num in range(MAX_RETRIES_SESSION):
+            self.governor.acquire()
+            try:
+                users = self.client.UsersLookup(user_id=ids)
+            except Exception as e:
+                # Most failures are the rate limit, have the lookups slow down
+                logger.error("User lookup failed: %s", e)
+                self.governor.throttled({})
+                continue
+            self.lookups += 1
+            self.governor.success({})
+            profiles = (user.AsDict() for user in users)
+            return dict((profile['id'], profile) for profile in profiles)
+        return None
+
+    def close(self):
+        self.flush()
+        self.executor.shutdown(wait=True)
+        self.cache.close()
+
+
+class TwitterSearchImpl(TwitterSearch):
+    compact_records = True
+
+    def __init__(self, session, rate_delay, error_delay, max_items, filepath, useragent_cache_path=None,
+                 useragent=None, parser=DEFAULT_PARSER, checkpoint_store=None, sink=DEFAULT_SINK, sink_options=None,
+                 dedup_index=None, stop_on_duplicates=False, base_url=DEFAULT_BASE_URL, enricher=None, since_id=None,
+                 append_offset=None, page_cache=None, offline=False, stop_event=None):
+        """
+        :param rate_delay: How long to pause between calls to Twitter
+        :param error_delay: How long to pause when an error occurs
+        :param max_items: Maximum number of items to collect for this example
+        :param filepath: Path of the output, or a dict of paths by lower case screen name to split the items of a search
+                         of several accounts by author
+        :param checkpoint_store: A CrawlCheckpoint to resume interrupted searches from
+        :param sink: The output format, one of SINKS
+        :param sink_options: Keyword arguments of the sink, such as batch_size or row_group_size
+        :param dedup_index: An IdIndex of the ids saved by earlier runs, items already in it are skipped
+        :param stop_on_duplicates: Stop the search at the first page made only of items already in dedup_index
+        :param since_id: Stop the search at the first item with an id up to this one, saved by an earlier crawl
+        :param append_offset: Size to cut the existing output back to before appending to it, None to overwrite it
+        :param stop_event: A threading.Event that stops the search when set, leaving it unfinished
+        """
+        super(TwitterSearchImpl, self).__init__(session, rate_delay, error_delay, useragent_cache_path, useragent,
+                                                parser, base_url=base_url, enricher=enricher, page_cache=page_cache,
+                                                offline=offline)
+        self.max_items = max_items
+        self.counter = 0
+        self.last_id = None
+        if isinstance(filepath, dict):
+            self.sink = SplitSink(filepath, SINKS[sink], **(sink_options or {}))
+            filepath = "%s and %i more" % (min(filepath.values()), len(filepath) - 1)
+        else:
+            self.sink = SINKS[sink](filepath, **(sink_options or {}))
+        self.filepath = filepath
+        self.output_open = False
+        self.checkpoint_store = checkpoint_store
+        self.dedup_index = dedup_index
+        self.stop_on_duplicates = stop_on_duplicates
+        self.duplicates = 0
+        self.since_id = since_id
+        self.append_offset = append_offset
+        self.newest_id = None
+        self.newest_epoch = None
+        self.stop_event = stop_event
+
+    def search(self, query, target_type, **kwargs):
+        self.update_session_headers()
+
+        if not self.start_output(query, kwargs):
+            return True
+        completed = False
+        try:
+            completed = super(TwitterSearchImpl, self).search(query, target_type=target_type, **kwargs)
+            if self.stopped():
+                completed = False
+        finally:
+            self.finish_output(query, completed)
+        return completed
+
+    def start_output(self, query, kwargs):
+        """
+        Opens the output, picking up from the last checkpoint of the query if there is one
+        :param kwargs: Search keyword arguments, updated with the cursor to resume from
+        :return: False if the query has already been searched to the end
+        """
+        state = self.checkpoint_store.load(query) if self.checkpoint_store is not None else None
+        if state is not None and not path.isfile(self.filepath):
+            logger.warning("%s : Output is missing, starting over.", self.filepath)
+            state = None
+
+        if state is None:
+            if self.append_offset is not None:
+                self.open_output(self.append_offset)
+            # Queries sharing an output file with the earlier queries of a crawl add to it
+            elif self.checkpoint_store is not None and not self.checkpoint_store.empty() and path.isfile(self.filepath):
+                self.open_output(path.getsize(self.filepath))
+            else:
+                self.open_output()
+            return True
+
+        if state['done'] or (self.max_items is not None and state['counter'] >= self.max_items):
+            logger.info("%s : Search already finished, %i items saved.", self.filepath, state['counter'])
+            self.checkpoint_store.finish(query)
+            return False
+
+        logger.info("%s : Resuming search after %i items.", self.filepath, state['counter'])
+        self.open_output(state['offset'])
+        self.counter = state['counter']
+        self.last_id = state['last_id']
+        kwargs['max_position'] = state['max_position']
+        return True
+
+    def finish_output(self, query, completed):
+        self.close_output()
+        if completed and self.checkpoint_store is not None:
+            self.checkpoint_store.finish(query)
+        if self.dedup_index is not None:
+            self.dedup_index.sync()
+            logger.info("%s : %i duplicate items skipped.", self.filepath, self.duplicates)
+
+    def open_output(self, offset=None):
+        """
+        :param offset: Size to cut the existing output back to before appending, or None to overwrite it
+        """
+        self.sink.open(offset)
+        self.output_open = True
+
+    def close_output(self):
+        if self.output_open:
+            self.sink.close()
+            self.output_open = False
+
+    def checkpoint(self, query, max_position, items):
+        # The output has to reach the disk before the checkpoint and the ids that cover it, a crash in between leads
+        # to a duplicate rather than a lost item
+        if self.checkpoint_store is not None:
+            offset = self.sink.sync()
+            self.checkpoint_store.save(query, max_position, self.counter, self.last_id, offset)
+        elif self.dedup_index is not None and self.sink.resumable:
+            self.sink.sync()
+
+        # Outputs that are only durable once closed record their ids in finish_output, after closing them
+        if self.dedup_index is not None and self.sink.resumable:
+            self.dedup_index.sync()
+
+    def save_items(self, items):
+        """
+        Just prints out items
+        :return:
+        """
+        new_items = 0
+        for item in items:
+            # Items come newest first, everything from here on was saved by an earlier crawl
+            if self.since_id is not None and item['id'] <= self.since_id:
+                logger.info("%s : Reached items saved by the last crawl, stopping.", self.filepath)
+                return False
+
+            if self.dedup_index is not None and not self.dedup_index.add(item['id']):
+                self.duplicates += 1
+                continue
+            new_items += 1
+
+            # Lets add a counter so we only collect a max number of items
+            self.counter += 1
+
+            self.sink.write(item)
+            self.last_id = item.get('id_str')
+            if self.newest_id is None or item['id'] > self.newest_id:
+                self.newest_id = item['id']
+                self.newest_epoch = item.get('epoch')
+
+            if self.counter % PROGRESS_PER == 0:
+                logger.info("%s : %i items saved to file, %.2f requests per second.", self.filepath, self.counter,
+                            self.governor.rate)
+
+            # When we've reached our max limit, return False so collection stops
+            if self.max_items is not None and self.counter >= self.max_items:
+                return False
+
+        if new_items == 0 and self.stop_on_duplicates:
+            logger.info("%s : Reached a page of known items, stopping.", self.filepath)
+            return False
+
+        return True
+
+
+class AsyncTwitterSearch(TwitterSearch):
+    __metaclass__ = ABCMeta
+
+    def __init__(self, session, rate_delay, error_delay=5, semaphore=None, executor=None,
+                 useragent_cache_path=None, useragent=None, parser=DEFAULT_PARSER,
+                 base_url=DEFAULT_BASE_URL, enricher=None, page_cache=None, offline=False):
+        """
+        Asynchronous counterpart of TwitterSearch, running on an asyncio event loop
+        :param session: An aiohttp.ClientSession, usually shared by every search on the loop
+        :param semaphore: An asyncio.Semaphore limiting the number of requests in flight across searches
+        :param executor: The concurrent.futures executor parsing runs on, the loop's default one if None
+        """
+        import asyncio
+
+        super(AsyncTwitterSearch, self).__init__(session, rate_delay, error_delay, useragent_cache_path, useragent,
+                                                 parser, base_url=base_url, enricher=enricher, page_cache=page_cache,
+                                                 offline=offline)
+        self.semaphore = semaphore if semaphore is not None else asyncio.Semaphore(DEFAULT_ASYNC_CONCURRENCY)
+        self.executor = executor
+        self.headers = {}
+
+    def update_session_headers(self):
+        # The session is shared with other searches, so headers are sent with each request instead
+        self.headers = dict(SEARCH_HEADERS)
+        self.headers['User-Agent'] = self.UA.random
+
+    async def search(self, query, target_type, **kwargs):
+        """
+        Scrape items from twitter
+        :param query:   Query to search Twitter with. Takes form of queries constructed with using Twitters
+                        advanced search: https://twitter.com/search-advanced
+        :param target_type:    Can be "tweets" or "users"
+        :param max_position:   Cursor of the page to start from, to resume an interrupted search
+        :return: False if the search gave up after too many failed requests
+        """
+        pages = self.iter_pages(query, target_type, max_position=kwargs.get('max_position'),
+                                language=kwargs.get('language'), user_stats=kwargs.get('user_stats'))
+        try:
+            async for items, max_position in pages:
+                if self.stopped():
+                    break
+                started = perf_counter()
+                continue_search = await self.save_items(items)
+                METRICS.observe('save_seconds', perf_counter() - started)
+                await self.checkpoint(query, max_position, items)
+                if not continue_search:
+                    break
+        finally:
+            await pages.aclose()
+        return not self.gave_up
+
+    async def checkpoint(self, query, max_position, items):
+        """
+        Coroutine counterpart of TwitterSearch.checkpoint, called once a page of items has been saved
+        """
+
+    async def iter_search(self, query, target_type=DEFAULT_TARGET_TYPE, **kwargs):
+        """
+        Yields the items of a search one by one, as its pages come in. Takes the keyword arguments of iter_pages.
+        """
+        pages = self.iter_pages(query, target_type, **kwargs)
+        try:
+            async for items, _ in pages:
+                for item in items:
+                    yield item
+        finally:
+            await pages.aclose()
+
+    async def iter_pages(self, query, target_type=DEFAULT_TARGET_TYPE, max_position=None, language=None,
+                         user_stats=False, prefetch=DEFAULT_PREFETCH_PAGES):
+        """
+        Yields the pages of a search as they come in, with the next pages fetched on a task while the caller works
+        through the current one. Closing the generator with aclose stops the search.
+        Sets gave_up once done if the search gave up after too many failed requests.
+        :param query:   Query to search Twitter with
+        :param target_type:    Can be "tweets" or "users"
+        :param max_position:   Cursor of the page to start from, to resume an interrupted search
+        :param language: Specifies a language to filter search results
+        :param user_stats: Add the profiles of their users to the items, see UserEnricher
+        :param prefetch: Number of pages fetched ahead of the caller
+        :return: An asynchronous generator of (items, max_position) tuples, max_position being the cursor of the
+                 next page
+        """
+        import asyncio
+
+        # Initialize search function wrapper according to the target type
+        parse_tweets_fn = self.parse_tweets if target_type == DEFAULT_TARGET_TYPE else self.parse_users
+        if target_type == DEFAULT_TARGET_TYPE and self.uses_records():
+            parse_tweets_fn = partial(parse_tweets_fn, compact=True)
+        loop = asyncio.get_running_loop()
+        self.gave_up = False
+        pages = asyncio.Queue(maxsize=prefetch)
+        errors = []
+
+        async def fetch():
+            try:
+                urls = SearchUrl(query, target_type, language=language, base_url=self.base_url,
+                                 construct_url=self.construct_url)
+                url = urls.page(max_position)
+                min_item = None
+                response = await self.execute_search(url)
+                while response is not None and response['items_html'] is not None:
+                    # Parsing is CPU bound, keep it off the loop so other searches can carry on with their I/O
+                    items = await loop.run_in_executor(self.executor, parse_tweets_fn, response['items_html'])
+                    max_item = response["min_position"]
+                    await pages.put((items, max_item))
+
+                    if min_item == max_item:
+                        break
+                    url = urls.page(max_item)
+                    # Sleep for our rate_delay
+                    await asyncio.sleep(self.rate_delay)
+                    response = await self.execute_search(url)
+                    min_item = max_item
+
+                if response is None:
+                    self.gave_up = True
+            except Exception as e:
+                errors.append(e)
+            await pages.put(None)
+
+        fetcher = asyncio.ensure_future(fetch())
+        try:
+            while True:
+                page = await pages.get()
+                if page is None:
+                    break
+                items, max_item = page
+
+                # If we have no items, then we can break the loop early
+                METRICS.count('pages_total')
+                METRICS.observe('page_items', len(items))
+                if len(items) == 0:
+                    break
+
+                # Check if we should collect additional user details
+                if user_stats:
+                    lookup = self.enricher.lookup(self.user_ids(items))
+                    self.enricher.flush()
+                    await asyncio.gather(*[asyncio.wrap_future(future) for future in lookup.futures])
+                    self.merge_profiles(items, lookup.result())
+
+                yield items, max_item
+        finally:
+            fetcher.cancel()
+            try:
+                await fetcher
+            except asyncio.CancelledError:
+                pass
+
+        if errors:
+            raise errors[0]
+
+    async def execute_search(self, url):
+        """
+        Executes a search to Twitter for the given URL, retrying with the same rules as TwitterSearch
+        :param url: URL to search twitter with
+        :return: A JSON object with data from Twitter
+        """
+        import asyncio
+        import aiohttp
+
+        data = self.cached_page(url)
+        if data is not None or self.offline:
+            return data
+
+        started = perf_counter()
+        retry_num = 0
+        throttled_num = 0
+        while True:
+            wait = self.governor.reserve()
+            METRICS.observe('rate_wait_seconds', wait)
+            await asyncio.sleep(wait)
+            status_code = None
+            headers = {}
+            async with self.semaphore:
+                logger.info("URL: " + url)
+                request_started = perf_counter()
+                METRICS.count('requests_total')
+                try:
+                    async with self.session.get(url, headers=self.headers) as response:
+                        # 400 Bad Request still carries a JSON body
+                        if response.status <= 400:
+                            self.governor.success(response.headers)
+                            body = await response.read()
+                            data = await response.json(content_type=None)
+                            if response.status == 200 and self.page_cache is not None:
+                                self.page_cache.put(url, data)
+                            METRICS.observe('http_request_seconds', perf_counter() - request_started)
+                            METRICS.count('bytes_received_total', len(body))
+                            METRICS.observe('http_seconds', perf_counter() - started)
+                            return data
+                        status_code = response.status
+                        headers = response.headers
+                except aiohttp.ClientError as e:
+                    logger.error("Request failed: %s", e)
+                METRICS.observe('http_request_seconds', perf_counter() - request_started)
+
+            # Throttling pauses every search sharing the governor, the retry waits for it
+            if status_code == 429:
+                METRICS.count('throttled_total')
+                self.governor.throttled(headers)
+                throttled_num += 1
+                if throttled_num <= MAX_THROTTLED_RETRIES:
+                    continue
+                logger.error("Still throttled after %i retries, giving up", MAX_THROTTLED_RETRIES)
+                METRICS.count('failed_requests_total')
+                return None
+
+            if retry_num == MAX_RETRIES:
+                METRICS.count('failed_requests_total')
+                return None
+
+            total_sleep = self.retry_delay(status_code, headers, retry_num)
+            logger.info("Sleeping for %i", total_sleep)
+            METRICS.count('retries_total')
+            METRICS.observe('retry_wait_seconds', total_sleep)
+            await asyncio.sleep(total_sleep)
+
+            retry_num += 1
+            if retry_num % MAX_RETRIES_SESSION == 0:
+                self.headers['User-Agent'] = self.UA.random
+
+    @abstractmethod
+    async def save_items(self, items):
+        """
+        An abstract coroutine that's called with a list of items.
+        It should return False to stop collecting.
+        """
+
+
+class AsyncTwitterSearchImpl(AsyncTwitterSearch):
+    compact_records = True
+
+    def __init__(self, session, rate_delay, error_delay, max_items, filepath, semaphore=None, executor=None,
+                 useragent_cache_path=None, useragent=None, parser=DEFAULT_PARSER,
+                 base_url=DEFAULT_BASE_URL, enricher=None, page_cache=None, offline=False, **writer_options):
+        """
+        Saves items to a file, the same way TwitterSearchImpl does
+        :param max_items: Maximum number of items to collect
+        :param writer_options: Output keyword arguments of TwitterSearchImpl, such as sink or checkpoint_store
+        """
+        super(AsyncTwitterSearchImpl, self).__init__(session, rate_delay, error_delay, semaphore, executor,
+                                                     useragent_cache_path, useragent, parser, base_url, enricher,
+                                                     page_cache, offline)
+        self.writer = TwitterSearchImpl(None, rate_delay, error_delay, max_items, filepath, useragent=self.UA,
+                                        **writer_options)
+
+    async def search(self, query, target_type, **kwargs):
+        self.update_session_headers()
+
+        if not self.writer.start_output(query, kwargs):
+            return True
+        completed = False
+        try:
+            completed = await super(AsyncTwitterSearchImpl, self).search(query, target_type=target_type, **kwargs)
+        finally:
+            self.writer.finish_output(query, completed)
+        return completed
+
+    async def save_items(self, items):
+        return self.writer.save_items(items)
+
+    async def checkpoint(self, query, max_position, items):
+        import asyncio
+
+        # Syncing the output waits for the disk, keep it off the loop so other searches can carry on
+        await asyncio.get_running_loop().run_in_executor(None, self.writer.checkpoint, query, max_position, items)
+
+
+async def async_twitter_search(jobs, rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY,
+                               limit=DEFAULT_LIMIT, concurrency=DEFAULT_ASYNC_CONCURRENCY,
+                               useragent_cache_path=None, parser=DEFAULT_PARSER, resume=False,
+                               connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                               base_url=DEFAULT_BASE_URL, enricher=None, page_cache=None, offline=False,
+                               **writer_options):
+    """
+    Runs many searches at once on the current event loop, sharing one connection pool
+    :param jobs: A list of (filepath, query, search keyword arguments) tuples
+    :param concurrency: Maximum number of requests in flight across all searches
+    :param resume: Resume the searches from the checkpoints next to their output
+    :param page_cache: A PageCache serving and keeping the pages of the searches
+    :param offline: Only replay the pages in page_cache
+    :param writer_options: Output keyword arguments of TwitterSearchImpl, such as sink
+    """
+    import asyncio
+    import aiohttp
+
+    useragent = UserAgentPool.shared(useragent_cache_path)
+    semaphore = asyncio.Semaphore(concurrency)
+
+    # Searches writing to the same file run one after the other
+    groups = {}
+    for job in jobs:
+        groups.setdefault(job[0], []).append(job)
+
+    timeout = aiohttp.ClientTimeout(sock_connect=connect_timeout, sock_read=read_timeout)
+    headers = {'Accept-Encoding': accept_encoding()}
+    async with aiohttp.ClientSession(connector=aiohttp.TCPConnector(limit=concurrency), timeout=timeout,
+                                     headers=headers) as session:
+        async def run_group(group):
+            checkpoint_store = CrawlCheckpoint.for_output(group[0][0]) if resume else None
+            for filepath, query, kwargs in group:
+                twit = AsyncTwitterSearchImpl(session, rate_delay, error_delay, limit, filepath,
+                                              semaphore=semaphore, useragent=useragent, parser=parser,
+                                              base_url=base_url, enricher=enricher, page_cache=page_cache,
+                                              offline=offline, checkpoint_store=checkpoint_store,
+                                              **writer_options)
+                logger.info("Search : %s", query)
+                await twit.search(query, **kwargs)
+
+        await asyncio.gather(*[run_group(group) for group in groups.values()])
+
+
+class TwitterSearchCollector(TwitterSearch):
+    compact_records = True
+
+    def __init__(self, session, rate_delay, error_delay, max_pages=None, stop_event=None, useragent=None,
+                 parser=DEFAULT_PARSER, base_url=DEFAULT_BASE_URL, page_cache=None, offline=False):
+        """
+        Keeps the crawled items in memory, used to crawl a single slice of a sharded search
+        :param max_pages: Maximum number of pages to collect before giving up on the slice
+        :param stop_event: A threading.Event that stops collection when set
+        """
+        super(TwitterSearchCollector, self).__init__(session, rate_delay, error_delay, useragent=useragent,
+                                                     parser=parser, base_url=base_url, page_cache=page_cache,
+                                                     offline=offline)
+        self.max_pages = max_pages
+        self.stop_event = stop_event
+        self.items = []
+        self.pages = 0
+        self.truncated = False
+
+    def save_items(self, items):
+        self.items.extend(items)
+        self.pages += 1
+
+        if self.stopped():
+            return False
+
+        if self.max_pages is not None and self.pages >= self.max_pages:
+            self.truncated = True
+            return False
+
+        return True
+
+
+def parse_search_date(value):
+    """
+    Parses a date as accepted by the since: and until: search operators
+    :param value: Either YYYY-MM-DD or YYYY-MM-DD_HH:MM:SS_UTC
+    :return: A naive UTC datetime
+    """
+    try:
+        return datetime.strptime(value, SEARCH_DATETIME_FORMAT)
+    except ValueError:
+        return datetime.strptime(value, SEARCH_DATE_FORMAT)
+
+
+def format_search_date(value):
+    """
+    Formats a datetime for the since: and until: search operators, using the short form on day boundaries
+    """
+    if value.hour == 0 and value.minute == 0 and value.second == 0:
+        return value.strftime(SEARCH_DATE_FORMAT)
+    return value.strftime(SEARCH_DATETIME_FORMAT)
+
+
+class DateShard(object):
+    def __init__(self, key, start, end):
+        """
+        :param key: A tuple ordering the shard in the output, newest slices first
+        :param start: Inclusive start of the slice
+        :param end: Exclusive end of the slice
+        """
+        self.key = key
+        self.start = start
+        self.end = end
+
+    @property
+    def span(self):
+        return self.end - self.start
+
+    def query(self, query):
+        return "%s since:%s until:%s" % (query, format_search_date(self.start), format_search_date(self.end))
+
+
+class DateShardPlanner(object):
+    def __init__(self, since, until, span):
+        """
+        Cuts [since, until) into slices from the newest to the oldest, adapting the size of the following slices
+        to how dense the previous ones turned out to be
+        :param since: Inclusive start of the window
+        :param until: Exclusive end of the window
+        :param span: Initial size of a slice
+        """
+        self.since = since
+        self.cursor = until
+        self.span = span
+        self.count = 0
+
+    def next_shard(self):
+        if self.cursor <= self.since:
+            return None
+
+        start = max(self.cursor - self.span, self.since)
+        shard = DateShard((self.count,), start, self.cursor)
+        self.count += 1
+        self.cursor = start
+        return shard
+
+    def report(self, shard, num_items, truncated):
+        """
+        Dense slices halve the size of the next ones, sparse slices double it
+        """
+        if truncated:
+            self.span = max(self.span // 2, MIN_SHARD_SPAN)
+        elif num_items < SHARD_SPARSE_ITEMS and shard.span >= self.span:
+            self.span = min(self.span * 2, MAX_SHARD_SPAN)
 
     @staticmethod
-    def parse_users(items_html):
+    def split(shard, oldest_epoch):
         """
-        Parses Users from the given HTML
-        :param items_html: The HTML block with items
-        :return: A JSON list of items
+        Splits what is left of a truncated shard, older than the oldest item collected so far
+        :param shard: The truncated shard
+        :param oldest_epoch: Epoch of the oldest item collected from the shard
+        :return: A list of shards covering the remaining part
         """
-        soup = BeautifulSoup(items_html, 'lxml')
-        items = []
-        for div in soup.find_all("div", class_='js-stream-item'):
+        # Include the second of the oldest item, since more items may share it. Duplicates are dropped on merge.
+        end = min(datetime.utcfromtimestamp(oldest_epoch) + timedelta(seconds=1), shard.end)
+        if end <= shard.start:
+            return []
 
-            # If our li doesn't have a tweet-id, we skip it as it's not going to be a tweet.
-            if 'data-item-id' not in div.attrs:
-                continue
+        if end - shard.start <= MIN_SHARD_SPAN:
+            return [DateShard(shard.key + (1,), shard.start, end)]
 
-            user = {
-                'bio': None,
-                'id_str': div['data-item-id'],
-                'id': int(div['data-item-id']),
-                'screen_name': None,
-                'name': None,
-            }
+        middle = shard.start + (end - shard.start) // 2
+        return [DateShard(shard.key + (1,), middle, end), DateShard(shard.key + (2,), shard.start, middle)]
 
-            # User Bio
-            text_p = div.find("p", class_="ProfileCard-bio")
-            if text_p is not None:
-                user['bio'] = text_p.get_text()
 
-            # Tweet User ID, User Screen Name, User Name
-            user_details_div = div.find("div", class_="user-actions")
-            if user_details_div is not None:
-                user['screen_name'] = user_details_div['data-screen-name']
-                user['name'] = user_details_div['data-name']
+class ShardedTwitterSearch(object):
+    def __init__(self, session, rate_delay, error_delay, workers=DEFAULT_SHARD_WORKERS, granularity='day',
+                 useragent=None, parser=DEFAULT_PARSER, base_url=DEFAULT_BASE_URL, page_cache=None, offline=False):
+        """
+        Crawls a date window as independent slices on a pool of threads, each one following its own pagination
+        :param workers: Number of slices crawled at the same time
+        :param granularity: Initial size of a slice, one of SHARD_GRANULARITIES
+        """
+        self.session = session
+        self.rate_delay = rate_delay
+        self.error_delay = error_delay
+        self.workers = workers
+        self.granularity = granularity
+        self.UA = useragent
+        self.parser = parser
+        self.base_url = base_url
+        self.page_cache = page_cache
+        self.offline = offline
 
-            user_fields_div = div.find("div", class_="ProfileCard-userFields")
-            user_verified_span = user_fields_div.find("span", class_="Icon--verified")
-            user['verified'] = True if user_verified_span else False
+    def crawl_shard(self, query, shard, target_type, stop_event, **kwargs):
+        max_pages = SHARD_DENSE_PAGES if shard.span > MIN_SHARD_SPAN else None
+        collector = TwitterSearchCollector(self.session, self.rate_delay, self.error_delay, max_pages=max_pages,
+                                           stop_event=stop_event, useragent=self.UA, parser=self.parser,
+                                           base_url=self.base_url, page_cache=self.page_cache, offline=self.offline)
+        shard_query = shard.query(query)
+        logger.info("Shard : %s", shard_query)
+        collector.search(shard_query, target_type=target_type, **kwargs)
+        return collector
 
-            items.append(user)
-        return items
+    def search(self, query, since, until, writer, target_type=DEFAULT_TARGET_TYPE, **kwargs):
+        """
+        Crawls the query between since and until, saving the merged items through writer.save_items in the same
+        order as a serial crawl, without duplicates
+        :param query: Query to search Twitter with, without since: and until: operators
+        :param since: Inclusive start of the window, as a datetime
+        :param until: Exclusive end of the window, as a datetime
+        :param writer: A TwitterSearch whose save_page receives the merged items
+        """
+        planner = DateShardPlanner(since, until, SHARD_GRANULARITIES[self.granularity])
+        # Users are looked up once slices are merged, so that they are not looked up for items dropped as duplicates
+        user_stats = kwargs.pop('user_stats', False)
+        stop_event = threading.Event()
+        running = {}
+        results = {}
+        # Ids of the last slice merged, see merge
+        seen = set()
+
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            def submit(shard):
+                future = executor.submit(self.crawl_shard, query, shard, target_type, stop_event, **kwargs)
+                running[future] = shard
+
+            def top_up():
+                while len(running) < self.workers:
+                    shard = planner.next_shard()
+                    if shard is None:
+                        break
+                    submit(shard)
+
+            top_up()
+            try:
+                while running and not stop_event.is_set():
+                    done, _ = wait(running, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        shard = running.pop(future)
+                        collector = future.result()
+                        results[shard.key] = collector.items
+                        planner.report(shard, len(collector.items), collector.truncated)
+
+                        if collector.truncated and collector.items:
+                            oldest_epoch = min(item['epoch'] for item in collector.items)
+                            for child in planner.split(shard, oldest_epoch):
+                                submit(child)
+
+                    if not self.merge(results, running, seen, writer, query, user_stats):
+                        stop_event.set()
+                        break
+                    top_up()
+                else:
+                    writer.save_enriched(query, drain=True)
+            finally:
+                stop_event.set()
 
     @staticmethod
-    def construct_url(query, target_type, max_position=None, language=None):
+    def merge(results, running, seen, writer, query, user_stats=False):
         """
-        For a given query, will construct a URL to search Twitter with
-        :param query: The query term used to search twitter
-        :param target_type:    Can be "tweets" or "users"
-        :param max_position: The max_position value to select the next pagination of items
-        :param language: Specifies a language to filter search results
-        :return: A string URL
+        Saves every finished slice that no running slice precedes
+        :param seen: The ids of the last slice merged, replaced by those of each slice merged
+        :param user_stats: Add the profiles of their users to the items
+        :return: False once the writer asks to stop collecting
         """
-        params = {
-            'f': target_type,
-            'vertical': 'default',
-            'include_available_features': 1,
-            'include_entities': 1,
-            'include_new_items_bar': 'true',
-            'reset_error_state': 'false',
-            'src': 'typd',
-            'max_position': max_position,
-            'q': query,
-        }
+        pending = min(shard.key for shard in running.values()) if running else None
+        while results:
+            key = min(results)
+            if pending is not None and pending < key:
+                break
 
-        if language:
-            params['l'] = language
+            # A slice only overlaps the one merged before it, on the second of its oldest item, so only the ids of
+            # that slice are kept rather than those of the whole crawl
+            slice_items = results.pop(key)
+            items = []
+            for item in slice_items:
+                if item['id'] not in seen:
+                    seen.add(item['id'])
+                    items.append(item)
+            if slice_items:
+                seen.clear()
+                seen.update(item['id'] for item in slice_items)
+            # Slices are collected as records, a writer overriding save_items gets dicts like its own searches do
+            if not writer.uses_records():
+                items = [item.to_dict() if isinstance(item, Tweet) else item for item in items]
+
+            if items and not writer.save_page(query, items, None, user_stats):
+                return False
+        return True
 
-        url_tupple = ('https', 'twitter.com', '/i/search/timeline', '', urlencode(params), '')
-        return urlunparse(url_tupple)
 
-    @staticmethod
-    def construct_user_url(query, target_type, max_position=None):
+class LeaseLost(Exception):
+    """
+    Raised when a worker finds out that its work unit was handed to another worker
+    """
+
+
+class WorkQueue(object):
+    """
+    The work units of a distributed crawl, leased by workers. Each unit is a search written to its own part file,
+    whose parts are merged into the outputs of the crawl once every unit is done.
+    A unit is pending until a worker leases it. The worker renews its lease with heartbeats carrying the cursor of
+    the search, and completes or releases it. Units whose lease runs out go back to another worker, which picks the
+    search up from the last cursor. Idle workers wait for units until the coordinator marks the queue closed.
+    Backends are listed in WORK_QUEUES and opened by open_work_queue, their constructor takes the location of the
+    queue and whether to create it.
+    """
+    __metaclass__ = ABCMeta
+
+    @abstractmethod
+    def add(self, units):
         """
-        For a given query, will construct a URL to search Twitter with
-        :param query: The query term used to search twitter
-        :param target_type:    Can be "tweets" or "users"
-        :param max_position: The max_position value to select the next pagination of items
-        :return: A string URL
+        Adds work units, skipping the ones already in the queue so that a restarted coordinator does not add them
+        twice. Opens the queue again if it was closed.
+        :param units: A list of dicts with the key, output, part, query and options of each unit, in merge order
         """
-        params = {
-            'f': target_type,
-            'vertical': 'default',
-            'q': query,
-            'src': 'typd',
-            'include_available_features': 1,
-            'include_entities': 1,
-            'max_position': max_position,
-            'reset_error_state': 'false',
-            'include_new_items_bar': 'true',
-        }
 
-        url_tupple = ('https', 'twitter.com', '/i/search/timeline', '', urlencode(params), '')
-        return urlunparse(url_tupple)
+    @abstractmethod
+    def mark_closed(self):
+        """
+        Records that no more units will be added, so that idle workers stop waiting for them
+        """
 
     @abstractmethod
-    def save_items(self, items):
+    def is_closed(self):
         """
-        An abstract method that's called with a list of items.
-        When implementing this class, you can do whatever you want with these items.
+        :return: True once the coordinator marked the queue closed
         """
 
-    def retrieve_user_details(self, items):
+    @abstractmethod
+    def lease(self, worker, duration):
         """
-        For a given set of crawled users, retrieves additional information using the Twitter REST API
-        :param items: A list of user dictionarities
-        :return: An updated list with additional fields of User dictionaries
+        :return: A pending work unit, or one whose lease ran out, now leased to the worker for duration seconds.
+                 None if there is none.
         """
-        # The user lookup API limit per request is 100
-        step = 100
 
-        import twitter
-        api = twitter.Api(consumer_key=TWITTER_REST_API_CONSUMER_KEY,
-                          consumer_secret=TWITTER_REST_API_CONSUMER_SECRET,
-                          access_token_key=TWITTER_REST_API_ACCESS_TOKEN,
-                          access_token_secret=TWITTER_REST_API_ACCESS_TOKEN_SECRET)
+    @abstractmethod
+    def heartbeat(self, unit_id, worker, duration, state=None):
+        """
+        Renews the lease of a unit
+        :param state: The checkpoint of the search of the unit, a dict of max_position, counter, last_id and offset
+        :return: False if the worker no longer holds the lease
+        """
 
-        for i in range(0, len(items), step):
-            statuses = api.UsersLookup(screen_name=[item["screen_name"] for item in items[i:step]])
-            for j in range(min(len(statuses), step)):
-                items[i + j] = {**items[i + j], **statuses[j].AsDict()}
+    @abstractmethod
+    def complete(self, unit_id, worker):
+        """
+        :return: False if the worker no longer holds the lease
+        """
 
-        return items
+    @abstractmethod
+    def release(self, unit_id, worker, max_attempts=MAX_UNIT_ATTEMPTS):
+        """
+        Gives up a unit after a failure, for another worker to retry unless it failed too many times
+        """
 
+    @abstractmethod
+    def progress(self):
+        """
+        :return: A dict of the number of units in each state, pending, leased, done and failed, and of items saved
+        """
 
-class TwitterSearchImpl(TwitterSearch):
-    def __init__(self, session, rate_delay, error_delay, max_items, filepath, useragent_cache_path=fake_useragent_settings.DB):
+    @abstractmethod
+    def units(self):
         """
-        :param rate_delay: How long to pause between calls to Twitter
-        :param error_delay: How long to pause when an error occurs
-        :param max_items: Maximum number of items to collect for this example
+        :return: Every unit, in merge order
         """
-        super(TwitterSearchImpl, self).__init__(session, rate_delay, error_delay, useragent_cache_path)
-        self.max_items = max_items
-        self.counter = 0
-        self.filepath = filepath
-        self.jsonl_file = None
 
-    def search(self, query, target_type, **kwargs):
-        # Specify a user agent to prevent Twitter from returning a profile card
-        headers = {
-            'Accept': 'application/json, text/javascript, */*; q=0.01',
-            'Referer': 'https://twitter.com/search',
-            'User-Agent': self.UA.random,
-            'X-Twitter-Active-User': 'yes',
-            'X-Requested-With': 'XMLHttpRequest'
-        }
-        self.session.headers.update(headers)
+    def close(self):
+        pass
 
-        self.jsonl_file = io.open(self.filepath, 'w', encoding='utf-8')
-        super(TwitterSearchImpl, self).search(query, target_type=target_type, **kwargs)
-        self.jsonl_file.close()
 
-    def save_items(self, items):
+class SqliteWorkQueue(WorkQueue):
+    def __init__(self, filepath, create=True):
         """
-        Just prints out items
-        :return:
+        A work queue in a SQLite database, for workers on the same machine or sharing a file system that supports
+        SQLite locking
+        :param filepath: Path of the database
+        :param create: Create the database if it is missing, rather than raising a ValueError
         """
-        for item in items:
-            # Lets add a counter so we only collect a max number of items
-            self.counter += 1
+        if not create and not path.isfile(filepath):
+            raise ValueError("%s : No such work queue" % filepath)
+        self.filepath = filepath
+        self.lock = threading.Lock()
+        self.db = sqlite3.connect(filepath, timeout=60, check_same_thread=False, isolation_level=None)
+        with self.lock:
+            self.db.execute("CREATE TABLE IF NOT EXISTS units ("
+                            "id INTEGER PRIMARY KEY, key TEXT UNIQUE, output TEXT, part TEXT, query TEXT, "
+                            "options TEXT, state TEXT NOT NULL DEFAULT 'pending', worker TEXT, lease_until REAL, "
+                            "attempts INTEGER NOT NULL DEFAULT 0, max_position TEXT, counter INTEGER, last_id TEXT, "
+                            "offset INTEGER, updated REAL)")
+            self.db.execute("CREATE INDEX IF NOT EXISTS units_state ON units (state, lease_until)")
+            self.db.execute("CREATE TABLE IF NOT EXISTS queue (name TEXT PRIMARY KEY, value TEXT)")
+
+    def transaction(self, statements):
+        """
+        Runs statements, a function of the connection, in a transaction holding the write lock from the start, so
+        that two workers never lease the same unit
+        """
+        with self.lock:
+            self.db.execute("BEGIN IMMEDIATE")
+            try:
+                result = statements(self.db)
+            except BaseException:
+                self.db.execute("ROLLBACK")
+                raise
+            self.db.execute("COMMIT")
+            return result
+
+    def add(self, units):
+        def statements(db):
+            db.executemany(
+                "INSERT OR IGNORE INTO units (key, output, part, query, options, updated) VALUES (?, ?, ?, ?, ?, ?)",
+                [(unit['key'], unit['output'], unit['part'], unit['query'], json.dumps(unit['options']), time())
+                 for unit in units])
+            db.execute("DELETE FROM queue WHERE name = 'closed'")
+        self.transaction(statements)
+
+    def mark_closed(self):
+        self.transaction(lambda db: db.execute("INSERT OR REPLACE INTO queue VALUES ('closed', ?)", (str(time()),)))
+
+    def is_closed(self):
+        with self.lock:
+            return self.db.execute("SELECT 1 FROM queue WHERE name = 'closed'").fetchone() is not None
 
-            if six.PY2:
-                data = json.dumps(item, ensure_ascii=False, encoding='utf-8')
+    def lease(self, worker, duration):
+        def statements(db):
+            now = time()
+            row = db.execute("SELECT id FROM units WHERE state = 'pending' OR (state = 'leased' AND lease_until < ?) "
+                             "ORDER BY id LIMIT 1", (now,)).fetchone()
+            if row is None:
+                return None
+            db.execute("UPDATE units SET state = 'leased', worker = ?, lease_until = ?, attempts = attempts + 1, "
+                       "updated = ? WHERE id = ?", (worker, now + duration, now, row[0]))
+            return self.unit(db, row[0])
+        return self.transaction(statements)
+
+    @staticmethod
+    def unit(db, unit_id):
+        row = db.execute("SELECT id, key, output, part, query, options, state, worker, attempts, max_position, "
+                         "counter, last_id, offset FROM units WHERE id = ?", (unit_id,)).fetchone()
+        unit = dict(zip(('id', 'key', 'output', 'part', 'query', 'options', 'state', 'worker', 'attempts',
+                         'max_position', 'counter', 'last_id', 'offset'), row))
+        unit['options'] = json.loads(unit['options'])
+        return unit
+
+    def heartbeat(self, unit_id, worker, duration, state=None):
+        def statements(db):
+            now = time()
+            if state is None:
+                cursor = db.execute("UPDATE units SET lease_until = ?, updated = ? "
+                                    "WHERE id = ? AND worker = ? AND state = 'leased'",
+                                    (now + duration, now, unit_id, worker))
             else:
-                data = json.dumps(item, ensure_ascii=False)
+                cursor = db.execute("UPDATE units SET lease_until = ?, updated = ?, max_position = ?, counter = ?, "
+                                    "last_id = ?, offset = ? WHERE id = ? AND worker = ? AND state = 'leased'",
+                                    (now + duration, now, state['max_position'], state['counter'],
+                                     state['last_id'], state['offset'], unit_id, worker))
+            return cursor.rowcount == 1
+        return self.transaction(statements)
 
-            self.jsonl_file.write(data + '\n')
+    def complete(self, unit_id, worker):
+        return self.transaction(lambda db: db.execute(
+            "UPDATE units SET state = 'done', lease_until = NULL, updated = ? "
+            "WHERE id = ? AND worker = ? AND state = 'leased'", (time(), unit_id, worker)).rowcount == 1)
 
-            if self.counter % PROGRESS_PER == 0:
-                logger.info("%s : %i items saved to file.", self.filepath, self.counter)
+    def release(self, unit_id, worker, max_attempts=MAX_UNIT_ATTEMPTS):
+        self.transaction(lambda db: db.execute(
+            "UPDATE units SET state = CASE WHEN attempts >= ? THEN 'failed' ELSE 'pending' END, lease_until = NULL, "
+            "updated = ? WHERE id = ? AND worker = ? AND state = 'leased'", (max_attempts, time(), unit_id, worker)))
+
+    def progress(self):
+        with self.lock:
+            progress = {'pending': 0, 'leased': 0, 'done': 0, 'failed': 0}
+            progress.update(self.db.execute("SELECT state, COUNT(*) FROM units GROUP BY state").fetchall())
+            progress['items'] = self.db.execute("SELECT COALESCE(SUM(counter), 0) FROM units").fetchone()[0]
+            return progress
+
+    def units(self):
+        with self.lock:
+            return [self.unit(self.db, row[0]) for row in self.db.execute("SELECT id FROM units ORDER BY id")]
+
+    def close(self):
+        with self.lock:
+            self.db.close()
+
+
+WORK_QUEUES = {
+    'sqlite': SqliteWorkQueue,
+}
 
-            # When we've reached our max limit, return False so collection stops
-            if self.max_items is not None and self.counter >= self.max_items:
-                return False
 
+def open_work_queue(spec, create=True):
+    """
+    :param spec: Path of a SQLite work queue, or backend://location for any backend of WORK_QUEUES
+    :param create: Create the queue if it does not exist yet, as the coordinator does. Workers only open existing
+                   queues, so that a mistyped path is an error rather than a new queue no coordinator fills.
+    :return: The WorkQueue
+    """
+    backend, separator, location = spec.partition('://')
+    if not separator:
+        backend, location = 'sqlite', spec
+    if backend not in WORK_QUEUES:
+        raise ValueError("Unknown work queue backend %s, use one of %s" % (backend, ", ".join(sorted(WORK_QUEUES))))
+    return WORK_QUEUES[backend](location, create=create)
+
+
+class WorkUnitCheckpoint(object):
+    def __init__(self, queue, unit, worker, lease):
+        """
+        The checkpoint store of the search of a work unit: the progress of the search goes to the queue, renewing the
+        lease of the unit at every page
+        """
+        self.queue = queue
+        self.unit = unit
+        self.worker = worker
+        self.lease = lease
+
+    def load(self, query):
+        if self.unit['offset'] is None:
+            return None
+        return {'max_position': self.unit['max_position'], 'counter': self.unit['counter'],
+                'last_id': self.unit['last_id'], 'offset': self.unit['offset'], 'done': False}
+
+    def save(self, query, max_position, counter, last_id, offset):
+        state = {'max_position': max_position, 'counter': counter, 'last_id': last_id, 'offset': offset}
+        if not self.queue.heartbeat(self.unit['id'], self.worker, self.lease, state):
+            raise LeaseLost("Work unit %i was handed to another worker" % self.unit['id'])
+
+    def empty(self):
+        # Each unit has a part file of its own
         return True
 
+    def finish(self, query):
+        pass
+
+
+def plan_work_units(jobs, since_date=None, until_date=None, unit_span=timedelta(days=DEFAULT_UNIT_DAYS),
+                    parts_dir=PARTS_DIR, sink=DEFAULT_SINK):
+    """
+    Splits the jobs of a crawl into work units, one per search window of unit_span, newest first
+    :param jobs: A list of (filepath, query, search keyword arguments) tuples
+    :param since_date: Start of the crawl window, each job is a single unit if None
+    :param parts_dir: Directory of the part files of the units
+    :return: A list of work units in merge order, see WorkQueue.add
+    """
+    units = []
+    for filepath, query, kwargs in jobs:
+        windows = [None]
+        if since_date is not None:
+            windows = []
+            end = until_date
+            while end > since_date:
+                windows.append(DateShard(len(windows), max(end - unit_span, since_date), end))
+                end = windows[-1].start
+
+        for window in windows:
+            unit_query = window.query(query) if window is not None else query
+            key = "%s\n%s" % (path.abspath(filepath), unit_query)
+            part = path.join(path.abspath(parts_dir),
+                             hashlib.sha1(key.encode('utf-8')).hexdigest()[:20] + SINKS[sink].extension)
+            units.append({'key': key, 'output': path.abspath(filepath), 'part': part, 'query': unit_query,
+                          'options': dict(kwargs, sink=sink)})
+    return units
+
+
+def coordinate(queue, units, poll_interval=QUEUE_POLL_INTERVAL):
+    """
+    Adds the work units of a crawl to the queue, waits for workers to get through them, closes the queue and merges
+    the parts of the units into the outputs of the crawl
+    :return: The number of units that failed
+    """
+    parts = set(path.dirname(unit['part']) for unit in units)
+    for dirpath in parts:
+        if not path.isdir(dirpath):
+            os.makedirs(dirpath)
+    queue.add(units)
+    logger.info("%i work units queued, waiting for workers.", len(units))
+
+    while True:
+        progress = queue.progress()
+        logger.info("Work units: %i pending, %i leased, %i done, %i failed. %i items saved.", progress['pending'],
+                    progress['leased'], progress['done'], progress['failed'], progress['items'])
+        if progress['pending'] == 0 and progress['leased'] == 0:
+            break
+        sleep(poll_interval)
+
+    # Lets the idle workers go
+    queue.mark_closed()
+    return merge_work_units(queue.units())
+
+
+def merge_work_units(units):
+    """
+    Concatenates the parts of the work units of each output, in order, once all of them are done. Concatenated
+    JSON lines, gzip members and zstd frames are valid files of their own kind.
+    :return: The number of units that failed
+    """
+    outputs = {}
+    for unit in units:
+        outputs.setdefault(unit['output'], []).append(unit)
+
+    failed = 0
+    for output, output_units in outputs.items():
+        missing = [unit for unit in output_units if unit['state'] != 'done']
+        if missing:
+            failed += len(missing)
+            logger.error("%s : %i work units failed, not merged, e.g. %s", output, len(missing), missing[0]['query'])
+            continue
+
+        with io.open(output + '.tmp', 'wb') as output_file:
+            for unit in output_units:
+                if path.isfile(unit['part']):
+                    with io.open(unit['part'], 'rb') as part_file:
+                        shutil.copyfileobj(part_file, output_file, MERGE_CHUNK_SIZE)
+        os.replace(output + '.tmp', output)
+        logger.info("%s : %i work units merged.", output, len(output_units))
+    return failed
+
+
+def run_worker(queue, session, rate_delay, error_delay, useragent_cache_path=None,
+               parser=DEFAULT_PARSER, base_url=DEFAULT_BASE_URL, worker_id=None, lease=DEFAULT_LEASE,
+               max_attempts=MAX_UNIT_ATTEMPTS, poll_interval=QUEUE_POLL_INTERVAL, enricher=None, wait=None,
+               **search_options):
+    """
+    Leases work units from the queue and searches them, until the coordinator closes the queue and none is left.
+    Workers started before the coordinator filled the queue wait for its units.
+    :param worker_id: Name of the worker in the queue, the host name and process id if None
+    :param lease: Seconds a unit is held for between two heartbeats
+    :param wait: Seconds an idle worker waits for a unit before it stops, until the queue is closed if None
+    :param search_options: Other keyword arguments of TwitterSearchImpl, such as page_cache
+    :return: The number of units searched
+    """
+    if not worker_id:
+        import socket
+        worker_id = "%s-%i" % (socket.gethostname(), os.getpid())
+    useragent = UserAgentPool.shared(useragent_cache_path)
+    searched = 0
+    idle_since = None
+    while True:
+        unit = queue.lease(worker_id, lease)
+        if unit is None:
+            progress = queue.progress()
+            if progress['pending'] == 0 and progress['leased'] == 0 and queue.is_closed():
+                logger.info("%s : Work queue closed, %i work units searched.", worker_id, searched)
+                return searched
+            if idle_since is None:
+                idle_since = time()
+                logger.info("%s : Waiting for work units.", worker_id)
+            elif wait is not None and time() - idle_since >= wait:
+                logger.info("%s : No work unit for %i seconds, stopping. %i work units searched.", worker_id, wait,
+                            searched)
+                return searched
+            # Units leased by other workers come back if their lease runs out
+            sleep(poll_interval)
+            continue
+        idle_since = None
+
+        options = dict(unit['options'])
+        sink = options.pop('sink', DEFAULT_SINK)
+        if options.get('user_stats') and enricher is None:
+            enricher = UserEnricher()
+        twit = TwitterSearchImpl(session, rate_delay, error_delay, None, unit['part'], useragent=useragent,
+                                 parser=parser, base_url=base_url, enricher=enricher, sink=sink,
+                                 checkpoint_store=WorkUnitCheckpoint(queue, unit, worker_id, lease), **search_options)
+
+        # Keeps the lease while a page takes long, e.g. while Twitter throttles the worker
+        stop_event = threading.Event()
+
+        def renew(unit_id):
+            while not stop_event.wait(lease / 3.0):
+                if not queue.heartbeat(unit_id, worker_id, lease):
+                    return
+        heartbeat = threading.Thread(target=renew, args=(unit['id'],), daemon=True)
+        heartbeat.start()
+
+        logger.info("%s : Work unit %i, attempt %i : %s", worker_id, unit['id'], unit['attempts'], unit['query'])
+        try:
+            completed = twit.search(unit['query'], **options)
+        except LeaseLost as e:
+            logger.warning("%s : %s", worker_id, e)
+            continue
+        except Exception as e:
+            logger.exception("%s : Work unit %i failed: %s", worker_id, unit['id'], e)
+            completed = False
+        finally:
+            stop_event.set()
+            heartbeat.join()
+
+        if completed:
+            queue.complete(unit['id'], worker_id)
+            searched += 1
+        else:
+            queue.release(unit['id'], worker_id, max_attempts)
+
 
 def twitter_search(search_terms=None, since=None, until=None, language=None, accounts=None, search_filter=None,
                    target_type=DEFAULT_TARGET_TYPE,
                    rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY, user_stats=False,
                    limit=DEFAULT_LIMIT,
-                   output_dir=".", output_file=None, useragent_cache_path=fake_useragent_settings.DB):
-    session = requests.Session()
+                   output_dir=".", output_file=None, useragent_cache_path=None,
+                   workers=DEFAULT_SHARD_WORKERS, shard=None, use_async=False,
+                   concurrency=DEFAULT_ASYNC_CONCURRENCY, parser=DEFAULT_PARSER, parse_workers=0, resume=False,
+                   sink=DEFAULT_SINK, sink_batch_size=DEFAULT_SINK_BATCH_SIZE, row_group_size=DEFAULT_ROW_GROUP_SIZE,
+                   dedup_index=None, stop_on_duplicates=False, max_rate=DEFAULT_MAX_RATE, http2=False,
+                   connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                   base_url=DEFAULT_BASE_URL, user_cache=None, user_lookup_workers=DEFAULT_USER_LOOKUP_WORKERS,
+                   incremental=False, follow=False, state_index=None, poll_min=DEFAULT_POLL_MIN,
+                   poll_max=DEFAULT_POLL_MAX, page_cache=None, page_cache_size=DEFAULT_PAGE_CACHE_SIZE,
+                   page_cache_ttl=DEFAULT_PAGE_CACHE_TTL, reparse=False, metrics_file=None, metrics_port=None,
+                   metrics_host=DEFAULT_METRICS_HOST, metrics_interval=0, coordinator=None,
+                   unit_days=DEFAULT_UNIT_DAYS, lang=None, pack_accounts=False,
+                   account_workers=DEFAULT_ACCOUNT_WORKERS):
+    # Sharded searches add their own since: and until: operators to each slice
+    if workers > 1 and shard is None:
+        shard = 'day'
+
+    if shard is not None and use_async:
+        logger.error("Sharded search is not available with --async")
+        sys.exit(1)
+
+    if reparse and not page_cache:
+        logger.error("Reparsing requires --page_cache")
+        sys.exit(1)
+
+    if reparse and (incremental or follow):
+        logger.error("Incremental crawls can not be reparsed")
+        sys.exit(1)
+
+    # Reparsing replays cached pages, there is no point in waiting between them but parsing can use every core
+    if reparse:
+        rate_delay = 0
+        if not parse_workers and shard is None and not use_async:
+            parse_workers = os.cpu_count() or 1
 
-    search_str = ""
+    if parse_workers and (shard is not None or use_async):
+        logger.error("Parsing processes are only available for plain searches")
+        sys.exit(1)
 
-    if search_terms:
-        search_str = " ".join(search_terms)
+    if resume and shard is not None:
+        logger.error("Sharded search can not be resumed")
+        sys.exit(1)
 
-    if since:
-        search_str += " since:" + since
+    if resume and sink == 'parquet':
+        logger.error("Parquet output can not be resumed")
+        sys.exit(1)
 
-    if until:
-        search_str += " until:" + until
+    if output_file == STDOUT and (resume or incremental or follow or sink == 'parquet'):
+        logger.error("The standard output can not be resumed, appended to, or written Parquet to")
+        sys.exit(1)
 
-    if search_filter:
-        search_str += " filter:" + search_filter
+    # Following accounts crawls them incrementally, over and over
+    incremental = incremental or follow
+    if incremental and not accounts:
+        logger.error("Incremental crawls require --accounts")
+        sys.exit(1)
 
+    if incremental and (shard is not None or use_async or resume or sink == 'parquet'):
+        logger.error("Incremental crawls are only available for plain searches to JSON lines outputs")
+        sys.exit(1)
+
+    if coordinator and (shard is not None or use_async or resume or incremental or reparse or dedup_index or
+                        sink == 'parquet' or output_file == STDOUT):
+        logger.error("Distributed crawls are only available for plain searches to JSON lines files")
+        sys.exit(1)
+
+    # The tweets of a group of accounts come out of a single search, they can only be written out anew
+    if pack_accounts and (use_async or resume or incremental or coordinator or target_type != DEFAULT_TARGET_TYPE):
+        logger.error("Packed accounts are only available for new crawls of tweets, without --async")
+        sys.exit(1)
+
+    # Searches run side by side need outputs of their own
+    if account_workers > 1 and (shard is not None or use_async or coordinator or output_file):
+        logger.error("Parallel account searches are only available for plain searches to --output_dir")
+        sys.exit(1)
+
+    writer_options = {
+        'sink': sink,
+        'sink_options': {'batch_size': sink_batch_size, 'row_group_size': row_group_size},
+        'stop_on_duplicates': stop_on_duplicates,
+    }
+
+    # Distributed crawls split the --since/--until window between their work units
+    if shard is not None or (coordinator and since):
+        if not since:
+            logger.error("Sharded search requires --since")
+            sys.exit(1)
+        since_date = parse_search_date(since)
+        until_date = parse_search_date(until) if until else \
+            datetime.utcnow().replace(hour=0, minute=0, second=0, microsecond=0) + timedelta(days=1)
+    else:
+        since_date = until_date = None
+    search_query = SearchQuery(search_terms, search_filter=search_filter, lang=lang,
+                               since=since if since_date is None else None,
+                               until=until if since_date is None else None)
+
+    # Each job is an output file, a query and the keyword arguments of its search
+    jobs = []
     if not accounts:
         if not search_terms:
             logger.error("Nothing to search")
@@ -464,43 +4001,390 @@ def twitter_search(search_terms=None, since=None, until=None, language=None, acc
             logger.error("No output_file specified")
             sys.exit(1)
         else:
-            filepath = path.join(output_dir, output_file)
-            twit = TwitterSearchImpl(session, rate_delay, error_delay,
-                                     limit, filepath, useragent_cache_path=useragent_cache_path)
-            logger.info("Search : %s", search_str)
-            twit.search(search_str, target_type=target_type, user_stats=user_stats, language=language)
+            filepath = output_file if output_file == STDOUT else path.join(output_dir, output_file)
+            jobs.append((filepath, str(search_query), {'target_type': target_type, 'user_stats': user_stats,
+                                                       'language': language, 'parse_workers': parse_workers}))
     else:
         if not path.isdir(output_dir) and not output_file:
             logger.error('Output directory does not exist.')
             sys.exit(1)
 
+        filepaths = {}
         for act in accounts:
             if output_file:
                 filepath = output_file
             else:
-                filepath = path.join(output_dir, act + '.jsonl')
-                # do not overwrite existing files in output directory
+                filepath = path.join(output_dir, act + SINKS[sink].extension)
+                # do not overwrite existing files in output directory, unless a checkpoint says where to resume
                 try:
-                    if path.getsize(filepath) > 0:
+                    resumable = incremental or (resume and path.isfile(filepath + CHECKPOINT_SUFFIX))
+                    if not resumable and path.getsize(filepath) > 0:
                         logger.error('%s : File already has content.', filepath)
                         continue
                 except OSError:
                     pass
 
-            twit = TwitterSearchImpl(session, rate_delay, error_delay,
-                                     limit, filepath, useragent_cache_path=useragent_cache_path)
-            search_str_from = search_str + " from:" + act
-            logger.info("Search : %s", search_str_from)
-            twit.search(search_str_from, target_type=DEFAULT_TARGET_TYPE, language=language)
+            if pack_accounts:
+                filepaths[act] = filepath
+                continue
+            jobs.append((filepath, str(search_query.with_accounts([act])),
+                         {'target_type': DEFAULT_TARGET_TYPE, 'user_stats': user_stats, 'language': language,
+                          'parse_workers': parse_workers}))
+
+        # Packed accounts share their searches, whose tweets are split back out to the output of each account
+        for query in search_query.pack(list(filepaths)) if filepaths else []:
+            filepath = output_file or dict((act.lower(), filepaths[act]) for act in query.accounts)
+            jobs.append((filepath, str(query), {'target_type': DEFAULT_TARGET_TYPE, 'user_stats': user_stats,
+                                                'language': language, 'parse_workers': parse_workers}))
+
+    if coordinator:
+        try:
+            queue = open_work_queue(coordinator)
+        except ValueError as e:
+            logger.error("%s", e)
+            sys.exit(1)
+        try:
+            units = plan_work_units(jobs, since_date, until_date, timedelta(days=unit_days),
+                                    path.join(output_dir, PARTS_DIR), sink)
+            failed = coordinate(queue, units)
+        finally:
+            queue.close()
+        if failed:
+            sys.exit(1)
+        return
+
+    if dedup_index:
+        writer_options['dedup_index'] = IdIndex(dedup_index)
+
+    # A single enricher, so that users are looked up once across every job
+    enricher = None
+    if user_stats:
+        enricher = UserEnricher(cache=UserCache(user_cache) if user_cache else None, workers=user_lookup_workers)
+
+    state = None
+    if incremental:
+        state = IncrementalState(state_index or path.join(output_dir, INCREMENTAL_STATE_FILE))
+
+    # Incremental crawls are after new tweets, so they keep their pages without ever being served old ones
+    cache = None
+    if page_cache:
+        cache = PageCache(page_cache, max_size=page_cache_size, ttl=0 if incremental else page_cache_ttl)
+
+    governor = RateGovernor.shared()
+    governor.max_rate = max_rate
+
+    reporter = None
+    if metrics_file or metrics_port is not None or metrics_interval:
+        reporter = MetricsReporter(METRICS, interval=metrics_interval, filepath=metrics_file, port=metrics_port,
+                                   host=metrics_host)
+
+    def run(jobs):
+        run_jobs(jobs, rate_delay, error_delay, limit, useragent_cache_path, parser, resume, writer_options,
+                 use_async=use_async, concurrency=concurrency, workers=workers, shard=shard,
+                 since_date=since_date, until_date=until_date, http2=http2, connect_timeout=connect_timeout,
+                 read_timeout=read_timeout, base_url=base_url, enricher=enricher, state=state, page_cache=cache,
+                 offline=reparse, account_workers=account_workers)
+
+    try:
+        if follow and jobs:
+            follow_jobs(jobs, state, run, poll_min=poll_min, poll_max=poll_max)
+        else:
+            run(jobs)
+    finally:
+        if state is not None:
+            state.close()
+        if cache is not None:
+            cache.close()
+        if dedup_index:
+            writer_options['dedup_index'].close()
+        if enricher is not None:
+            logger.info("%i user lookups made.", enricher.lookups)
+            enricher.close()
+        if reporter is not None:
+            reporter.close()
+
+
+def twitter_worker(queue, rate_delay=DEFAULT_RATE_DELAY, error_delay=DEFAULT_ERROR_DELAY,
+                   useragent_cache_path=None, parser=DEFAULT_PARSER, max_rate=DEFAULT_MAX_RATE,
+                   http2=False, connect_timeout=DEFAULT_CONNECT_TIMEOUT, read_timeout=DEFAULT_READ_TIMEOUT,
+                   base_url=DEFAULT_BASE_URL, user_cache=None, user_lookup_workers=DEFAULT_USER_LOOKUP_WORKERS,
+                   page_cache=None, page_cache_size=DEFAULT_PAGE_CACHE_SIZE, page_cache_ttl=DEFAULT_PAGE_CACHE_TTL,
+                   metrics_file=None, metrics_port=None, metrics_host=DEFAULT_METRICS_HOST, metrics_interval=0,
+                   worker_id=None, lease=DEFAULT_LEASE, wait=None):
+    """
+    Runs a worker of a distributed crawl, searching the work units of the queue a coordinator fills until it closes
+    the queue. Takes the keyword arguments of twitter_search that are about how to search rather than what to search.
+    :param queue: The work queue, see open_work_queue. It has to exist already.
+    :param wait: Seconds an idle worker waits for a unit before it stops, until the queue is closed if None
+    """
+    try:
+        work_queue = open_work_queue(queue, create=False)
+    except ValueError as e:
+        logger.error("%s", e)
+        sys.exit(1)
+
+    governor = RateGovernor.shared()
+    governor.max_rate = max_rate
+    reporter = None
+    if metrics_file or metrics_port is not None or metrics_interval:
+        reporter = MetricsReporter(METRICS, interval=metrics_interval, filepath=metrics_file, port=metrics_port,
+                                   host=metrics_host)
+    cache = PageCache(page_cache, max_size=page_cache_size, ttl=page_cache_ttl) if page_cache else None
+    enricher = UserEnricher(cache=UserCache(user_cache) if user_cache else None, workers=user_lookup_workers)
+    session = Transport(connect_timeout=connect_timeout, read_timeout=read_timeout, http2=http2)
+    try:
+        run_worker(work_queue, session, rate_delay, error_delay, useragent_cache_path=useragent_cache_path,
+                   parser=parser, base_url=base_url, worker_id=worker_id, lease=lease, enricher=enricher,
+                   wait=wait, page_cache=cache)
+    finally:
+        session.close()
+        enricher.close()
+        if cache is not None:
+            cache.close()
+        if reporter is not None:
+            reporter.close()
+        work_queue.close()
+
+
+def run_jobs(jobs, rate_delay, error_delay, limit, useragent_cache_path, parser, resume, writer_options,
+             use_async=False, concurrency=DEFAULT_ASYNC_CONCURRENCY, workers=DEFAULT_SHARD_WORKERS, shard=None,
+             since_date=None, until_date=None, http2=False, connect_timeout=DEFAULT_CONNECT_TIMEOUT,
+             read_timeout=DEFAULT_READ_TIMEOUT, base_url=DEFAULT_BASE_URL, enricher=None, state=None, page_cache=None,
+             offline=False, account_workers=DEFAULT_ACCOUNT_WORKERS):
+    """
+    Runs the jobs built by twitter_search
+    :param jobs: A list of (filepath, query, search keyword arguments) tuples
+    :param writer_options: Output keyword arguments of TwitterSearchImpl
+    :param enricher: The UserEnricher of user_stats searches
+    :param state: The IncrementalState of an incremental crawl, whose searches only add items newer than the last run
+    :param page_cache: A PageCache serving and keeping the pages of the searches
+    :param offline: Only replay the pages in page_cache
+    :param account_workers: Number of jobs searched at the same time, see run_parallel_jobs
+    """
+    if use_async:
+        import asyncio
+
+        asyncio.run(async_twitter_search(jobs, rate_delay=rate_delay, error_delay=error_delay, limit=limit,
+                                         concurrency=concurrency, useragent_cache_path=useragent_cache_path,
+                                         parser=parser, resume=resume, connect_timeout=connect_timeout,
+                                         read_timeout=read_timeout, base_url=base_url, enricher=enricher,
+                                         page_cache=page_cache, offline=offline, **writer_options))
+        return
+
+    session = Transport(pool_size=max(workers, account_workers, 1), connect_timeout=connect_timeout,
+                        read_timeout=read_timeout, http2=http2)
+    sharded = None
+    if shard is not None:
+        sharded = ShardedTwitterSearch(session, rate_delay, error_delay, workers=workers, granularity=shard,
+                                       parser=parser, base_url=base_url, page_cache=page_cache, offline=offline)
+
+    checkpoint_stores = {}
+
+    def open_job(filepath, query, stop_event=None):
+        if resume and filepath not in checkpoint_stores:
+            checkpoint_stores[filepath] = CrawlCheckpoint.for_output(filepath)
+        incremental_options = state.writer_options(query, filepath, SINKS[writer_options['sink']]) \
+            if state is not None else {}
+        return TwitterSearchImpl(session, rate_delay, error_delay,
+                                 limit, filepath, useragent_cache_path=useragent_cache_path, parser=parser,
+                                 checkpoint_store=checkpoint_stores.get(filepath) if resume else None,
+                                 base_url=base_url, enricher=enricher, page_cache=page_cache, offline=offline,
+                                 stop_event=stop_event, **writer_options, **incremental_options)
+
+    try:
+        if account_workers > 1 and sharded is None:
+            run_parallel_jobs(jobs, open_job, account_workers, state=state)
+            return
+
+        for filepath, query, kwargs in jobs:
+            twit = open_job(filepath, query)
+            logger.info("Search : %s", query)
+            if sharded is None:
+                completed = twit.search(query, **kwargs)
+                if state is not None and completed:
+                    state.finish(query, filepath, twit.newest_id, twit.newest_epoch, twit.counter)
+                elif state is not None:
+                    state.failed(query)
+                continue
+
+            sharded.UA = twit.UA
+            twit.update_session_headers()
+            twit.open_output()
+            try:
+                sharded.search(query, since_date, until_date, twit, **kwargs)
+            finally:
+                twit.finish_output(query, True)
+    finally:
+        session.close()
+
+
+def expected_length(query, filepath=None, state=None):
+    """
+    A rough guess of how long the search of a query takes, to start the longest searches of a crawl first.
+    Incremental crawls expect as many items as the accounts made since their last crawl. Other searches expect as
+    many as their existing output holds, e.g. when resumed, then as many as the number of accounts they pack, and
+    searches that look alike keep their order.
+    :param filepath: Path of the output of the search, or a dict of paths by screen name for packed accounts
+    :param state: The IncrementalState of an incremental crawl, whose searches only go back to their last crawl
+    :return: A key to sort queries by, higher for longer searches
+    """
+    if state is None:
+        filepaths = list(filepath.values()) if isinstance(filepath, dict) else [filepath]
+        # Compressed outputs shrink alike, their size compares as well as their number of lines
+        saved = sum(path.getsize(filepath) for filepath in filepaths
+                    if filepath is not None and filepath != STDOUT and path.isfile(filepath))
+        return saved, max(query.count("from:"), 1)
+    last = state.load(query)
+    if last is None or last['crawled'] is None:
+        # Never crawled, the search goes through the whole history of the accounts
+        return float('inf')
+    # Items expected since the last crawl
+    return (last['activity'] or 0) * (time() - last['crawled'])
+
+
+def run_parallel_jobs(jobs, open_job, workers, state=None, progress_interval=ACCOUNTS_PROGRESS_INTERVAL):
+    """
+    Searches jobs side by side on a pool of threads, each one writing to its own output, the longest searches first.
+    The searches share the session, and so its connection pool, and the rate governor.
+    :param jobs: A list of (filepath, query, search keyword arguments) tuples, with one output each
+    :param open_job: Called with the filepath, query and stop event of a job, returns its TwitterSearchImpl
+    :param workers: Number of jobs searched at the same time
+    :param state: The IncrementalState of an incremental crawl, only used from the calling thread
+    :param progress_interval: Seconds between two progress reports across every job
+    """
+    pending = deque(sorted(jobs, key=lambda job: expected_length(job[1], job[0], state), reverse=True))
+    stop_event = threading.Event()
+    running = {}
+    done_jobs = failed_jobs = items = 0
+    executor = ThreadPoolExecutor(max_workers=workers)
+
+    def top_up():
+        while pending and len(running) < workers:
+            filepath, query, kwargs = pending.popleft()
+            twit = open_job(filepath, query, stop_event)
+            logger.info("Search : %s", query)
+            running[executor.submit(twit.search, query, **kwargs)] = (filepath, query, twit)
+
+    try:
+        top_up()
+        while running:
+            done, _ = wait(running, timeout=progress_interval, return_when=FIRST_COMPLETED)
+            for future in done:
+                filepath, query, twit = running.pop(future)
+                completed = future.result()
+                done_jobs += 1
+                items += twit.counter
+                if not completed:
+                    failed_jobs += 1
+                if state is not None and completed:
+                    state.finish(query, filepath, twit.newest_id, twit.newest_epoch, twit.counter)
+                elif state is not None:
+                    state.failed(query)
+
+            top_up()
+            logger.info("Searches : %i of %i done, %i gave up, %i running. %i items saved, %.2f requests per second.",
+                        done_jobs, len(jobs), failed_jobs, len(running),
+                        items + sum(twit.counter for _, _, twit in running.values()), RateGovernor.shared().rate)
+    finally:
+        # Running searches stop at their next page, unfinished
+        stop_event.set()
+        executor.shutdown(wait=True)
+
+
+def follow_jobs(jobs, state, run, poll_min=DEFAULT_POLL_MIN, poll_max=DEFAULT_POLL_MAX):
+    """
+    Runs the jobs of an incremental crawl over and over until interrupted, the most active ones the most often
+    :param state: The IncrementalState of the crawl
+    :param run: Called with the list of jobs that are due
+    :param poll_min: Shortest time between two runs of a job, in seconds
+    :param poll_max: Longest time between two runs of a job, in seconds
+    """
+    logger.info("Following %i searches, interrupt to stop.", len(jobs))
+    try:
+        while True:
+            now = time()
+            due = [job for job in jobs if state.next_poll(job[1], poll_min, poll_max) <= now]
+            if due:
+                run(due)
+
+            next_poll = min(state.next_poll(job[1], poll_min, poll_max) for job in jobs)
+            logger.info("Next poll in %i seconds.", max(next_poll - time(), 0))
+            sleep(max(next_poll - time(), 0))
+    except KeyboardInterrupt:
+        logger.info("Stopped following.")
+
+
+class ThreadsProfiler(object):
+    """
+    Runs cProfile on the calling thread and on every thread started while it is enabled, such as the fetcher threads
+    of the searches, which fetch and parse the pages
+    """
+
+    def __init__(self):
+        import cProfile
+
+        self.profiles = [cProfile.Profile()]
+        self.lock = threading.Lock()
+
+    def enable(self):
+        threading.setprofile(self.profile_thread)
+        self.profiles[0].enable()
+
+    def disable(self):
+        threading.setprofile(None)
+        self.profiles[0].disable()
+
+    def profile_thread(self, frame, event, arg):
+        # Called on the first event of a new thread, which then gets a profiler of its own
+        import cProfile
+
+        sys.setprofile(None)
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Profilers built on sys.monitoring already follow every thread, and only one of them can run
+            return
+        with self.lock:
+            self.profiles.append(profile)
+
+    def stats(self, stream=None):
+        """
+        :return: The statistics of every thread profiled, merged into a pstats.Stats
+        """
+        import pstats
+
+        with self.lock:
+            profiles = list(self.profiles)
+        stats = pstats.Stats(profiles[0], stream=stream)
+        for profile in profiles[1:]:
+            stats.add(profile)
+        return stats
+
+
+def save_profile(profiler, filepath):
+    """
+    Saves the statistics of a ThreadsProfiler, to load with pstats or a viewer such as snakeviz, and logs the
+    costliest calls
+    """
+    report = io.StringIO()
+    stats = profiler.stats(stream=report)
+    stats.dump_stats(filepath)
+    stats.sort_stats('cumulative').print_stats(PROFILE_REPORT_LINES)
+    logger.info("Profile saved to %s\n%s", filepath, report.getvalue())
 
 
 def main():
+    import argparse
+
+    logging.basicConfig(format=LOG_FORMAT, level=logging.INFO)
     parser = argparse.ArgumentParser()
     parser.add_argument("--search", default=[], nargs='+')
     parser.add_argument("-f", default=DEFAULT_TARGET_TYPE, type=str)
     parser.add_argument("--user_stats", action="store_true", default=False, required=False)
     parser.add_argument('--accounts', nargs='+', required=False)
     parser.add_argument('-l', type=str, required=False)
+    parser.add_argument("--lang", type=str, help="Language of the tweets, as a lang: operator of the query")
     parser.add_argument("--filter", type=str)
     parser.add_argument("--since", type=str)
     parser.add_argument("--until", type=str)
@@ -508,15 +4392,139 @@ def main():
     parser.add_argument("--error_delay", type=int, default=DEFAULT_ERROR_DELAY)
     parser.add_argument("--limit", type=int, default=DEFAULT_LIMIT)
     parser.add_argument("--output_dir", type=str, default='.')
-    parser.add_argument("--output_file", type=str)
-    parser.add_argument("--fake_useragent_cache_path", type=str, default=fake_useragent_settings.DB)
+    parser.add_argument("--output_file", type=str, help="Output file, " + STDOUT + " for the standard output")
+    parser.add_argument("--fake_useragent_cache_path", type=str, default=None,
+                        help="Path of the fake_useragent database, its own default one if not given")
+    parser.add_argument("--workers", type=int, default=DEFAULT_SHARD_WORKERS,
+                        help="Number of date slices crawled at the same time")
+    parser.add_argument("--shard", type=str, choices=sorted(SHARD_GRANULARITIES),
+                        help="Split the --since/--until window into day or hour slices")
+    parser.add_argument("--async", dest="use_async", action="store_true", default=False,
+                        help="Run every search at once on an asyncio event loop (requires aiohttp)")
+    parser.add_argument("--concurrency", type=int, default=DEFAULT_ASYNC_CONCURRENCY,
+                        help="Maximum number of requests in flight with --async")
+    parser.add_argument("--parser", type=str, choices=sorted(PARSERS), default=DEFAULT_PARSER,
+                        help="HTML parser backend, lxml is several times faster than bs4")
+    parser.add_argument("--parse_workers", type=int, default=0,
+                        help="Parse pages on this many processes while the next pages are fetched")
+    parser.add_argument("--resume", action="store_true", default=False,
+                        help="Keep a checkpoint next to each output and resume interrupted searches from it")
+    parser.add_argument("--sink", type=str, choices=sorted(SINKS), default=DEFAULT_SINK,
+                        help="Output format: JSON lines, gzip or zstd compressed JSON lines, or Parquet")
+    parser.add_argument("--sink_batch_size", type=int, default=DEFAULT_SINK_BATCH_SIZE,
+                        help="Number of JSON lines written at once")
+    parser.add_argument("--row_group_size", type=int, default=DEFAULT_ROW_GROUP_SIZE,
+                        help="Number of rows per Parquet row group")
+    parser.add_argument("--dedup_index", type=str,
+                        help="Path of a persistent index of saved ids, items already in it are not saved again")
+    parser.add_argument("--stop_on_duplicates", action="store_true", default=False,
+                        help="Stop a search at the first page made only of items already in --dedup_index")
+    parser.add_argument("--max_rate", type=float, default=DEFAULT_MAX_RATE,
+                        help="Highest number of requests per second the rate governor grows to")
+    parser.add_argument("--http2", action="store_true", default=False,
+                        help="Use an HTTP/2 client (requires httpx[http2])")
+    parser.add_argument("--connect_timeout", type=float, default=DEFAULT_CONNECT_TIMEOUT)
+    parser.add_argument("--read_timeout", type=float, default=DEFAULT_READ_TIMEOUT)
+    parser.add_argument("--base_url", type=str, default=DEFAULT_BASE_URL,
+                        help="Scheme and host searches are sent to, e.g. the stand-in server of benchmark.py")
+    parser.add_argument("--user_cache", type=str, default=None,
+                        help="SQLite cache of the user profiles looked up with --user_stats, kept across runs")
+    parser.add_argument("--user_lookup_workers", type=int, default=DEFAULT_USER_LOOKUP_WORKERS,
+                        help="Number of user lookups sent at once with --user_stats")
+    parser.add_argument("--incremental", action="store_true", default=False,
+                        help="Only crawl tweets of --accounts newer than the last run, appending them to the output")
+    parser.add_argument("--follow", action="store_true", default=False,
+                        help="Keep crawling --accounts incrementally, polling the most active ones the most often")
+    parser.add_argument("--state_index", type=str, default=None,
+                        help="Where incremental crawls record the newest tweet of each account, "
+                             "output_dir/" + INCREMENTAL_STATE_FILE + " by default")
+    parser.add_argument("--poll_min", type=float, default=DEFAULT_POLL_MIN,
+                        help="Shortest time between two polls of an account with --follow, in seconds")
+    parser.add_argument("--poll_max", type=float, default=DEFAULT_POLL_MAX,
+                        help="Longest time between two polls of an account with --follow, in seconds")
+    parser.add_argument("--page_cache", type=str, default=None,
+                        help="Directory keeping the raw pages of the searches, to crawl again or --reparse them")
+    parser.add_argument("--page_cache_size", type=int, default=DEFAULT_PAGE_CACHE_SIZE,
+                        help="Bytes of compressed pages kept in --page_cache, the oldest ones are dropped first")
+    parser.add_argument("--page_cache_ttl", type=float, default=DEFAULT_PAGE_CACHE_TTL,
+                        help="Seconds a cached page is served for instead of requesting it again")
+    parser.add_argument("--reparse", action="store_true", default=False,
+                        help="Parse the searches again from --page_cache only, without going to Twitter")
+    parser.add_argument("--metrics_file", type=str, default=None,
+                        help="File rewritten with the crawl metrics in the Prometheus text format")
+    parser.add_argument("--metrics_port", type=int, default=None,
+                        help="Serve the crawl metrics on http://--metrics_host:port/metrics")
+    parser.add_argument("--metrics_host", type=str, default=DEFAULT_METRICS_HOST,
+                        help="Address --metrics_port listens on, 0.0.0.0 to serve the metrics to other machines")
+    parser.add_argument("--metrics_interval", type=float, default=0,
+                        help="Log the crawl metrics as JSON, and rewrite --metrics_file, every this many seconds")
+    parser.add_argument("--coordinator", type=str, default=None,
+                        help="Queue the searches as work units in this work queue, a SQLite file, wait for --worker "
+                             "processes to search them and merge their outputs")
+    parser.add_argument("--worker", type=str, default=None,
+                        help="Search the work units of this existing work queue until its coordinator closes it, "
+                             "ignoring what to search")
+    parser.add_argument("--wait", type=float, default=None,
+                        help="Seconds a --worker waits for a work unit before it stops, until the queue is closed "
+                             "by default")
+    parser.add_argument("--unit_days", type=int, default=DEFAULT_UNIT_DAYS,
+                        help="Days of the --since/--until window searched by each work unit")
+    parser.add_argument("--lease", type=float, default=DEFAULT_LEASE,
+                        help="Seconds a worker holds a work unit for, another worker takes over unless it is renewed")
+    parser.add_argument("--worker_id", type=str, default=None,
+                        help="Name of the worker, its host name and process id by default")
+    parser.add_argument("--account_workers", type=int, default=DEFAULT_ACCOUNT_WORKERS,
+                        help="Number of --accounts searched at the same time, the longest searches first: the "
+                             "accounts with the most new tweets expected with --incremental, otherwise the ones with "
+                             "the largest existing output, then the largest groups of --pack_accounts")
+    parser.add_argument("--pack_accounts", action="store_true", default=False,
+                        help="Search as many --accounts at once as the query length allows, splitting their tweets "
+                             "back out to their own output, with --limit applying to each group of accounts")
+    parser.add_argument("--profile", type=str, default=None,
+                        help="Run under cProfile, on every thread, saving the statistics to this file and logging the "
+                             "costliest calls")
     args = parser.parse_args()
 
-    twitter_search(target_type=args.f, search_terms=args.search, since=args.since, until=args.until, language=args.l,
-                   accounts=args.accounts, search_filter=args.filter, rate_delay=args.rate_delay,
-                   error_delay=args.error_delay, limit=args.limit,
-                   output_dir=args.output_dir, output_file=args.output_file, user_stats=args.user_stats,
-                   useragent_cache_path=args.fake_useragent_cache_path)
+    profiler = None
+    if args.profile:
+        profiler = ThreadsProfiler()
+        profiler.enable()
+    try:
+        if args.worker:
+            twitter_worker(args.worker, rate_delay=args.rate_delay, error_delay=args.error_delay,
+                           useragent_cache_path=args.fake_useragent_cache_path, parser=args.parser,
+                           max_rate=args.max_rate, http2=args.http2, connect_timeout=args.connect_timeout,
+                           read_timeout=args.read_timeout, base_url=args.base_url, user_cache=args.user_cache,
+                           user_lookup_workers=args.user_lookup_workers, page_cache=args.page_cache,
+                           page_cache_size=args.page_cache_size, page_cache_ttl=args.page_cache_ttl,
+                           metrics_file=args.metrics_file, metrics_port=args.metrics_port,
+                           metrics_host=args.metrics_host, metrics_interval=args.metrics_interval,
+                           worker_id=args.worker_id, lease=args.lease, wait=args.wait)
+            return
+
+        twitter_search(target_type=args.f, search_terms=args.search, since=args.since, until=args.until,
+                       language=args.l, accounts=args.accounts, search_filter=args.filter, rate_delay=args.rate_delay,
+                       error_delay=args.error_delay, limit=args.limit,
+                       output_dir=args.output_dir, output_file=args.output_file, user_stats=args.user_stats,
+                       useragent_cache_path=args.fake_useragent_cache_path, workers=args.workers, shard=args.shard,
+                       use_async=args.use_async, concurrency=args.concurrency, parser=args.parser,
+                       parse_workers=args.parse_workers, resume=args.resume, sink=args.sink,
+                       sink_batch_size=args.sink_batch_size, row_group_size=args.row_group_size,
+                       dedup_index=args.dedup_index, stop_on_duplicates=args.stop_on_duplicates,
+                       max_rate=args.max_rate, http2=args.http2, connect_timeout=args.connect_timeout,
+                       read_timeout=args.read_timeout, base_url=args.base_url, user_cache=args.user_cache,
+                       user_lookup_workers=args.user_lookup_workers, incremental=args.incremental,
+                       follow=args.follow, state_index=args.state_index, poll_min=args.poll_min,
+                       poll_max=args.poll_max, page_cache=args.page_cache, page_cache_size=args.page_cache_size,
+                       page_cache_ttl=args.page_cache_ttl, reparse=args.reparse, metrics_file=args.metrics_file,
+                       metrics_port=args.metrics_port, metrics_host=args.metrics_host,
+                       metrics_interval=args.metrics_interval, coordinator=args.coordinator,
+                       unit_days=args.unit_days, lang=args.lang, pack_accounts=args.pack_accounts,
+                       account_workers=args.account_workers)
+    finally:
+        if profiler is not None:
+            profiler.disable()
+            save_profile(profiler, args.profile)
 
 
 if __name__ == '__main__':
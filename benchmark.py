@@ -0,0 +1,956 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import gc
+import os
+import re
+import sys
+import json
+import zlib
+import py_compile
+import random
+import argparse
+import logging
+import resource
+import shutil
+import subprocess
+import tempfile
+import threading
+import tracemalloc
+from time import perf_counter, sleep, time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import urlparse, parse_qs
+
+import TwitterScraper
+
+logger = logging.getLogger(__name__)
+
+DEFAULT_ITEMS = 100000
+DEFAULT_PAGES = 200
+DEFAULT_PAGE_SIZE = 20
+DEFAULT_QUERY_PAGES = 25
+DEFAULT_QUERIES = 4
+DEFAULT_LATENCY = 0.01
+DEFAULT_RATE = 1000.0
+DEFAULT_TOLERANCE = 0.2
+DEFAULT_ROUNDS = 3
+DEFAULT_SHARD_WORKERS = [1, 2, 4, 8]
+DEFAULT_LOOKUP_LATENCY = 0.1
+DEFAULT_IMPORT_BUDGET_MS = 50.0
+DEFAULT_STARTUP_RUNS = 5
+DEFAULT_QUEUE_WORKERS = 4
+DEFAULT_BENCH_LEASE = 2.0  # Seconds before the work unit of a killed worker goes to another one
+COORDINATOR_POLL_INTERVAL = 0.2
+# Runs TwitterScraper.py with its rate governor starting at the rate given as first argument
+WORKER_CODE = ("import sys, TwitterScraper; governor = TwitterScraper.RateGovernor.shared(); "
+               "governor.max_rate = float(sys.argv[1]); governor.set_rate(governor.max_rate); "
+               "sys.argv = ['TwitterScraper.py'] + sys.argv[2:]; TwitterScraper.main()")
+# Imported where they are used, a plain import of TwitterScraper must not load them
+DEFERRED_MODULES = ['requests', 'bs4', 'lxml', 'fake_useragent', 'six', 'asyncio', 'aiohttp', 'httpx', 'zstandard',
+                    'pyarrow', 'twitter', 'brotli']
+SEARCH_PATH = '/i/search/timeline'
+# The user agent of the fake_useragent database of the benchmarks, unlike the fallback one of a database that failed
+BENCH_USERAGENT = 'Mozilla/5.0 (X11; Linux x86_64; rv:60.0) Gecko/20100101 Firefox/60.0'
+SCRIPT_DIR = os.path.dirname(os.path.abspath(TwitterScraper.__file__))
+EPOCH = 1500000000
+
+
+def synthetic_tweet(i):
+    """
+    A tweet shaped like the ones TwitterSearch.parse_tweets returns
+    """
+    epoch = EPOCH + i * 7
+    user_id = 1000 + i % 500
+    return {
+        'created_at': 'Fri Jul 14 02:40:%02d +0000 2017' % (i % 60),
+        'text': u'Tweet number %i about #python and #scraping, see https://t.co/%08x ❤' % (i, i),
+        'id': 886000000000000000 + i,
+        'id_str': str(886000000000000000 + i),
+        'epoch': epoch,
+        'reply_count': i % 13,
+        'retweet_count': i % 101,
+        'favorite_count': i % 997,
+        'hashtags': ['#python', '#scraping'],
+        'cards': [],
+        'urls': ['https://example.com/articles/%i' % i] if i % 3 == 0 else [],
+        'photos': ['https://pbs.twimg.com/media/%08x.jpg' % i] if i % 5 == 0 else [],
+        'videos': [{'expanded_url': 'https://twitter.com/i/videos/tweet/%i' % i}] if i % 17 == 0 else [],
+        'user': {
+            'id_str': str(user_id),
+            'id': user_id,
+            'screen_name': 'user%i' % user_id,
+            'name': 'User %i' % user_id,
+        },
+    }
+
+
+def synthetic_tweet_html(id, epoch, screen_name=None):
+    """
+    The markup of a tweet in the items_html of a search page
+    :param screen_name: Author of the tweet, one of 500 made up accounts by default
+    """
+    if screen_name is None:
+        user_id = 1000 + id % 500
+        screen_name = u'user%i' % user_id
+    else:
+        user_id = 1000 + zlib.crc32(screen_name.encode('utf-8')) % 1000000
+    html = (u'<li class="js-stream-item stream-item stream-item" data-item-id="%i" data-item-type="tweet">'
+            u'<div class="tweet js-stream-tweet js-actionable-tweet" data-tweet-id="%i" data-user-id="%i" '
+            u'data-screen-name="%s" data-name="User %i">'
+            u'<div class="content"><div class="stream-item-header">'
+            u'<a class="tweet-timestamp js-permalink" href="/%s/status/%i">'
+            u'<span class="_timestamp js-short-timestamp" data-time="%i">Jul 14</span></a></div>'
+            u'<div class="js-tweet-text-container"><p class="TweetTextSize js-tweet-text tweet-text">'
+            u'Tweet number %i about <a class="twitter-hashtag pretty-link">#python</a> and '
+            u'<a class="twitter-hashtag pretty-link">#scraping</a> ❤ '
+            u'<a class="twitter-timeline-link" data-expanded-url="https://example.com/articles/%i">'
+            u'example.com/articles<span class="u-hidden">/%i</span></a></p></div>'
+            % (id, id, user_id, screen_name, user_id, screen_name, id, epoch, id, id, id))
+    if id % 5 == 0:
+        html += (u'<div class="AdaptiveMedia-photoContainer js-adaptive-photo" '
+                 u'data-image-url="https://pbs.twimg.com/media/%08x.jpg"></div>' % id)
+    if id % 17 == 0:
+        html += u'<div class="PlayableMedia-player"></div>'
+    html += (u'<div class="stream-item-footer"><div class="ProfileTweet-actionList">'
+             u'<span class="ProfileTweet-actionCount">%i replies</span>'
+             u'<span class="ProfileTweet-actionCount">%i retweets</span>'
+             u'<span class="ProfileTweet-actionCount">%s likes</span>'
+             u'</div></div></div></div></li>' % (id % 13, id % 101, format(id % 9973, ',')))
+    return html
+
+
+def synthetic_user_html(id):
+    """
+    The markup of an account in the items_html of a users search page
+    """
+    verified = u'<span class="Icon Icon--verified"></span>' if id % 7 == 0 else u''
+    return (u'<div class="js-stream-item" data-item-id="%i"><div class="ProfileCard js-actionable-user">'
+            u'<div class="user-actions btn-group not-following" data-user-id="%i" data-screen-name="user%i" '
+            u'data-name="User %i"></div>'
+            u'<div class="ProfileCard-userFields"><span class="ProfileNameTruncated">User %i</span>%s</div>'
+            u'<p class="ProfileCard-bio u-dir">Bio of account %i, talking about #python</p>'
+            u'</div></div>' % (id, id, id, id, id, verified, id))
+
+
+def synthetic_page(query, target_type, page, page_size=DEFAULT_PAGE_SIZE):
+    """
+    items_html of a search page, with ids that only depend on the query so that repeated runs get the same items.
+    The tweets of a query with from: operators are by its accounts in turn.
+    :param page: Index of the page, starting at 0
+    """
+    base = zlib.crc32(query.encode('utf-8')) << 24
+    ids = [base + page * page_size + j for j in range(page_size)]
+    if target_type == 'users':
+        return u''.join(synthetic_user_html(id) for id in ids)
+    accounts = re.findall(r'from:(\w+)', query) or [None]
+    return u''.join(synthetic_tweet_html(id, EPOCH + (id % 100000000), accounts[id % len(accounts)]) for id in ids)
+
+
+class StaticUserAgent(object):
+    random = TwitterScraper.FALLBACK_USERAGENT
+
+
+class StubUser(object):
+    def __init__(self, id):
+        self.id = id
+
+    def AsDict(self):
+        return {'id': self.id, 'screen_name': 'user%i' % self.id, 'followers_count': self.id % 9973,
+                'friends_count': self.id % 997, 'statuses_count': self.id % 99991, 'verified': self.id % 7 == 0}
+
+
+class StubUsersClient(object):
+    def __init__(self, latency=DEFAULT_LOOKUP_LATENCY):
+        """
+        A stand-in for twitter.Api that answers UsersLookup after some latency, leaving out one user in eleven as if
+        they were suspended. The ids of each lookup are kept in batches.
+        """
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.batches = []
+
+    def UsersLookup(self, user_id=None, **kwargs):
+        with self.lock:
+            self.batches.append(list(user_id))
+        sleep(self.latency)
+        return [StubUser(id) for id in user_id if id % 11]
+
+
+def write_useragent_cache(filepath):
+    """
+    Writes a fake_useragent database with a single user agent, so that searches never download one
+    """
+    with open(filepath, 'w') as f:
+        json.dump({'browsers': {'firefox': [BENCH_USERAGENT]}, 'randomize': {'0': 'firefox'}}, f)
+
+
+class FakeTwitterServer(ThreadingHTTPServer):
+    daemon_threads = True
+
+    def __init__(self, host='127.0.0.1', port=0, latency=0, page_size=DEFAULT_PAGE_SIZE, pages=DEFAULT_QUERY_PAGES,
+                 throttle_rate=0, error_rate=0, retry_after=1, recorded=None, seed=0):
+        """
+        A stand-in for the search endpoint of Twitter. Every query has the same number of pages, either synthetic or
+        replayed from recorded responses, and the requests can be made to fail like Twitter does.
+        :param latency: Seconds each response is delayed by
+        :param page_size: Number of items in a synthetic page
+        :param pages: Number of pages of each query
+        :param throttle_rate: Fraction of requests answered with 429 and an x-rate-limit-reset header
+        :param error_rate: Fraction of requests answered with 503 and a Retry-After header
+        :param retry_after: Seconds the injected failures ask clients to wait for
+        :param recorded: A list of recorded {items_html, min_position} responses, served in order to every query
+        :param seed: Seed of the failure injection
+        """
+        ThreadingHTTPServer.__init__(self, (host, port), FakeTwitterHandler)
+        self.latency = latency
+        self.page_size = page_size
+        self.pages = len(recorded) if recorded else pages
+        self.throttle_rate = throttle_rate
+        self.error_rate = error_rate
+        self.retry_after = retry_after
+        self.recorded = recorded
+        self.random = random.Random(seed)
+        self.lock = threading.Lock()
+        self.stats = {'requests': 0, 'pages': 0, 'items': 0, 'throttled': 0, 'errors': 0}
+        self.thread = None
+
+    @property
+    def url(self):
+        return 'http://%s:%i' % self.server_address[:2]
+
+    def start(self):
+        self.thread = threading.Thread(target=self.serve_forever)
+        self.thread.daemon = True
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+        self.thread.join()
+
+    def handle_error(self, request, client_address):
+        # Clients going away mid-response, such as a killed worker, are not an error of the server
+        if isinstance(sys.exc_info()[1], ConnectionError):
+            logger.debug("%s:%i went away", *client_address[:2])
+            return
+        ThreadingHTTPServer.handle_error(self, request, client_address)
+
+    def count(self, **counts):
+        with self.lock:
+            for key, value in counts.items():
+                self.stats[key] += value
+
+    def inject(self):
+        """
+        :return: The HTTP status to fail the next request with, or None
+        """
+        with self.lock:
+            draw = self.random.random()
+        if draw < self.throttle_rate:
+            return 429
+        if draw < self.throttle_rate + self.error_rate:
+            return 503
+        return None
+
+    def page(self, query, target_type, max_position):
+        page = int(max_position) if max_position else 0
+        if page >= self.pages:
+            return {'items_html': '', 'min_position': max_position, 'has_more_items': False}, 0
+        if self.recorded:
+            response = dict(self.recorded[page])
+            response['min_position'] = str(page + 1)
+            return response, response['items_html'].count('data-item-id')
+        items_html = synthetic_page(query, target_type, page, self.page_size)
+        return {'items_html': items_html, 'min_position': str(page + 1), 'has_more_items': True}, self.page_size
+
+
+class FakeTwitterHandler(BaseHTTPRequestHandler):
+    protocol_version = 'HTTP/1.1'
+    # Headers and body go out in separate writes, which Nagle's algorithm would hold back on keep-alive connections
+    disable_nagle_algorithm = True
+
+    def log_message(self, format, *args):
+        logger.debug(format, *args)
+
+    def send_body(self, status, body, headers=None):
+        body = body.encode('utf-8')
+        self.send_response(status)
+        for key, value in (headers or {}).items():
+            self.send_header(key, value)
+        self.send_header('Content-Type', 'application/json; charset=utf-8')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):
+        server = self.server
+        server.count(requests=1)
+        url = urlparse(self.path)
+        if url.path != SEARCH_PATH:
+            self.send_body(404, '{}')
+            return
+
+        if server.latency:
+            sleep(server.latency)
+
+        status = server.inject()
+        if status == 429:
+            server.count(throttled=1)
+            self.send_body(429, '{}', {'x-rate-limit-limit': '180', 'x-rate-limit-remaining': '0',
+                                       'x-rate-limit-reset': str(int(time() + server.retry_after))})
+            return
+        if status is not None:
+            server.count(errors=1)
+            self.send_body(status, '{}', {'Retry-After': str(server.retry_after)})
+            return
+
+        params = parse_qs(url.query)
+        max_position = params.get('max_position', [None])[0]
+        if max_position == 'None':
+            max_position = None
+        response, items = server.page(params.get('q', [''])[0], params.get('f', ['tweets'])[0], max_position)
+        if items:
+            server.count(pages=1, items=items)
+        self.send_body(200, json.dumps(response))
+
+
+def load_recorded(filepath):
+    """
+    Reads recorded search responses, one JSON object with an items_html field per line
+    """
+    if filepath is None:
+        return None
+    with open(filepath) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+
+def peak_rss_mb():
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # Kilobytes on Linux, bytes on macOS
+    return peak / 1e6 if sys.platform == 'darwin' else peak / 1e3
+
+
+def bench_sinks(args):
+    """
+    Writes the same items through every output sink, reporting bytes on disk and write throughput
+    """
+    items = [synthetic_tweet(i) for i in range(args.items)]
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        for name, sink_class in sorted(TwitterScraper.SINKS.items()):
+            filepath = os.path.join(directory, 'bench' + sink_class.extension)
+            sink = sink_class(filepath, batch_size=args.batch_size, row_group_size=args.row_group_size)
+            try:
+                start = perf_counter()
+                sink.open()
+                for item in items:
+                    sink.write(item)
+                sink.close()
+                elapsed = perf_counter() - start
+            except ImportError as e:
+                logger.warning("%s skipped, %s", name, e)
+                continue
+
+            size = os.path.getsize(filepath)
+            results.append({'name': name, 'bytes': size, 'items_per_s': len(items) / elapsed,
+                            'mb_per_s': size / elapsed / 1e6})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_parse(args):
+    """
+    Parses the same pages with every parser backend
+    """
+    recorded = load_recorded(args.recorded)
+    results = []
+    for target_type in ('tweets', 'users'):
+        if recorded:
+            if target_type == 'users':
+                continue
+            pages = [response['items_html'] for response in recorded]
+        else:
+            pages = [synthetic_page('bench', target_type, page, args.page_size) for page in range(args.pages)]
+
+        for name, parse_fns in sorted(TwitterScraper.PARSERS.items()):
+            parse = parse_fns[0] if target_type == 'tweets' else parse_fns[1]
+            start = perf_counter()
+            items = sum(len(parse(page)) for page in pages)
+            elapsed = perf_counter() - start
+            results.append({'name': 'parse_%s/%s' % (target_type, name), 'pages_per_s': len(pages) / elapsed,
+                            'items_per_s': items / elapsed, 'us_per_item': elapsed / items * 1e6})
+    return results
+
+
+def bench_save(args):
+    """
+    Times the JSON serialization of parsed tweets and their trip through TwitterSearchImpl.save_items into each sink
+    """
+    pages = [TwitterScraper.LxmlParser.parse_tweets(synthetic_page('bench', 'tweets', page, args.page_size))
+             for page in range(args.pages)]
+    items = [item for page in pages for item in page]
+
+    start = perf_counter()
+    for item in items:
+        json.dumps(item)
+    elapsed = perf_counter() - start
+    results = [{'name': 'serialize/json', 'items_per_s': len(items) / elapsed,
+                'us_per_item': elapsed / len(items) * 1e6}]
+
+    directory = tempfile.mkdtemp()
+    try:
+        for name, sink_class in sorted(TwitterScraper.SINKS.items()):
+            filepath = os.path.join(directory, 'bench' + sink_class.extension)
+            twit = TwitterScraper.TwitterSearchImpl(None, 0, 0, None, filepath, useragent=StaticUserAgent(),
+                                                    sink=name)
+            try:
+                start = perf_counter()
+                twit.open_output()
+                for page in pages:
+                    twit.save_items(page)
+                twit.close_output()
+                elapsed = perf_counter() - start
+            except ImportError as e:
+                logger.warning("%s skipped, %s", name, e)
+                continue
+            results.append({'name': 'save_items/%s' % name, 'items_per_s': len(items) / elapsed,
+                            'us_per_item': elapsed / len(items) * 1e6})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def bench_records(args):
+    """
+    Compares the Tweet records parsers return for compact_records searches with the dicts they return otherwise:
+    parsing and encoding time, memory held by the parsed pages, and garbage collections along the way
+    """
+    pages = [synthetic_page('bench', 'tweets', page, args.page_size) for page in range(args.pages)]
+    items = args.pages * args.page_size
+
+    results = []
+    for name, compact in (('dicts', False), ('records', True)):
+        # Best of a few rounds, both representations allocate enough for the timings to be noisy
+        parse_elapsed = encode_elapsed = float('inf')
+        collections = sum(stats['collections'] for stats in gc.get_stats())
+        for _ in range(args.rounds):
+            TwitterScraper.User._interned.clear()
+            start = perf_counter()
+            parsed = [TwitterScraper.LxmlParser.parse_tweets(page, compact=compact) for page in pages]
+            parse_elapsed = min(parse_elapsed, perf_counter() - start)
+
+            start = perf_counter()
+            for page in parsed:
+                for item in page:
+                    TwitterScraper.JsonlSink.encode(item)
+            encode_elapsed = min(encode_elapsed, perf_counter() - start)
+            del parsed
+        collections = (sum(stats['collections'] for stats in gc.get_stats()) - collections) / args.rounds
+
+        # Measured on its own, tracing allocations slows everything down
+        TwitterScraper.User._interned.clear()
+        tracemalloc.start()
+        parsed = [TwitterScraper.LxmlParser.parse_tweets(page, compact=compact) for page in pages]
+        held = tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+        del parsed
+
+        results.append({'name': 'records/%s' % name, 'us_per_parse': parse_elapsed / items * 1e6,
+                        'us_per_encode': encode_elapsed / items * 1e6, 'mem_per_item': held / items,
+                        'gc_runs': collections})
+    return results
+
+
+def import_time():
+    """
+    Imports TwitterScraper in a new interpreter under python -X importtime
+    :return: The cumulative import time of TwitterScraper in milliseconds, and the modules it loaded
+    """
+    code = ("import sys; before = set(sys.modules); import TwitterScraper; "
+            "print('\\n'.join(sorted(set(sys.modules) - before)))")
+    process = subprocess.run([sys.executable, '-X', 'importtime', '-c', code], cwd=SCRIPT_DIR, check=True,
+                             stdout=subprocess.PIPE, stderr=subprocess.PIPE, universal_newlines=True)
+    for line in process.stderr.splitlines():
+        fields = line.split('|')
+        if len(fields) == 3 and fields[2].strip() == 'TwitterScraper':
+            return int(fields[1]) / 1000.0, process.stdout.split()
+    raise RuntimeError("No import time reported for TwitterScraper:\n" + process.stderr)
+
+
+def bench_startup(args):
+    """
+    Startup cost of the script: the import time of TwitterScraper, best of a few runs, and the wall time of
+    TwitterScraper.py --help
+    """
+    # Installed scripts start from cached bytecode, which a fresh checkout or PYTHONDONTWRITEBYTECODE leave out
+    py_compile.compile(TwitterScraper.__file__)
+    import_ms = help_ms = float('inf')
+    modules = []
+    for _ in range(args.runs):
+        elapsed, modules = import_time()
+        import_ms = min(import_ms, elapsed)
+
+        start = perf_counter()
+        subprocess.run([sys.executable, os.path.join(SCRIPT_DIR, 'TwitterScraper.py'), '--help'], check=True,
+                       stdout=subprocess.DEVNULL)
+        help_ms = min(help_ms, (perf_counter() - start) * 1000)
+
+    deferred = [name for name in modules if name.split('.')[0] in DEFERRED_MODULES]
+    if deferred:
+        logger.warning("Importing TwitterScraper loaded %s", ", ".join(deferred))
+    return [{'name': 'startup', 'import_ms': import_ms, 'help_ms': help_ms, 'modules': len(modules),
+             'deferred': len(deferred)}]
+
+
+def check_startup(args, results):
+    """
+    Fails a startup run that went over the import time budget or loaded a module meant to be imported later
+    :return: The number of failures
+    """
+    failures = 0
+    for result in results:
+        if result['import_ms'] > args.budget_ms:
+            logger.error("%s : importing TwitterScraper took %.1f ms, over the budget of %.1f ms", result['name'],
+                         result['import_ms'], args.budget_ms)
+            failures += 1
+        if result['deferred']:
+            logger.error("%s : importing TwitterScraper loaded %i modules meant to be imported where they are used",
+                         result['name'], result['deferred'])
+            failures += 1
+    return failures
+
+
+def bench_users(args):
+    """
+    Adds the profiles of their authors to pages of tweets through a stub REST client, first with an empty user cache
+    and then with the cache filled by the first run
+    """
+    pages = [TwitterScraper.LxmlParser.parse_tweets(synthetic_page('bench', 'tweets', page, args.page_size))
+             for page in range(args.pages)]
+    items = sum(len(page) for page in pages)
+
+    directory = tempfile.mkdtemp()
+    results = []
+    try:
+        cache_path = os.path.join(directory, 'users.db')
+        for name in ('cold', 'warm'):
+            governor = TwitterScraper.RateGovernor(rate=args.rate, max_rate=args.rate)
+            enricher = TwitterScraper.UserEnricher(client=StubUsersClient(args.latency),
+                                                   cache=TwitterScraper.UserCache(cache_path),
+                                                   workers=args.workers, governor=governor)
+            twit = TwitterScraper.TwitterSearchImpl(None, 0, 0, None, os.path.join(directory, name + '.jsonl'),
+                                                    useragent=StaticUserAgent(), enricher=enricher)
+            start = perf_counter()
+            twit.open_output()
+            for page in pages:
+                twit.save_page('bench', page, None, user_stats=True)
+            twit.save_enriched('bench', drain=True)
+            twit.close_output()
+            elapsed = perf_counter() - start
+            enricher.close()
+            results.append({'name': 'user_stats/%s' % name, 'items_per_s': items / elapsed,
+                            'lookups': enricher.lookups})
+    finally:
+        shutil.rmtree(directory)
+    return results
+
+
+def run_search(args, server_url, directory, name, **kwargs):
+    """
+    Runs twitter_search for args.queries accounts against the server
+    :return: The result of the run, with the server counters when the server is ours
+    """
+    governor = TwitterScraper.RateGovernor.shared()
+    governor.max_rate = args.rate
+    governor.set_rate(args.rate)
+
+    output_dir = os.path.join(directory, name)
+    os.mkdir(output_dir)
+    accounts = ['bench%i' % i for i in range(args.queries)]
+    useragent_cache_path = os.path.join(directory, 'useragents.json')
+    if not os.path.isfile(useragent_cache_path):
+        write_useragent_cache(useragent_cache_path)
+
+    start = perf_counter()
+    TwitterScraper.twitter_search(accounts=accounts, output_dir=output_dir, rate_delay=0, error_delay=args.error_delay,
+                                  limit=None, useragent_cache_path=useragent_cache_path, parser=args.parser,
+                                  max_rate=args.rate, base_url=server_url, **kwargs)
+    elapsed = perf_counter() - start
+
+    items = 0
+    for filename in os.listdir(output_dir):
+        with open(os.path.join(output_dir, filename), 'rb') as f:
+            items += sum(1 for _ in f)
+    return {'name': name, 'seconds': elapsed, 'items_per_s': items / elapsed, 'items': items}
+
+
+def with_server(args, run):
+    """
+    Calls run with the URL of the server to search, starting a FakeTwitterServer unless --base_url is given
+    """
+    directory = tempfile.mkdtemp()
+    server = None
+    try:
+        if args.base_url:
+            return run(args.base_url, directory, None)
+        server = FakeTwitterServer(latency=args.latency, page_size=args.page_size, pages=args.query_pages,
+                                   throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                                   retry_after=args.retry_after, recorded=load_recorded(args.recorded)).start()
+        return run(server.url, directory, server)
+    finally:
+        if server is not None:
+            server.stop()
+        shutil.rmtree(directory)
+
+
+def add_server_stats(result, server, before):
+    """
+    Adds the pages served and failures injected since the before snapshot of the server counters
+    """
+    if server is None:
+        return result
+    stats = dict((key, value - before[key]) for key, value in server.stats.items())
+    result['pages_per_s'] = stats['pages'] / result['seconds']
+    result['throttled'] = stats['throttled']
+    result['errors'] = stats['errors']
+    return result
+
+
+def bench_e2e(args):
+    """
+    Runs a whole twitter_search against the stand-in server
+    """
+    def run(server_url, directory, server):
+        before = dict(server.stats) if server is not None else None
+        result = run_search(args, server_url, directory, 'e2e_packed' if args.pack_accounts else 'e2e',
+                            use_async=args.use_async, parse_workers=args.parse_workers, http2=args.http2,
+                            pack_accounts=args.pack_accounts, account_workers=args.account_workers)
+        result = add_server_stats(result, server, before)
+        # The in-process server is part of it, yet its footprint is small next to the parsing
+        result['peak_rss_mb'] = peak_rss_mb()
+        return [result]
+    return with_server(args, run)
+
+
+def bench_shards(args):
+    """
+    Runs the same sharded search with more and more workers, to check that throughput grows with them
+    """
+    def run(server_url, directory, server):
+        results = []
+        for workers in args.workers:
+            before = dict(server.stats) if server is not None else None
+            result = run_search(args, server_url, directory, 'workers_%i' % workers, workers=workers,
+                                shard=args.shard, since=args.since, until=args.until)
+            results.append(add_server_stats(result, server, before))
+        return results
+    return with_server(args, run)
+
+
+def start_worker(args, queue_path, server_url, directory, index):
+    """
+    Starts a TwitterScraper.py --worker process searching the stand-in server, logging to a file of the directory
+    """
+    useragent_cache_path = os.path.join(directory, 'useragents.json')
+    if not os.path.isfile(useragent_cache_path):
+        write_useragent_cache(useragent_cache_path)
+    command = [sys.executable, '-c', WORKER_CODE, str(args.rate), '--worker', queue_path,
+               '--worker_id', 'bench-%i' % index, '--lease', str(args.lease), '--base_url', server_url,
+               '--rate_delay', '0', '--error_delay', str(int(args.error_delay)), '--max_rate', str(args.rate),
+               '--parser', args.parser, '--fake_useragent_cache_path', useragent_cache_path]
+    with open(os.path.join(directory, 'worker-%i.log' % index), 'wb') as log:
+        return subprocess.Popen(command, cwd=SCRIPT_DIR, stdout=subprocess.DEVNULL, stderr=log)
+
+
+def count_output(filepath):
+    """
+    :return: The number of lines of a JSON lines output, and of distinct tweet ids in it
+    """
+    ids = set()
+    lines = 0
+    with open(filepath, 'rb') as f:
+        for line in f:
+            lines += 1
+            ids.add(json.loads(line.decode('utf-8'))['id'])
+    return lines, len(ids)
+
+
+def bench_distributed(args):
+    """
+    Runs a coordinator and local worker processes against the stand-in server. The first worker is killed once it
+    saved a page of a work unit, which another worker takes over once its lease runs out.
+    """
+    def run(server_url, directory, server):
+        before = dict(server.stats) if server is not None else None
+        output_dir = os.path.join(directory, 'distributed')
+        os.mkdir(output_dir)
+        queue_path = os.path.join(directory, 'queue.db')
+        accounts = ['bench%i' % i for i in range(args.queries)]
+        jobs = [(os.path.join(output_dir, account + '.jsonl'),
+                 str(TwitterScraper.SearchQuery(accounts=[account])),
+                 {'target_type': 'tweets', 'user_stats': False, 'language': None, 'parse_workers': 0})
+                for account in accounts]
+        units = TwitterScraper.plan_work_units(jobs, parts_dir=os.path.join(output_dir, TwitterScraper.PARTS_DIR))
+
+        # Workers only open a queue that exists, they wait for its units
+        queue = TwitterScraper.open_work_queue(queue_path)
+        monitor = TwitterScraper.open_work_queue(queue_path, create=False)
+        start = perf_counter()
+        workers = [start_worker(args, queue_path, server_url, directory, i) for i in range(args.workers)]
+        failed = []
+        coordinator = threading.Thread(target=lambda: failed.append(
+            TwitterScraper.coordinate(queue, units, poll_interval=COORDINATOR_POLL_INTERVAL)))
+        coordinator.start()
+        killed = 0
+        try:
+            while coordinator.is_alive():
+                if args.kill and not killed and any(unit['worker'] == 'bench-0' and unit['state'] == 'leased' and
+                                                    unit['offset'] is not None for unit in monitor.units()):
+                    workers[0].kill()
+                    killed = 1
+                coordinator.join(0.02)
+            elapsed = perf_counter() - start
+        finally:
+            coordinator.join()
+            for worker in workers:
+                try:
+                    # Idle workers stop once the coordinator closed the queue
+                    worker.wait(timeout=TwitterScraper.QUEUE_POLL_INTERVAL * 2)
+                except subprocess.TimeoutExpired:
+                    worker.kill()
+                    worker.wait()
+            monitor.close()
+            queue.close()
+        if args.kill and not killed:
+            logger.warning("The first worker did not hold a work unit long enough to be killed")
+
+        items = distinct = 0
+        for filepath, _, _ in jobs:
+            if os.path.isfile(filepath):
+                lines, ids = count_output(filepath)
+                items += lines
+                distinct += ids
+        expected = len(jobs) * (server.pages * server.page_size if server is not None and not server.recorded
+                                else items // max(len(jobs), 1))
+        result = {'name': 'distributed_%i' % args.workers, 'seconds': elapsed, 'items_per_s': items / elapsed,
+                  'items': items, 'duplicates': items - distinct, 'missing': max(expected - items, 0),
+                  'failed_units': failed[0] if failed else len(units), 'killed': killed}
+        return [add_server_stats(result, server, before)]
+    return with_server(args, run)
+
+
+def check_distributed(args, results):
+    """
+    Fails a distributed run that lost or duplicated items, or failed work units, e.g. around the killed worker
+    :return: The number of failures
+    """
+    failures = 0
+    for result in results:
+        for metric in ('missing', 'duplicates', 'failed_units'):
+            if result[metric]:
+                logger.error("%s : %i %s", result['name'], result[metric], metric.replace('_', ' '))
+                failures += 1
+    return failures
+
+
+def worse(metric, value, baseline, tolerance):
+    """
+    :return: True if value regressed from baseline by more than the tolerance, for the metrics that have a direction
+    """
+    if metric.endswith('_per_s'):
+        return value < baseline * (1 - tolerance)
+    if metric.startswith('us_per_') or metric in ('seconds', 'peak_rss_mb', 'mem_per_item', 'import_ms', 'help_ms'):
+        return value > baseline * (1 + tolerance)
+    return False
+
+
+def compare(results, baseline_path, tolerance):
+    """
+    Compares results with the ones saved by an earlier --json run
+    :return: The number of regressions
+    """
+    with open(baseline_path) as f:
+        baseline = dict((result['name'], result) for result in json.load(f)['results'])
+
+    regressions = 0
+    for result in results:
+        previous = baseline.get(result['name'])
+        if previous is None:
+            continue
+        for metric, value in result.items():
+            if metric in previous and worse(metric, value, previous[metric], tolerance):
+                logger.error("%s : %s regressed from %.4g to %.4g", result['name'], metric, previous[metric], value)
+                regressions += 1
+    return regressions
+
+
+def print_results(results):
+    columns = []
+    for result in results:
+        columns.extend(key for key in result if key != 'name' and key not in columns)
+    print(("%-24s" % "name") + "".join("%14s" % column for column in columns))
+    for result in results:
+        print(("%-24s" % result['name']) + "".join(
+            "%14.4g" % result[column] if column in result else "%14s" % "-" for column in columns))
+
+
+def add_server_arguments(parser):
+    parser.add_argument("--base_url", type=str, default=None,
+                        help="Search a server that is already running instead of starting one")
+    parser.add_argument("--recorded", type=str, default=None,
+                        help="JSON lines file of recorded search responses to serve instead of synthetic pages")
+    parser.add_argument("--latency", type=float, default=DEFAULT_LATENCY, help="Seconds each response is delayed by")
+    parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    parser.add_argument("--query_pages", type=int, default=DEFAULT_QUERY_PAGES, help="Number of pages of each query")
+    parser.add_argument("--queries", type=int, default=DEFAULT_QUERIES, help="Number of accounts searched")
+    parser.add_argument("--throttle_rate", type=float, default=0, help="Fraction of requests answered with 429")
+    parser.add_argument("--error_rate", type=float, default=0, help="Fraction of requests answered with 503")
+    parser.add_argument("--retry_after", type=int, default=1, help="Seconds the injected failures ask to wait")
+    parser.add_argument("--error_delay", type=float, default=0.1)
+    parser.add_argument("--rate", type=float, default=DEFAULT_RATE, help="Requests per second of the rate governor")
+    parser.add_argument("--parser", type=str, default=TwitterScraper.DEFAULT_PARSER,
+                        choices=sorted(TwitterScraper.PARSERS))
+
+
+def serve(args):
+    """
+    Runs the stand-in server until interrupted, for searches started from another process
+    """
+    server = FakeTwitterServer(port=args.port, latency=args.latency, page_size=args.page_size, pages=args.query_pages,
+                               throttle_rate=args.throttle_rate, error_rate=args.error_rate,
+                               retry_after=args.retry_after, recorded=load_recorded(args.recorded))
+    logger.info("Serving on %s", server.url)
+    try:
+        server.serve_forever()
+    except KeyboardInterrupt:
+        pass
+    finally:
+        server.server_close()
+    return []
+
+
+def main():
+    logging.basicConfig(format=TwitterScraper.LOG_FORMAT, level=logging.INFO)
+    # Logging every request of the searches would weigh on what is measured
+    TwitterScraper.logger.setLevel(logging.WARNING)
+
+    common = argparse.ArgumentParser(add_help=False)
+    common.add_argument("--json", action='store_true', help="Print the results as JSON, to save as a baseline")
+    common.add_argument("--baseline", type=str, default=None,
+                        help="JSON results of an earlier run, exits with an error if a result regressed")
+    common.add_argument("--tolerance", type=float, default=DEFAULT_TOLERANCE,
+                        help="Fraction a result may be worse than the baseline by")
+
+    parser = argparse.ArgumentParser(description="Benchmarks for TwitterScraper")
+    subparsers = parser.add_subparsers(dest="benchmark")
+
+    sinks_parser = subparsers.add_parser("sinks", parents=[common],
+                                         help="Bytes on disk and write throughput of each output sink")
+    sinks_parser.add_argument("--items", type=int, default=DEFAULT_ITEMS)
+    sinks_parser.add_argument("--batch_size", type=int, default=TwitterScraper.DEFAULT_SINK_BATCH_SIZE)
+    sinks_parser.add_argument("--row_group_size", type=int, default=TwitterScraper.DEFAULT_ROW_GROUP_SIZE)
+    sinks_parser.set_defaults(run=bench_sinks)
+
+    parse_parser = subparsers.add_parser("parse", parents=[common],
+                                         help="Throughput of parse_tweets and parse_users for each parser backend")
+    parse_parser.add_argument("--pages", type=int, default=DEFAULT_PAGES)
+    parse_parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    parse_parser.add_argument("--recorded", type=str, default=None,
+                              help="JSON lines file of recorded search responses to parse instead of synthetic pages")
+    parse_parser.set_defaults(run=bench_parse)
+
+    save_parser = subparsers.add_parser("save", parents=[common],
+                                        help="Serialization time and save_items throughput for each output sink")
+    save_parser.add_argument("--pages", type=int, default=DEFAULT_PAGES)
+    save_parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    save_parser.set_defaults(run=bench_save)
+
+    records_parser = subparsers.add_parser("records", parents=[common],
+                                           help="Time and memory of Tweet records against dicts")
+    records_parser.add_argument("--pages", type=int, default=DEFAULT_PAGES)
+    records_parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    records_parser.add_argument("--rounds", type=int, default=DEFAULT_ROUNDS)
+    records_parser.set_defaults(run=bench_records)
+
+    users_parser = subparsers.add_parser("users", parents=[common],
+                                         help="Throughput of --user_stats against a stub REST client")
+    users_parser.add_argument("--pages", type=int, default=DEFAULT_PAGES)
+    users_parser.add_argument("--page_size", type=int, default=DEFAULT_PAGE_SIZE)
+    users_parser.add_argument("--latency", type=float, default=DEFAULT_LOOKUP_LATENCY,
+                              help="Seconds each lookup takes")
+    users_parser.add_argument("--workers", type=int, default=TwitterScraper.DEFAULT_USER_LOOKUP_WORKERS)
+    users_parser.add_argument("--rate", type=float, default=TwitterScraper.USER_LOOKUP_RATE,
+                              help="Lookups per second")
+    users_parser.set_defaults(run=bench_users)
+
+    e2e_parser = subparsers.add_parser("e2e", parents=[common],
+                                       help="A whole twitter_search against a local stand-in for Twitter")
+    add_server_arguments(e2e_parser)
+    e2e_parser.add_argument("--async", dest="use_async", action='store_true')
+    e2e_parser.add_argument("--parse_workers", type=int, default=0)
+    e2e_parser.add_argument("--http2", action='store_true')
+    e2e_parser.add_argument("--account_workers", type=int, default=TwitterScraper.DEFAULT_ACCOUNT_WORKERS,
+                            help="Number of accounts searched at the same time")
+    e2e_parser.add_argument("--pack_accounts", action='store_true',
+                            help="Search the accounts in as few queries as the query length allows")
+    e2e_parser.set_defaults(run=bench_e2e)
+
+    shards_parser = subparsers.add_parser("shards", parents=[common],
+                                          help="Throughput of a sharded twitter_search as workers are added")
+    add_server_arguments(shards_parser)
+    shards_parser.add_argument("--workers", type=int, nargs='+', default=DEFAULT_SHARD_WORKERS)
+    shards_parser.add_argument("--shard", type=str, default='day', choices=sorted(TwitterScraper.SHARD_GRANULARITIES))
+    shards_parser.add_argument("--since", type=str, default='2017-07-01')
+    shards_parser.add_argument("--until", type=str, default='2017-07-09')
+    shards_parser.set_defaults(run=bench_shards)
+
+    distributed_parser = subparsers.add_parser("distributed", parents=[common],
+                                               help="A coordinator and local --worker processes against a local "
+                                                    "stand-in for Twitter, killing one of the workers")
+    add_server_arguments(distributed_parser)
+    distributed_parser.add_argument("--workers", type=int, default=DEFAULT_QUEUE_WORKERS,
+                                    help="Number of worker processes")
+    distributed_parser.add_argument("--lease", type=float, default=DEFAULT_BENCH_LEASE,
+                                    help="Seconds a worker holds a work unit for without renewing its lease")
+    distributed_parser.add_argument("--no_kill", dest="kill", action='store_false',
+                                    help="Let every worker run to the end")
+    distributed_parser.set_defaults(run=bench_distributed, check=check_distributed)
+
+    startup_parser = subparsers.add_parser("startup", parents=[common],
+                                           help="Import time of TwitterScraper against a budget, and time of --help")
+    startup_parser.add_argument("--runs", type=int, default=DEFAULT_STARTUP_RUNS)
+    startup_parser.add_argument("--budget_ms", type=float, default=DEFAULT_IMPORT_BUDGET_MS,
+                                help="Import time over which the run fails")
+    startup_parser.set_defaults(run=bench_startup, check=check_startup)
+
+    serve_parser = subparsers.add_parser("serve", help="Run the stand-in for Twitter, e.g. to search it with "
+                                                       "TwitterScraper.py --base_url")
+    add_server_arguments(serve_parser)
+    serve_parser.add_argument("--port", type=int, default=8000)
+    serve_parser.set_defaults(run=serve)
+
+    args = parser.parse_args()
+    if args.benchmark is None:
+        parser.print_help()
+        sys.exit(1)
+    results = args.run(args)
+    if args.benchmark == 'serve':
+        return
+
+    if args.json:
+        print(json.dumps({'benchmark': args.benchmark, 'results': results}, indent=2))
+    else:
+        print_results(results)
+
+    failures = args.check(args, results) if getattr(args, 'check', None) else 0
+    if args.baseline:
+        failures += compare(results, args.baseline, args.tolerance)
+    if failures:
+        sys.exit(1)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,61 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import PageCache  # noqa: E402
+from benchmark import synthetic_page  # noqa: E402
+
+PAGES = 50
+SEGMENT_SIZE = 16 * 1024
+
+
+def response(url):
+    return {'items_html': synthetic_page(url, 'tweets', 0), 'min_position': url, 'has_more_items': True}
+
+
+class SharedPageCacheTest(unittest.TestCase):
+    """
+    Caches opened on the same directory, like the ones of several --worker processes, have to read back the pages
+    every one of them wrote
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.caches = [PageCache(self.directory, segment_size=SEGMENT_SIZE) for _ in range(3)]
+
+    def tearDown(self):
+        for cache in self.caches:
+            cache.close()
+        shutil.rmtree(self.directory)
+
+    def test_interleaved_writers(self):
+        urls = ['https://twitter.com/i/search/timeline?page=%i' % i for i in range(PAGES)]
+        for i, url in enumerate(urls):
+            self.caches[i % len(self.caches)].put(url, response(url))
+
+        for cache in self.caches:
+            for url in urls:
+                self.assertEqual(cache.get(url), response(url))
+
+    def test_dropped_segments(self):
+        # A small cache drops the segments of the other writers too, their pages are then missed rather than misread
+        self.caches.append(PageCache(self.directory, max_size=SEGMENT_SIZE, segment_size=SEGMENT_SIZE))
+        urls = ['https://twitter.com/i/search/timeline?page=%i' % i for i in range(PAGES)]
+        for i, url in enumerate(urls):
+            self.caches[i % len(self.caches)].put(url, response(url))
+
+        for cache in self.caches:
+            for url in urls:
+                self.assertIn(cache.get(url), (None, response(url)))
+
+
+if __name__ == '__main__':
+    unittest.main()
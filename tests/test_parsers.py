@@ -0,0 +1,117 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import JsonlSink, LxmlParser, Tweet, TwitterSearch  # noqa: E402
+
+FIXTURES_DIR = os.path.join(TESTS_DIR, 'fixtures')
+TWEET_FIXTURES = ['tweets_cards.html', 'tweets_hidden.html', 'tweets_counts.html', 'empty.html']
+USER_FIXTURES = ['users.html', 'empty.html']
+EMPTY_PAGES = ['', '   ', '\n\t\n']
+
+
+def load_fixture(name):
+    """
+    :return: The items_html of a search page recorded in the fixtures directory
+    """
+    with io.open(os.path.join(FIXTURES_DIR, name), encoding='utf-8') as f:
+        return f.read()
+
+
+class ParserParityTest(unittest.TestCase):
+    """
+    LxmlParser has to give the same items as the BeautifulSoup parsers of TwitterSearch, as dicts and as records
+    """
+
+    def assert_tweets_parity(self, items_html):
+        """
+        :return: The tweets of the page, as dicts
+        """
+        dicts = TwitterSearch.parse_tweets(items_html)
+        self.assertEqual(LxmlParser.parse_tweets(items_html), dicts)
+        for parse_tweets in (TwitterSearch.parse_tweets, LxmlParser.parse_tweets):
+            records = parse_tweets(items_html, compact=True)
+            self.assertTrue(all(isinstance(record, Tweet) for record in records))
+            self.assertEqual([record.to_dict() for record in records], dicts)
+            self.assertEqual([record.to_json() for record in records], [JsonlSink.encode(item) for item in dicts])
+        return dicts
+
+    def assert_users_parity(self, items_html):
+        """
+        :return: The users of the page
+        """
+        users = TwitterSearch.parse_users(items_html)
+        self.assertEqual(LxmlParser.parse_users(items_html), users)
+        return users
+
+    def test_tweet_fixtures(self):
+        for name in TWEET_FIXTURES:
+            with self.subTest(fixture=name):
+                self.assert_tweets_parity(load_fixture(name))
+
+    def test_user_fixtures(self):
+        for name in USER_FIXTURES:
+            with self.subTest(fixture=name):
+                self.assert_users_parity(load_fixture(name))
+
+    def test_cards(self):
+        tweets = self.assert_tweets_parity(load_fixture('tweets_cards.html'))
+        self.assertEqual([tweet['id'] for tweet in tweets], [1001, 1002, 1003])
+
+        summary, player, unlinked = tweets
+        self.assertEqual(summary['cards'], [{
+            'card_url': 'https://twitter.com/i/cards/tfw/v1/1001?cardname=summary_large_image',
+            'expanded_url': 'https://www.nasa.gov/mission',
+        }])
+        self.assertEqual(summary['hashtags'], ['#Space'])
+        self.assertEqual(player['cards'], [])
+        self.assertEqual(player['videos'], [{'expanded_url': 'https://twitter.com/i/videos/tweet/1002'},
+                                            {'expanded_url': 'https://www.youtube.com/watch?v=launch'}])
+        self.assertEqual(player['urls'], ['https://www.youtube.com/watch?v=launch', 'https://www.esa.int/replay'])
+        # Cards without a link in the text are left out, like quoted tweets
+        self.assertEqual(unlinked['cards'], [])
+        self.assertEqual(unlinked['videos'], [])
+        self.assertEqual(unlinked['photos'], ['https://pbs.twimg.com/media/Da1.jpg',
+                                              'https://pbs.twimg.com/media/Da2.jpg'])
+
+    def test_nested_hidden(self):
+        tweets = self.assert_tweets_parity(load_fixture('tweets_hidden.html'))
+        self.assertEqual([tweet['text'] for tweet in tweets], [
+            'Hidden parts are gone, example.com/a/very but their tails stay',
+            u'Tout est caché sauf ça & ❤ #caché',
+        ])
+        self.assertEqual(tweets[0]['urls'], ['https://example.com/a/very/long/path'])
+        self.assertEqual(tweets[1]['user'], {'id_str': '42', 'id': 42, 'screen_name': u'ünïcode',
+                                             'name': u'Ünï & Cöde ❤'})
+
+    def test_thousands_separators(self):
+        tweets = self.assert_tweets_parity(load_fixture('tweets_counts.html'))
+        # Items without an id or without text are skipped
+        self.assertEqual([tweet['id'] for tweet in tweets], [3001, 3002])
+        self.assertEqual([(tweet['reply_count'], tweet['retweet_count'], tweet['favorite_count']) for tweet in tweets],
+                         [(1234, 12345, 1234567), (2000000, 10000, 999)])
+
+    def test_verified_users(self):
+        users = self.assert_users_parity(load_fixture('users.html'))
+        self.assertEqual([user['id'] for user in users], [11348282, 555, 556])
+        self.assertEqual([user['verified'] for user in users], [True, False, False])
+        self.assertEqual(users[0]['bio'], u'Explore the universe and discover our home planet with @NASA & more ❤')
+        self.assertEqual((users[1]['screen_name'], users[1]['name'], users[1]['bio']), ('somebody', 'Some Body', ''))
+        self.assertEqual((users[2]['screen_name'], users[2]['name'], users[2]['bio']), (None, None, None))
+
+    def test_empty_pages(self):
+        for items_html in EMPTY_PAGES + [load_fixture('empty.html')]:
+            with self.subTest(items_html=items_html[:20]):
+                self.assertEqual(self.assert_tweets_parity(items_html), [])
+                self.assertEqual(self.assert_users_parity(items_html), [])
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,47 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import copy
+import os
+import pickle
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import LxmlParser, Tweet  # noqa: E402
+from benchmark import synthetic_page  # noqa: E402
+
+
+class TweetCopyTest(unittest.TestCase):
+    """
+    Copies and pickles of a Tweet record have to read and encode like the tweet, keys deleted from it included
+    """
+
+    def setUp(self):
+        self.tweets = LxmlParser.parse_tweets(synthetic_page('copies', 'tweets', 0), compact=True)
+        self.assertTrue(all(isinstance(tweet, Tweet) for tweet in self.tweets))
+
+    def copies(self, tweet):
+        return [copy.copy(tweet), copy.deepcopy(tweet), pickle.loads(pickle.dumps(tweet))]
+
+    def test_copies(self):
+        for tweet in self.tweets:
+            for tweet_copy in self.copies(tweet):
+                self.assertEqual(tweet_copy.to_dict(), tweet.to_dict())
+                self.assertEqual(tweet_copy.to_json(), tweet.to_json())
+
+    def test_deleted_keys(self):
+        tweet = self.tweets[0]
+        del tweet['photos']
+        tweet['user']['name'] = 'Renamed'
+        for tweet_copy in self.copies(tweet):
+            self.assertNotIn('photos', tweet_copy)
+            self.assertRaises(KeyError, lambda: tweet_copy['photos'])
+            self.assertEqual(tweet_copy['user']['name'], 'Renamed')
+            self.assertEqual(tweet_copy.to_json(), tweet.to_json())
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,77 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import CrawlCheckpoint, RateGovernor, Transport, TwitterSearchImpl  # noqa: E402
+from benchmark import FakeTwitterServer, StaticUserAgent  # noqa: E402
+
+PAGES = 10
+PAGE_SIZE = 20
+STOP_AFTER = 60
+QUERY = 'from:nasa'
+
+
+class StoppedSearch(TwitterSearchImpl):
+    """
+    Sets its stop event once STOP_AFTER items are checkpointed, while the next page is already on its way
+    """
+
+    def checkpoint(self, query, max_position, items):
+        super(StoppedSearch, self).checkpoint(query, max_position, items)
+        if self.counter >= STOP_AFTER:
+            self.stop_event.set()
+
+
+class ResumeTest(unittest.TestCase):
+    """
+    A search stopped mid-crawl has to carry on from the last page it saved, without losing nor repeating items
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeTwitterServer(pages=PAGES, page_size=PAGE_SIZE).start()
+        self.session = Transport()
+        self.filepath = os.path.join(self.directory, 'nasa.jsonl')
+
+    def tearDown(self):
+        self.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def search(self, search_class, stop_event=None):
+        checkpoint_store = CrawlCheckpoint.for_output(self.filepath)
+        twit = search_class(self.session, 0, 0, None, self.filepath, useragent=StaticUserAgent(),
+                            checkpoint_store=checkpoint_store, base_url=self.server.url, stop_event=stop_event)
+        twit.governor = RateGovernor(rate=1000.0, max_rate=1000.0)
+        try:
+            return twit.search(QUERY, target_type='tweets')
+        finally:
+            checkpoint_store.close()
+
+    def saved_ids(self):
+        with io.open(self.filepath, 'rb') as f:
+            return [json.loads(line.decode('utf-8'))['id'] for line in f]
+
+    def test_resume_after_stop(self):
+        self.assertFalse(self.search(StoppedSearch, threading.Event()))
+        self.assertEqual(len(self.saved_ids()), STOP_AFTER)
+
+        self.assertTrue(self.search(TwitterSearchImpl))
+        ids = self.saved_ids()
+        self.assertEqual(len(ids), PAGES * PAGE_SIZE)
+        self.assertEqual(len(set(ids)), PAGES * PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()
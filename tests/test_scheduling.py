@@ -0,0 +1,49 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import os
+import shutil
+import sys
+import tempfile
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import SearchQuery, expected_length  # noqa: E402
+
+
+class ExpectedLengthTest(unittest.TestCase):
+    """
+    --account_workers starts the searches with the largest existing outputs first, then the largest groups of packed
+    accounts, and keeps the order of the others
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+
+    def tearDown(self):
+        shutil.rmtree(self.directory)
+
+    def job(self, accounts, lines=None):
+        filepath = os.path.join(self.directory, '-'.join(accounts) + '.jsonl')
+        if lines is not None:
+            with io.open(filepath, 'wb') as f:
+                f.write(b'{"id": 1}\n' * lines)
+        return filepath, str(SearchQuery(accounts=accounts)), {}
+
+    def order(self, jobs):
+        return [job[0] for job in sorted(jobs, key=lambda job: expected_length(job[1], job[0]), reverse=True)]
+
+    def test_existing_outputs_first(self):
+        jobs = [self.job(['a']), self.job(['b'], lines=10), self.job(['c']), self.job(['d'], lines=100)]
+        self.assertEqual(self.order(jobs), [jobs[3][0], jobs[1][0], jobs[0][0], jobs[2][0]])
+
+    def test_packed_groups(self):
+        jobs = [self.job(['a']), self.job(['b', 'c', 'd']), self.job(['e', 'f']), self.job(['g'])]
+        self.assertEqual(self.order(jobs), [jobs[1][0], jobs[2][0], jobs[0][0], jobs[3][0]])
+
+
+if __name__ == '__main__':
+    unittest.main()
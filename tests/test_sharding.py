@@ -0,0 +1,74 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+from datetime import datetime
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import DateShard, ShardedTwitterSearch, TwitterSearchCollector  # noqa: E402
+from benchmark import StaticUserAgent  # noqa: E402
+
+
+def tweets(newest, oldest):
+    """
+    :return: The tweets of a slice, newest first
+    """
+    return [{'id': id, 'id_str': str(id)} for id in range(newest, oldest - 1, -1)]
+
+
+def shard(key):
+    return DateShard(key, datetime(2019, 1, 1), datetime(2019, 1, 2))
+
+
+class ShardMergeTest(unittest.TestCase):
+    """
+    Slices overlap the slice merged before them, a split slice on the second of its oldest tweet and neighbouring
+    days on their boundary. Merged, they have to give every tweet once, in order.
+    """
+
+    def setUp(self):
+        self.writer = TwitterSearchCollector(None, 0, 0, useragent=StaticUserAgent())
+        self.seen = set()
+
+    def merge(self, results, running=()):
+        running = dict((i, shard(key)) for i, key in enumerate(running))
+        return ShardedTwitterSearch.merge(results, running, self.seen, self.writer, 'nasa')
+
+    def saved_ids(self):
+        return [item['id'] for item in self.writer.items]
+
+    def test_overlapping_slices(self):
+        results = {
+            (0,): tweets(100, 81),
+            # Split from (0,), from the second of its oldest tweet on
+            (0, 1): tweets(81, 61),
+            (0, 2): tweets(60, 41),
+            (1,): tweets(41, 21),
+            (2,): [],
+            # Overlaps the last slice with tweets, past an empty one
+            (3,): tweets(21, 1),
+        }
+        self.assertTrue(self.merge(results))
+        self.assertEqual(self.saved_ids(), list(range(100, 0, -1)))
+        self.assertEqual(results, {})
+
+    def test_running_slices(self):
+        results = {(0,): tweets(100, 81), (0, 1): tweets(81, 61), (1,): tweets(41, 21)}
+        # (0, 2) still runs, the slices after it wait for it
+        self.assertTrue(self.merge(results, running=[(0, 2)]))
+        self.assertEqual(self.saved_ids(), list(range(100, 60, -1)))
+        self.assertEqual(list(results), [(1,)])
+
+        results[(0, 2)] = tweets(61, 41)
+        self.assertTrue(self.merge(results))
+        self.assertEqual(self.saved_ids(), list(range(100, 20, -1)))
+        # Only the ids of the last slice are kept
+        self.assertEqual(self.seen, set(range(41, 20, -1)))
+
+
+if __name__ == '__main__':
+    unittest.main()
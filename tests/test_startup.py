@@ -0,0 +1,31 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import argparse
+import os
+import sys
+import unittest
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from benchmark import (DEFAULT_IMPORT_BUDGET_MS, DEFAULT_STARTUP_RUNS, DEFERRED_MODULES, bench_startup,  # noqa: E402
+                       check_startup)
+
+
+class StartupTest(unittest.TestCase):
+    """
+    Importing TwitterScraper has to stay within the import time budget of benchmark.py startup, without loading the
+    libraries only needed once a search runs
+    """
+
+    def test_startup_budget(self):
+        args = argparse.Namespace(runs=DEFAULT_STARTUP_RUNS, budget_ms=DEFAULT_IMPORT_BUDGET_MS)
+        results = bench_startup(args)
+        self.assertEqual(results[0]['deferred'], 0, "Importing TwitterScraper loaded one of %s" % DEFERRED_MODULES)
+        self.assertEqual(check_startup(args, results), 0, "Importing TwitterScraper took %.1f ms, over %.1f ms" % (
+            results[0]['import_ms'], DEFAULT_IMPORT_BUDGET_MS))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,88 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import os
+import sys
+import unittest
+from unittest import mock
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import USER_LOOKUP_BATCH, RateGovernor, UserCache, UserEnricher  # noqa: E402
+from benchmark import StubUser, StubUsersClient  # noqa: E402
+
+PAGE_USERS = 30
+PAGES = 4
+TTL = 3600
+NOW = 1500000000.0
+
+
+def suspended(id):
+    # StubUsersClient leaves these users out of its answers
+    return id % 11 == 0
+
+
+class UserEnricherTest(unittest.TestCase):
+    """
+    Users are looked up in full batches across pages, once, until their cached profile expires
+    """
+
+    def setUp(self):
+        self.client = StubUsersClient(latency=0)
+        self.cache = UserCache(ttl=TTL)
+        self.pages = [list(range(1000 + page * PAGE_USERS, 1000 + (page + 1) * PAGE_USERS)) for page in range(PAGES)]
+
+    def tearDown(self):
+        self.cache.close()
+
+    def enrich(self):
+        """
+        Looks the users of every page up, like a user_stats search does
+        :return: The profiles of each page
+        """
+        governor = RateGovernor(rate=1000.0, max_rate=1000.0)
+        enricher = UserEnricher(client=self.client, cache=self.cache, governor=governor)
+        lookups = [enricher.lookup(ids) for ids in self.pages]
+        enricher.flush()
+        profiles = [lookup.result() for lookup in lookups]
+        enricher.executor.shutdown(wait=True)
+        return profiles
+
+    def test_batches_span_pages(self):
+        with mock.patch('TwitterScraper.time', return_value=NOW):
+            profiles = self.enrich()
+
+        self.assertEqual([len(batch) for batch in self.client.batches],
+                         [USER_LOOKUP_BATCH, PAGES * PAGE_USERS - USER_LOOKUP_BATCH])
+        self.assertEqual(sorted(sum(self.client.batches, [])), sum(self.pages, []))
+        for ids, page_profiles in zip(self.pages, profiles):
+            for id in ids:
+                if not suspended(id):
+                    self.assertEqual(page_profiles[id], StubUser(id).AsDict())
+
+    def test_cached_users(self):
+        with mock.patch('TwitterScraper.time', return_value=NOW):
+            self.enrich()
+        batches = len(self.client.batches)
+
+        with mock.patch('TwitterScraper.time', return_value=NOW + TTL - 1):
+            profiles = self.enrich()
+        self.assertEqual(len(self.client.batches), batches)
+        for ids, page_profiles in zip(self.pages, profiles):
+            for id in ids:
+                # Suspended users are cached as None rather than looked up again
+                self.assertEqual(page_profiles[id], None if suspended(id) else StubUser(id).AsDict())
+
+    def test_expired_users(self):
+        with mock.patch('TwitterScraper.time', return_value=NOW):
+            self.enrich()
+        batches = len(self.client.batches)
+
+        with mock.patch('TwitterScraper.time', return_value=NOW + TTL + 1):
+            self.enrich()
+        self.assertEqual(sorted(sum(self.client.batches[batches:], [])), sum(self.pages, []))
+
+
+if __name__ == '__main__':
+    unittest.main()
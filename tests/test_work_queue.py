@@ -0,0 +1,100 @@
+#!/usr/bin/env python
+# -*- coding: utf-8 -*-
+
+import io
+import json
+import os
+import shutil
+import sys
+import tempfile
+import threading
+import unittest
+from time import sleep
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.dirname(TESTS_DIR))
+
+from TwitterScraper import (PARTS_DIR, RateGovernor, SearchQuery, Transport, TwitterSearchImpl,  # noqa: E402
+                            WorkUnitCheckpoint, merge_work_units, open_work_queue, plan_work_units, run_worker)
+from benchmark import FakeTwitterServer, StaticUserAgent, write_useragent_cache  # noqa: E402
+
+PAGES = 5
+PAGE_SIZE = 20
+LEASE = 0.5
+POLL_INTERVAL = 0.05
+DEAD_AFTER = 40
+
+
+class DyingSearch(TwitterSearchImpl):
+    """
+    Stops once DEAD_AFTER items are checkpointed, like a worker killed mid-unit that never releases its lease
+    """
+
+    def checkpoint(self, query, max_position, items):
+        super(DyingSearch, self).checkpoint(query, max_position, items)
+        if self.counter >= DEAD_AFTER:
+            self.stop_event.set()
+
+
+class LeaseExpiryTest(unittest.TestCase):
+    """
+    A unit whose worker died is leased again once its lease runs out, carried on from its last page and merged once
+    """
+
+    def setUp(self):
+        self.directory = tempfile.mkdtemp()
+        self.server = FakeTwitterServer(pages=PAGES, page_size=PAGE_SIZE).start()
+        self.session = Transport()
+        self.queue = open_work_queue(os.path.join(self.directory, 'queue.db'))
+        self.useragent_cache_path = os.path.join(self.directory, 'useragents.json')
+        write_useragent_cache(self.useragent_cache_path)
+
+        governor = RateGovernor.shared()
+        self.max_rate, self.rate = governor.max_rate, governor.rate
+        governor.max_rate = 1000.0
+        governor.set_rate(governor.max_rate)
+
+    def tearDown(self):
+        governor = RateGovernor.shared()
+        governor.max_rate = self.max_rate
+        governor.set_rate(self.rate)
+        self.queue.close()
+        self.session.close()
+        self.server.stop()
+        shutil.rmtree(self.directory)
+
+    def test_expired_lease(self):
+        output = os.path.join(self.directory, 'nasa.jsonl')
+        jobs = [(output, str(SearchQuery(accounts=['nasa'])),
+                 {'target_type': 'tweets', 'user_stats': False, 'language': None, 'parse_workers': 0})]
+        units = plan_work_units(jobs, parts_dir=os.path.join(self.directory, PARTS_DIR))
+        os.mkdir(os.path.join(self.directory, PARTS_DIR))
+        self.queue.add(units)
+
+        unit = self.queue.lease('dead', LEASE)
+        twit = DyingSearch(self.session, 0, 0, None, unit['part'], useragent=StaticUserAgent(),
+                           base_url=self.server.url, stop_event=threading.Event(),
+                           checkpoint_store=WorkUnitCheckpoint(self.queue, unit, 'dead', LEASE))
+        self.assertFalse(twit.search(unit['query'], target_type='tweets'))
+        unit = self.queue.units()[0]
+        self.assertEqual((unit['state'], unit['worker'], unit['counter']), ('leased', 'dead', DEAD_AFTER))
+
+        sleep(LEASE * 2)
+        self.queue.mark_closed()
+        searched = run_worker(self.queue, self.session, 0, 0, useragent_cache_path=self.useragent_cache_path,
+                              base_url=self.server.url, worker_id='alive', lease=LEASE, poll_interval=POLL_INTERVAL)
+        self.assertEqual(searched, 1)
+        unit = self.queue.units()[0]
+        self.assertEqual((unit['state'], unit['worker'], unit['attempts']), ('done', 'alive', 2))
+        # The dead worker lost its lease for good
+        self.assertFalse(self.queue.heartbeat(unit['id'], 'dead', LEASE))
+
+        self.assertEqual(merge_work_units(self.queue.units()), 0)
+        with io.open(output, 'rb') as f:
+            ids = [json.loads(line.decode('utf-8'))['id'] for line in f]
+        self.assertEqual(len(ids), PAGES * PAGE_SIZE)
+        self.assertEqual(len(set(ids)), PAGES * PAGE_SIZE)
+
+
+if __name__ == '__main__':
+    unittest.main()